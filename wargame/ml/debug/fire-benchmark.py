@@ -0,0 +1,448 @@
+#!/usr/bin/python
+# coding: UTF-8
+#    Benchmarks of the fire-to-flag path
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Measure what a player waits for between "fire" and the flag, without
+    hardware. Everything runs in a temporary directory on the simulated
+    launchers of missile2k13.py (transportBackend 'sim').
+
+    Suites:
+        fire    time each stage of MissilesController.fire(): readiness check,
+                crash subscription, launch plans, detection, DB updates,
+                flags and console output (rendered with missileUI.py if
+                urwid is installed). Two cases: the push path (crash events
+                of an in-process CrashPublisher, as sent by buildingSensor.py)
+                and the fallback without the sensor socket (sleep and parse
+                of the log, or of the journal with --journal)
+        log     cost to find the recent crashes in a buildingSensor.log of
+                10^3 to 10^7 lines (LogCursor) and in a journal of as many
+                records (CrashJournalReader)
+        db      cost of the DB operations of a launch against a growing
+                launches history, for both storage engines
+
+    Usage: fire-benchmark.py [-o FILE] [--fires N] [--journal] [--max-lines N]
+                             [--full-scan-max N] [--max-launches N] [--repeat N]
+                             [fire] [log] [db]
+
+    The results (milliseconds) are written as JSON to FILE or stdout.
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import getopt
+import inspect
+import platform
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'home-ml'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+import asyncLog
+import crashJournal
+import missile2k13
+from missile2k13 import MissilesController, DBController, SQLiteStorage, ShelveStorage, \
+                        CrashDetector, CrashSubscriber, CrashJournalReader, LogCursor
+
+RESULT_VERSION = 2
+LOG_DATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def summarize(samples):
+    """
+    Return the statistics of durations in seconds, in milliseconds
+    """
+    if not samples:
+        return None
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * len(s)))] * 1000
+    return {'count': len(s), 'mean': sum(s) * 1000 / len(s), 'min': s[0] * 1000, \
+            'p50': pick(0.5), 'p90': pick(0.9), 'max': s[-1] * 1000}
+
+def timeCall(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def initGameData(d, remaining=4):
+    """
+    This method write the initial game data (see initDB.py) in a storage dict
+    """
+    d['secureMods'] = {'fire': {'description': 'Benchmark', 'key': 'bench', 'locked': False}}
+    d['launches'] = []
+    d['remainingMissiles'] = [remaining, remaining, remaining]
+    d['buildings'] = [{'name': 'Grate ciel', 'value': 3, 'crashed': False, 'flag': 'FLAG1'}, \
+                      {'name': 'something', 'value': 5, 'crashed': False, 'flag': 'FLAG2'}]
+    d['loginFlag'] = 'FLAG0'
+    d['flagsGiven'] = []
+    d['lightStatus'] = False
+
+class StageTimer():
+    """
+    Replace methods by wrappers adding their duration to a stage
+    """
+    def __init__(self):
+        self.samples = {}
+        self._current = {}
+        self._wrapped = []
+
+    def wrap(self, owner, name, stage):
+        func = getattr(owner, name)
+        # The class attribute for a class, not the unbound method
+        self._wrapped.append((owner, name, owner.__dict__[name] if inspect.isclass(owner) else None))
+        self.samples.setdefault(stage, [])
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._current[stage] = self._current.get(stage, 0) + time.time() - start
+        setattr(owner, name, timed)
+
+    def add(self, stage, duration):
+        self._current[stage] = self._current.get(stage, 0) + duration
+
+    def endRun(self):
+        """
+        This method record a sample of every stage, 0 for those not reached
+        """
+        for stage in set(self.samples) | set(self._current):
+            self.samples.setdefault(stage, []).append(self._current.get(stage, 0))
+        self._current = {}
+
+    def reset(self):
+        self._current = {}
+
+    def unwrap(self):
+        """
+        This method restore the wrapped methods
+        """
+        for (owner, name, func) in reversed(self._wrapped):
+            if func is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, func)
+        self._wrapped = []
+
+class ConsoleOutput():
+    """
+    Print callbacks of the benchmarked controller. With urwid, each message
+    goes through the console widgets of missileUI.py and a 80x24 redraw.
+    """
+    size = (80, 24)
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.lines = []
+        self.box = None
+        try:
+            import missileUI
+            self.walker = missileUI.ScrollbackWalker()
+            self.box = missileUI.ExtendedListBox(self.walker)
+            self.skipped = None
+        except ImportError, e:
+            self.skipped = str(e)
+
+    def _print(self, kind, text):
+        start = time.time()
+        self.lines.append(kind + ': ' + text)
+        if self.box is not None:
+            self.walker.append((kind + '_text', text))
+            self.box.scroll_to_bottom()
+            self.box.render(self.size)
+        self.timer.add('ui', time.time() - start)
+
+    def print_info(self, text):
+        self._print('info', text)
+
+    def print_warning(self, text):
+        self._print('warning', text)
+
+    def print_error(self, text):
+        self._print('error', text)
+
+def benchFire(workDir, fires, crashSource):
+    """
+    Return the stage statistics of fires salvos of launcher #0, a building crashing each time
+    @param crashSource: 'push' (CrashSubscriber), 'log' or 'journal' (CrashDetector)
+    """
+    oStorage = SQLiteStorage(os.path.join(workDir, DBController._decorated.sqliteFile))
+    initGameData(oStorage.getDB(), fires + 1)
+    oStorage.close()
+
+    logFile = os.path.join(workDir, 'buildingSensor.log')
+    open(logFile, 'w').close()
+    journalFile = os.path.join(workDir, 'buildingSensor.journal')
+    CrashDetector.bsLogFile = logFile
+    CrashDetector.bsJournalFile = journalFile if crashSource == 'journal' else os.path.join(workDir, 'none.journal')
+    CrashSubscriber.socketFile = os.path.join(workDir, 'buildingSensor.sock' if crashSource == 'push' else 'none.sock')
+    publisher = None
+    if crashSource == 'push':
+        publisher = crashJournal.CrashPublisher(CrashSubscriber.socketFile)
+        publisher.start()
+    elif crashSource == 'journal':
+        with open(journalFile, 'wb') as f:
+            f.write(crashJournal.HEADER.pack(crashJournal.MAGIC, crashJournal.VERSION, \
+                                             crashJournal.RECORD.size, crashJournal.getBootId()))
+    MissilesController.transportBackend = 'sim'
+    MissilesController.hotplugFifo = os.path.join(workDir, 'hotplug')
+    MissilesController.TIME_WAIT_DELAY = 0
+
+    timer = StageTimer()
+    output = ConsoleOutput(timer)
+    oMC = MissilesController(output.print_info, output.print_warning, output.print_error)
+    oMC.registerDevices()
+    oMC.enable(0)
+    if publisher is not None:
+        execute = oMC._execute
+        def executeAndCrash(plans):
+            execute(plans)
+            # The sensor pushes a crash once the salvo is launched
+            publisher.publish(crashJournal.RECORD.pack(crashJournal.monotonicNs(), 12, 1, crashJournal.EVENT_CRASH, 0))
+        oMC._execute = executeAndCrash
+    timer.wrap(oMC, 'isReady', 'ready')
+    timer.wrap(oMC, '_subscribeCrashes', 'subscribe')
+    timer.wrap(oMC, '_execute', 'launchPlans')
+    timer.wrap(oMC, 'printFlags', 'printFlags')
+    timer.wrap(oMC, 'logCrash', 'setBuildingAsCrashed')
+    if crashSource == 'push':
+        timer.wrap(CrashSubscriber, 'waitForCrashes', 'detect')
+    else:
+        timer.wrap(CrashDetector, 'getCrashedBuildings', 'detect')
+        timer.wrap(CrashDetector, '_importRecentCrashEvents', 'parse')
+    oDB = DBController.getInstance()
+    timer.wrap(oDB, 'launchMissile', 'launchMissile')
+    timer.reset()
+
+    ml = oMC.getEnabledList()[0]
+    try:
+        for i in xrange(fires):
+            # Not timed: a launcher fires again once its fire cycle is over
+            time.sleep(max(0, ml.getBusyUntil() - time.time()))
+            # The sensor logs a crash when the salvo starts
+            if crashSource == 'log':
+                with open(logFile, 'a') as f:
+                    f.write('%s - BuildingSensor - INFO - Building #1 crashed\n' % datetime.now().strftime(LOG_DATE_TIME_FORMAT))
+            elif crashSource == 'journal':
+                with open(journalFile, 'ab') as f:
+                    f.write(crashJournal.RECORD.pack(crashJournal.monotonicNs(), 12, 1, crashJournal.EVENT_CRASH, 0))
+            timer.add('total', timeCall(oMC.fire))
+            timer.endRun()
+        oMC.scheduler.waitIdle()
+    finally:
+        timer.unwrap()
+
+    stages = dict([(stage, summarize(samples)) for (stage, samples) in timer.samples.items()])
+    if crashSource == 'push':
+        # CrashSubscriber.settleTime is part of the detection
+        stages['detectSettle'] = summarize([CrashSubscriber.settleTime] * fires)
+    else:
+        stages['detectSleep'] = summarize([d - p for (d, p) in zip(timer.samples.get('detect', []), timer.samples.get('parse', []))])
+    # Time of fire() outside the stages: the FIRE_DURATION sleep when buildingSensor.py can't be subscribed to
+    aTopStages = ['ready', 'subscribe', 'launchPlans', 'detect', 'printFlags', 'setBuildingAsCrashed', 'launchMissile']
+    stages['other'] = summarize([timer.samples['total'][i] - sum([timer.samples[s][i] for s in aTopStages]) \
+                                 for i in xrange(fires)])
+    return {'fires': fires, 'crashSource': crashSource, \
+            'flagsShown': len([l for l in output.lines if 'flag' in l]), \
+            'ui': 'missileUI' if output.skipped is None else 'skipped (' + output.skipped + ')', \
+            'stages': stages}
+
+def writeSyntheticLog(path, lines, recent):
+    """
+    This method write a buildingSensor.log of lines lines, the last recent ones in the last seconds
+    """
+    old = (datetime.now() - timedelta(hours=1)).strftime(LOG_DATE_TIME_FORMAT)
+    now = datetime.now().strftime(LOG_DATE_TIME_FORMAT)
+    oldLine = old + ' - BuildingSensor - DEBUG - Building #2 level 0\n'
+    chunk = oldLine * 10000
+    f = open(path, 'wb')
+    try:
+        count = lines - recent
+        while count > 0:
+            n = min(count, 10000)
+            f.write(chunk if n == 10000 else oldLine * n)
+            count -= n
+        for i in xrange(recent):
+            f.write(now + ' - BuildingSensor - INFO - Building #%d crashed\n' % (i % 2 + 1))
+    finally:
+        f.close()
+
+def writeSyntheticJournal(path, records, recent):
+    """
+    This method write a crash journal of records records, the last recent ones at the current time
+    """
+    now = crashJournal.monotonicNs()
+    oldRecords = ''.join([crashJournal.RECORD.pack(i, 16, 2, 1, 0) for i in xrange(10000)])
+    f = open(path, 'wb')
+    try:
+        f.write(crashJournal.HEADER.pack(crashJournal.MAGIC, crashJournal.VERSION, \
+                                         crashJournal.RECORD.size, crashJournal.getBootId()))
+        count = records - recent
+        while count > 0:
+            n = min(count, 10000)
+            f.write(oldRecords[:n * crashJournal.RECORD.size])
+            count -= n
+        for i in xrange(recent):
+            f.write(crashJournal.RECORD.pack(now + i, 12, 1, 1, 0))
+    finally:
+        f.close()
+
+def benchLog(workDir, maxLines, fullScanMax, recent=20):
+    """
+    Return the cost of reading the recent crashes for each size from 10^3 to maxLines
+    """
+    aResults = []
+    window = timedelta(seconds=CrashDetector.recentTimeValue)
+    lines = 1000
+    while lines <= maxLines:
+        path = os.path.join(workDir, 'buildingSensor.log')
+        writeSyntheticLog(path, lines, recent)
+        result = {'lines': lines, 'bytes': os.path.getsize(path)}
+
+        oCursor = LogCursor(path, LOG_DATE_TIME_FORMAT)
+        start = time.time()
+        found = len(oCursor.getEntriesSince(datetime.now() - window))
+        result['logCold'] = (time.time() - start) * 1000
+        with open(path, 'a') as f:
+            f.write(datetime.now().strftime(LOG_DATE_TIME_FORMAT) + ' - BuildingSensor - INFO - Building #1 crashed\n')
+        start = time.time()
+        oCursor.getEntriesSince(datetime.now() - window)
+        result['logWarm'] = (time.time() - start) * 1000
+        result['recentFound'] = found
+        result['logFull'] = None
+        if lines <= fullScanMax:
+            start = time.time()
+            LogCursor(path, LOG_DATE_TIME_FORMAT).getEntriesSince(datetime.min)
+            result['logFull'] = (time.time() - start) * 1000
+        os.unlink(path)
+
+        path = os.path.join(workDir, 'buildingSensor.journal')
+        writeSyntheticJournal(path, lines, recent)
+        start = time.time()
+        oReader = CrashJournalReader(path)
+        oReader.getEventsSince(crashJournal.monotonicNs() - CrashDetector.recentTimeValue * 1000000000)
+        oReader.close()
+        result['journal'] = (time.time() - start) * 1000
+        os.unlink(path)
+
+        aResults.append(result)
+        print >> sys.stderr, 'log: %d lines done' % lines
+        lines *= 10
+    return aResults
+
+def populateLaunches(oStorage, count):
+    """
+    This method fill the launches history of a storage with count old launches
+    """
+    old = datetime.now() - timedelta(days=1)
+    if isinstance(oStorage, SQLiteStorage):
+        with oStorage.transaction() as conn:
+            conn.executemany('INSERT INTO launches (mlId, source, datetime, cb) VALUES (?, ?, ?, ?)', \
+                                      [('0', '10.0.0.1', old, 'set([])')] * count)
+        oStorage.recount(['launches'])
+    else:
+        oStorage.getDB()['launches'] = [{'mlId': '0', 'source': '10.0.0.1', 'datetime': old, 'cb': 'set([])'} \
+                                        for i in xrange(count)]
+        oStorage.sync()
+
+def benchDB(workDir, maxLaunches, repeat):
+    """
+    Return the cost of the launch operations for histories of 10^2 to maxLaunches launches
+    """
+    aResults = []
+    for (backend, storageClass, fileName) in (('sqlite', SQLiteStorage, 'bench.sqlite'), \
+                                              ('shelve', ShelveStorage, 'bench.shelve')):
+        launches = 100
+        while launches <= maxLaunches:
+            path = os.path.join(workDir, fileName)
+            oStorage = storageClass(path)
+            initGameData(oStorage.getDB(), repeat + 1)
+            oStorage.sync()
+            populateLaunches(oStorage, launches)
+            ops = {}
+            for (name, func, args) in (('getLaunches(limit=1)', oStorage.getLaunches, (None, 1)), \
+                                       ('getLaunches(limit=10)', oStorage.getLaunches, (None, 10)), \
+                                       ('getCounters', oStorage.getCounters, ()), \
+                                       ('launchMissile', oStorage.launchMissile, (0, '10.0.0.1', set([0]))), \
+                                       ('setBuildingAsCrashed', oStorage.setBuildingAsCrashed, (0,)), \
+                                       ('sync', oStorage.sync, ())):
+                ops[name] = summarize([timeCall(func, *args) for i in xrange(repeat)])
+            oStorage.close()
+            for f in os.listdir(workDir):
+                if f.startswith(fileName):
+                    os.unlink(os.path.join(workDir, f))
+            aResults.append({'backend': backend, 'launches': launches, 'ops': ops})
+            print >> sys.stderr, 'db: %s with %d launches done' % (backend, launches)
+            launches *= 10
+    return aResults
+
+def usage():
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'ho:', ['help', 'fires=', 'journal', 'max-lines=', 'full-scan-max=', \
+                                                 'max-launches=', 'repeat='])
+    except getopt.GetoptError, e:
+        print >> sys.stderr, str(e)
+        usage()
+    options = {'output': None, 'fires': 3, 'journal': False, 'maxLines': 10 ** 7, 'fullScanMax': 10 ** 5, \
+               'maxLaunches': 10 ** 5, 'repeat': 20}
+    for (opt, value) in opts:
+        if opt in ('-h', '--help'):
+            usage()
+        elif opt == '-o':
+            options['output'] = os.path.abspath(value)
+        elif opt == '--journal':
+            options['journal'] = True
+        else:
+            key = {'--fires': 'fires', '--max-lines': 'maxLines', '--full-scan-max': 'fullScanMax', \
+                   '--max-launches': 'maxLaunches', '--repeat': 'repeat'}[opt]
+            options[key] = int(value)
+    aSuites = args or ['fire', 'log', 'db']
+    if [s for s in aSuites if s not in ('fire', 'log', 'db')]:
+        usage()
+
+    workDir = tempfile.mkdtemp(prefix='hf2k13-bench-')
+    os.chdir(workDir)
+    asyncLog.setup(os.path.join(workDir, 'benchmark.log'))
+    results = {'version': RESULT_VERSION, 'datetime': datetime.now().isoformat(), 'host': platform.node(), \
+               'python': platform.python_version(), 'options': options}
+    try:
+        if 'fire' in aSuites:
+            results['fire'] = []
+            for crashSource in ('push', 'journal' if options['journal'] else 'log'):
+                results['fire'].append(benchFire(workDir, options['fires'], crashSource))
+                print >> sys.stderr, 'fire: %s done' % crashSource
+        if 'log' in aSuites:
+            results['log'] = benchLog(workDir, options['maxLines'], options['fullScanMax'])
+        if 'db' in aSuites:
+            results['db'] = benchDB(workDir, options['maxLaunches'], options['repeat'])
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -43,38 +43,55 @@
 #
 #d.close()       # close it
 
-# clear log file
-open('/root/logs/buildingSensor.log', 'w').close()
+import os
+ROOT_DIR = os.environ.get('HF_ROOT_DIR', '/root')
+ML_DIR = os.environ.get('HF_ML_DIR', '/home/ml')
+
+# clear log and crash journal files (buildingSensor.py rewrites the journal header)
+open(ROOT_DIR + '/logs/buildingSensor.log', 'w').close()
+open(ROOT_DIR + '/logs/buildingSensor.journal', 'w').close()
 
 import shelve
+from missile2k13 import DBController, SQLiteStorage
 
-dbFile = '/home/ml/missile2k13.shelve'
-d = shelve.open(dbFile, writeback=True)
+data = {}
 
 # secure modules
-d['secureMods'] = {}
-d['secureMods']['fire'] = {'description': 'This module let the country fire a missile', 'key': 'DPQJDUEja43H8Dfhmjaq', 'locked': True}
+data['secureMods'] = {}
+data['secureMods']['fire'] = {'description': 'This module let the country fire a missile', 'key': 'DPQJDUEja43H8Dfhmjaq', 'locked': True}
 
 # Last launches
-d['launches'] = []
-#d['launches'].append({'mlId': None, 'source': None, 'datetime': None, 'crashed': None})       # Only for structure example
+data['launches'] = []
+#data['launches'].append({'mlId': None, 'source': None, 'datetime': None, 'crashed': None})       # Only for structure example
 
 # Set remaining missiles
-d['remainingMissiles'] = [4, 4, 4]
+data['remainingMissiles'] = [4, 4, 4]
 
 # Set remaining building
-d['buildings'] = []
-d['buildings'].append({'name': 'Grate ciel', 'value': 3, 'crashed': False, 'flag': 'GngWo2MipVoLTIhID7eJ'})
-d['buildings'].append({'name': 'something', 'value': 5, 'crashed': False, 'flag': 'sACGbNlemvcMXX9K2sD6'})
+data['buildings'] = []
+data['buildings'].append({'name': 'Grate ciel', 'value': 3, 'crashed': False, 'flag': 'GngWo2MipVoLTIhID7eJ'})
+data['buildings'].append({'name': 'something', 'value': 5, 'crashed': False, 'flag': 'sACGbNlemvcMXX9K2sD6'})
 
 # Login flag
-d['loginFlag'] = 'K5ycRDu478mLQTZnTiYX'
+data['loginFlag'] = 'K5ycRDu478mLQTZnTiYX'
 
 # Given flags list
-d['flagsGiven'] = []
+data['flagsGiven'] = []
 
 # Light Status (False = Off, True = On)
-d['lightStatus'] = False
+data['lightStatus'] = False
 
+# Write both storage engines so DBController.storageBackend can be switched
+dbFile = ML_DIR + '/missile2k13.shelve'
+d = shelve.open(dbFile, writeback=True)
+for key in data:
+    d[key] = data[key]
 d.sync()
 d.close()
+
+sqliteFile = ML_DIR + '/' + DBController._decorated.sqliteFile
+oStorage = SQLiteStorage(sqliteFile)
+d = oStorage.getDB()
+for key in data:
+    d[key] = data[key]
+oStorage.close()
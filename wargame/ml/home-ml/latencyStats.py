@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Latency histograms
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Latency histograms of the shell commands, USB transfers and DB
+    operations of the process. Each operation has a fixed array of
+    bucket counters, so the memory used does not grow with the number of
+    samples. The histograms are printed by the "stats" shell command and
+    written every MissilesController.metricsInterval seconds to the
+    metrics file of the process (logs/metrics-PID.prom) in the
+    Prometheus text format:
+
+        hf2k13_latency_seconds_bucket{pid="1234",op="cmd.fire",le="0.005"} 12
+        hf2k13_latency_seconds_sum{pid="1234",op="cmd.fire"} 0.0421
+        hf2k13_latency_seconds_count{pid="1234",op="cmd.fire"} 12
+
+    Every shell of an SSH session and missileServer.py write their own
+    file, removed when the process exits. Scrape the logs directory with
+    the textfile collector of node_exporter and sum by op.
+"""
+import os
+import time
+import array
+import atexit
+import contextlib
+from threading import Thread, Lock
+
+import asyncLog
+
+# Upper bounds of the buckets in seconds, the last bucket counts the slower samples
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, \
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_HISTOGRAMS = 256        # more names are counted in OVERFLOW_NAME
+OVERFLOW_NAME = 'other'
+METRIC_NAME = 'hf2k13_latency_seconds'
+
+class LatencyHistogram():
+    """
+    Counts of the samples of one operation by bucket
+    """
+    def __init__(self):
+        self.counts = array.array('L', [0] * (len(BUCKETS) + 1))
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def getPercentile(self, q):
+        """
+        Return the upper bound of the bucket holding the q quantile, at most the max
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def copy(self):
+        h = LatencyHistogram()
+        h.counts = array.array('L', self.counts)
+        h.count, h.sum, h.max = self.count, self.sum, self.max
+        return h
+
+class LatencyRegistry():
+    """
+    The histograms of the process by operation name
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._lock = Lock()
+        self.since = time.time()
+
+    def record(self, name, seconds):
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                if len(self._histograms) >= MAX_HISTOGRAMS:
+                    name = OVERFLOW_NAME
+                h = self._histograms.setdefault(name, LatencyHistogram())
+            h.record(seconds)
+
+    def getHistograms(self):
+        """
+        Return a copy of the histograms {name: LatencyHistogram}
+        """
+        with self._lock:
+            return dict([(name, h.copy()) for (name, h) in self._histograms.iteritems()])
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self.since = time.time()
+
+    def report(self, prefix=''):
+        """
+        Return the lines of the latency table, times in miliseconds
+        """
+        aLines = ['%-28s %8s %9s %9s %9s %9s %9s' % ('operation', 'count', 'mean', 'p50<=', 'p90<=', 'p99<=', 'max')]
+        for (name, h) in sorted(self.getHistograms().iteritems()):
+            if not name.startswith(prefix):
+                continue
+            aLines.append('%-28s %8d %9.2f %9.2f %9.2f %9.2f %9.2f' % \
+                          (name, h.count, h.sum * 1000 / h.count, h.getPercentile(0.5) * 1000, \
+                           h.getPercentile(0.9) * 1000, h.getPercentile(0.99) * 1000, h.max * 1000))
+        return aLines
+
+    def format(self, pid=None):
+        """
+        Return the histograms in the Prometheus text format, labeled with pid if given
+        """
+        aLines = ['# HELP %s Latency of the missile2k13 operations' % METRIC_NAME, \
+                  '# TYPE %s histogram' % METRIC_NAME]
+        labels = ''
+        if pid is not None:
+            labels = 'pid="%d",' % pid
+        for (name, h) in sorted(self.getHistograms().iteritems()):
+            seen = 0
+            for (i, n) in enumerate(h.counts):
+                seen += n
+                le = repr(BUCKETS[i]) if i < len(BUCKETS) else '+Inf'
+                aLines.append('%s_bucket{%sop="%s",le="%s"} %d' % (METRIC_NAME, labels, name, le, seen))
+            aLines.append('%s_sum{%sop="%s"} %r' % (METRIC_NAME, labels, name, h.sum))
+            aLines.append('%s_count{%sop="%s"} %d' % (METRIC_NAME, labels, name, h.count))
+        return '\n'.join(aLines) + '\n'
+
+    def dump(self, path, pid=None):
+        """
+        This method replace the metrics file atomically so a reader never sees a partial file
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.format(pid))
+        os.rename(tmp, path)
+
+class MetricsDumper(Thread):
+    """
+    Write the metrics file of the process every interval seconds, it is
+    removed at exit
+    """
+    def __init__(self, registry, path, interval):
+        Thread.__init__(self)
+        self.daemon = True
+        self.registry = registry
+        self.pid = os.getpid()
+        self.path = path % {'pid': self.pid}
+        self.interval = interval
+        self.log = asyncLog.getLogger('MetricsDumper')
+
+    def dump(self):
+        try:
+            self.registry.dump(self.path, self.pid)
+        except (IOError, OSError), e:
+            self.log.warning('Could not write ' + self.path + ': ' + str(e))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.dump()
+
+registry = LatencyRegistry()
+_dumper = None
+
+def record(name, seconds):
+    registry.record(name, seconds)
+
+@contextlib.contextmanager
+def timer(name):
+    """
+    Context manager recording the duration of its block
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        registry.record(name, time.time() - start)
+
+def timed(name):
+    """
+    Decorator recording the duration of every call
+    """
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.record(name, time.time() - start)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
+
+def startDumper(path, interval):
+    """
+    This method start the metrics file thread of the process (once),
+    %(pid)d in path is replaced by the process id
+    """
+    global _dumper
+    if _dumper is not None:
+        return
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+    _dumper = MetricsDumper(registry, path, interval)
+    _dumper.start()
+    atexit.register(_dumper.remove)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Launcher motion model
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Pan/tilt integration of the launcher moves, shared by the dead-reckoning
+    pose of missile2k13.py and the simulated launchers of ../sim, so the
+    simulator moves exactly like the controller expects.
+"""
+import time
+
+# Command bits of the control transfers (see MissileLauncher)
+CMD_DOWN = 0x01
+CMD_UP = 0x02
+CMD_LEFT = 0x04
+CMD_RIGHT = 0x08
+CMD_FIRE = 0x10
+CMD_STOP = 0x20
+
+class MotionModel():
+    """
+    Per-axis integration of the launcher moves. Pan grows to the left and
+    tilt grows up from the origin reached by a reset (right/down limit 
+    switches). An axis starts moving spinUp seconds after its direction 
+    changes and stops on its limits.
+    """
+    def __init__(self, panSpeed, tiltSpeed, spinUp, panRange, tiltRange, pan=0.0, tilt=0.0):
+        self.speeds = {'pan': panSpeed, 'tilt': tiltSpeed}
+        self.ranges = {'pan': panRange, 'tilt': tiltRange}
+        self.spinUp = spinUp
+        self.position = {'pan': pan, 'tilt': tilt}
+        now = time.time()
+        self._axes = {'pan': [0, now, now], 'tilt': [0, now, now]}    # direction, start, last update
+
+    @staticmethod
+    def getDirections(cmd):
+        """
+        Return the (pan, tilt) directions (-1, 0 or 1) of a command
+        """
+        if cmd & CMD_STOP:
+            return (0, 0)
+        pan = tilt = 0
+        if cmd & CMD_LEFT:
+            pan += 1
+        if cmd & CMD_RIGHT:
+            pan -= 1
+        if cmd & CMD_UP:
+            tilt += 1
+        if cmd & CMD_DOWN:
+            tilt -= 1
+        return (pan, tilt)
+
+    def update(self, now):
+        for axis in ('pan', 'tilt'):
+            direction, start, last = self._axes[axis]
+            if direction:
+                t0 = max(start + self.spinUp, last)
+                if now > t0:
+                    value = self.position[axis] + direction * self.speeds[axis] * (now - t0)
+                    self.position[axis] = min(max(value, 0.0), self.ranges[axis])
+            self._axes[axis][2] = now
+
+    def command(self, cmd, now):
+        """
+        This method apply a command sent at time now
+        """
+        self.update(now)
+        if cmd == CMD_FIRE:
+            return
+        for axis, direction in zip(('pan', 'tilt'), self.getDirections(cmd)):
+            if direction != self._axes[axis][0]:
+                self._axes[axis] = [direction, now, now]
+
+    def setPosition(self, pan, tilt, now):
+        """
+        This method set a known position, axes stopped
+        """
+        self.position = {'pan': pan, 'tilt': tilt}
+        self._axes = {'pan': [0, now, now], 'tilt': [0, now, now]}
+
+    def getPosition(self, now):
+        self.update(now)
+        return (self.position['pan'], self.position['tilt'])
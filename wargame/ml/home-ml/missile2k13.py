@@ -17,7 +17,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 # code extracted from nigiri
-# This code needs urwid version: 1.0.1-2 (debian stable repo)
+# This code needs urwid version: 1.0.1-2 (debian stable repo) for the UI (missileUI.py)
 #
 # Dependencies:
 # 	aptitude update; aptitude install pip
@@ -26,26 +26,85 @@
 # ToDo: make a script that move missiles launchers randomly (turned off when someone login)
 #
 
+import time
+_importStart = time.time()     # see StartupProfile
 import os
 import sys
 import traceback
 import re
-import time
-import copy
 import logging
 import locale
-import commands
-import inspect
-import usb.core
-import urwid
-import shelve
-import subprocess
-
-import RPi.GPIO as GPIO
-from logging.handlers import TimedRotatingFileHandler
-from threading import Thread
+import cPickle
+import contextlib
+import struct
+import socket
+import select
+import heapq
+import atexit
+import math
+import fcntl
+import getopt
+
+# Loaded when used: sqlite3, shelve (storages), ctypes (monotonicNs()), 
+# usb/usb1 (transports) and urwid (missileUI.py, interactive mode only)
+from threading import Thread, Event, Condition, Lock, current_thread, local
+from collections import deque
 from datetime import datetime,timedelta
-from urwid import MetaSignals
+from sessionIdentity import getSourceIP
+import asyncLog
+import latencyStats
+import spanTrace
+from launcherMotion import MotionModel
+import launcherMotion
+import crashJournal
+from crashJournal import CrashJournalReader, monotonicNs, getBootId
+
+# Overridden to run elsewhere than on the game box (see ../sim)
+ROOT_DIR = os.environ.get('HF_ROOT_DIR', '/root')
+
+class StartupProfile():
+    """
+    Timeline of the start-up phases (--startup-profile). Phases run in the
+    UI thread and in the background initialization thread, each one lasts
+    from the previous mark of its thread.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.marks = [('imports started', _importStart, 'MainThread')]
+        self.processStart = self._getProcessStart()
+
+    @staticmethod
+    def _getProcessStart():
+        """
+        Return the start time of the process (from /proc) or None
+        """
+        try:
+            stat = open('/proc/self/stat').read()
+            startTicks = float(stat.rsplit(')', 1)[1].split()[19])
+            uptime = float(open('/proc/uptime').read().split()[0])
+            return time.time() - (uptime - startTicks / os.sysconf('SC_CLK_TCK'))
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+    def mark(self, name):
+        self.marks.append((name, time.time(), current_thread().name))
+
+    def report(self):
+        """
+        Return the lines of the timeline
+        """
+        origin = self.processStart or _importStart
+        aLines = ['Start-up profile (ms since the process started, ms of the phase):']
+        if self.processStart is not None:
+            aLines.append('    %8.1f %8.1f  %s' % ((_importStart - origin) * 1000, (_importStart - origin) * 1000, 'python interpreter'))
+        last = {}
+        for (name, t, thread) in sorted(self.marks, key=lambda m: m[1]):
+            previous = last.get(thread, _importStart)
+            aLines.append('    %8.1f %8.1f  %s (%s)' % ((t - origin) * 1000, (t - previous) * 1000, name, thread))
+            last[thread] = t
+        return aLines
+
+startupProfile = StartupProfile()
 
 class Singleton:
     """
@@ -86,80 +145,900 @@ class Singleton:
         return isinstance(inst, self._decorated)
 
 
-class MissileLauncher(Thread):
+def encodeCommand(cmd):
     """
-    This is the missile launcher controller class. 
+    Return the 8 bytes control transfer payload of a launcher command
     """
-    _dev = None
-    _shallEnd = False
-    id = None
+    return struct.pack('8B', 0x02, cmd, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00)
 
-    def __init__(self,dev, id):
-        Thread.__init__(self)
-        self.daemon=True
-        self._dev = dev
-        self.id = id
-        self._setupDevice()
-    
-    def _setupDevice(self):
-        if self._dev is None:
+class PyUSBTransport():
+    """
+    Synchronous transport using pyusb. A failed transfer is retried before raising usb.core.USBError.
+    """
+    timeout = 100           # in miliseconds
+    retries = 2
+
+    def __init__(self, dev):
+        import usb.core
+        if dev is None:
             raise ValueError('Launcher not found.')
+        self._USBError = usb.core.USBError
+        self._dev = dev
+        self.location = self.getLocation(dev)
         if self._dev.is_kernel_driver_active(0) is True:
             self._dev.detach_kernel_driver(0)
             self._dev.set_configuration()
 
-    def run(self):
+    @staticmethod
+    def getLocation(dev):
         """
+        Return the USB location (bus:port[.port...]) of a device
         """
-        while not self._shallEnd:
+        ports = getattr(dev, 'port_numbers', None) or (dev.port_number,)
+        return str(dev.bus) + ':' + '.'.join([str(port) for port in ports])
+
+    @staticmethod
+    def find(idVendor, idProduct, location=None):
+        import usb.core
+        return [PyUSBTransport(dev) for dev in \
+                usb.core.find(find_all=True, idVendor=idVendor, idProduct=idProduct) \
+                if location is None or PyUSBTransport.getLocation(dev) == location]
+
+    def send(self, packet):
+        for attempt in xrange(self.retries + 1):
             try:
-                time.sleep(1)
-            except KeyboardInterrupt:
-                break
+                self._dev.ctrl_transfer(0x21, 0x09, 0, 0, packet, self.timeout)
+                return
+            except self._USBError:
+                if attempt == self.retries:
+                    raise
 
-    def up(self,delay):
-        self.stop()
-        self._dev.ctrl_transfer(0x21,0x09,0,0,[0x02,0x02,0x00,0x00,0x00,0x00,0x00,0x00]) 
-        time.sleep(delay/1000)
-        self.stop()
-    
-    def down(self,delay):
-        self.stop()
-        self._dev.ctrl_transfer(0x21,0x09,0,0,[0x02,0x01,0x00,0x00,0x00,0x00,0x00,0x00])
-        time.sleep(delay/1000)
-        self.stop()
-    
-    def left(self,delay):
-        self.stop()
-        self._dev.ctrl_transfer(0x21,0x09,0,0,[0x02,0x04,0x00,0x00,0x00,0x00,0x00,0x00])
-        time.sleep(delay/1000)
-        self.stop()
-    
-    def right(self,delay):
-        self.stop()
-        self._dev.ctrl_transfer(0x21,0x09,0,0,[0x02,0x08,0x00,0x00,0x00,0x00,0x00,0x00])
-        time.sleep(delay/1000)
-        self.stop()
-    
-    def stop(self):
-        self._dev.ctrl_transfer(0x21,0x09,0,0,[0x02,0x20,0x00,0x00,0x00,0x00,0x00,0x00])
-    
-    def fire(self):
-        self._dev.ctrl_transfer(0x21,0x09,0,0,[0x02,0x10,0x00,0x00,0x00,0x00,0x00,0x00])
-        time.sleep(3)
-    
-    def reset(self):
-        self._dev.ctrl_transfer(0x21,0x09,0,0,[0x02,0x09,0x00,0x00,0x00,0x00,0x00,0x00])
-        time.sleep(6)
+    def close(self):
+        import usb.util
+        usb.util.dispose_resources(self._dev)
+
+class LibUSBEventLoop(Thread):
+    """
+    Thread handling the libusb events (transfer completions) of a context
+    """
+    def __init__(self, context):
+        Thread.__init__(self)
+        self.daemon = True
+        self.context = context
+
+    def run(self):
+        while True:
+            self.context.handleEventsTimeout(1)
+
+class LibUSBAsyncTransport():
+    """
+    Asynchronous transport using libusb1 (python-libusb1). send() submits 
+    the transfer and returns at once, so the transfers of every launcher
+    can be in flight together. A failed completion is raised by the next
+    send() since nobody waits for it.
+    """
+    timeout = 100           # in miliseconds
+    _context = None
+    _loop = None
+
+    def __init__(self, device):
+        import usb1
+        self.usb1 = usb1
+        self._handle = device.open()
+        self.location = self.getLocation(device)
+        if self._handle.kernelDriverActive(0):
+            self._handle.detachKernelDriver(0)
+        self._handle.claimInterface(0)
+        self._inFlight = set()
+        self._errors = []
+        self._lock = Lock()
+
+    @staticmethod
+    def getLocation(device):
+        return str(device.getBusNumber()) + ':' + '.'.join([str(port) for port in device.getPortNumberList()])
+
+    @staticmethod
+    def find(idVendor, idProduct, location=None):
+        import usb1
+        # One context for every device, its event loop handles all the completions
+        if LibUSBAsyncTransport._context is None:
+            LibUSBAsyncTransport._context = usb1.USBContext()
+            LibUSBAsyncTransport._loop = LibUSBEventLoop(LibUSBAsyncTransport._context)
+            LibUSBAsyncTransport._loop.start()
+        return [LibUSBAsyncTransport(device) for device in LibUSBAsyncTransport._context.getDeviceList() \
+                if device.getVendorID() == idVendor and device.getProductID() == idProduct and \
+                   (location is None or LibUSBAsyncTransport.getLocation(device) == location)]
+
+    def send(self, packet):
+        with self._lock:
+            if self._errors:
+                error = self._errors.pop(0)
+                raise IOError(error)
+            transfer = self._handle.getTransfer()
+            transfer.setControl(0x21, 0x09, 0, 0, packet, callback=self._onComplete, timeout=self.timeout)
+            # Keep a reference until libusb is done with it
+            self._inFlight.add(transfer)
+        transfer.submit()
+
+    def _onComplete(self, transfer):
+        with self._lock:
+            self._inFlight.discard(transfer)
+            if transfer.getStatus() != self.usb1.TRANSFER_COMPLETED:
+                self._errors.append('Transfer failed (status ' + str(transfer.getStatus()) + ')')
+
+    def close(self):
+        self._handle.close()
+
+class SimulatedTransport():
+    """
+    In-memory launcher to run without hardware. Its moves follow a 
+    MotionModel with the speeds of a real unit, not the nominal ones of
+    LauncherPose. The units of find() differ like real ones (see UNITS).
+    """
+    panSpeed = 55.0         # in degrees per second
+    tiltSpeed = 22.0        # in degrees per second
+    spinUp = 0.03           # in seconds, motor latency before a move starts
+    panRange = 300.0        # in degrees
+    tiltRange = 40.0        # in degrees
+    # (panSpeed, tiltSpeed, spinUp) of the units sim:0, sim:1, ... (cycled)
+    UNITS = [(55.0, 22.0, 0.03), (52.0, 21.0, 0.03), (58.0, 23.5, 0.04), (47.0, 18.5, 0.05)]
+
+    def __init__(self, panSpeed=None, tiltSpeed=None, spinUp=None, location='sim:0'):
+        self.location = location
+        if panSpeed is not None:
+            self.panSpeed = panSpeed
+        if tiltSpeed is not None:
+            self.tiltSpeed = tiltSpeed
+        if spinUp is not None:
+            self.spinUp = spinUp
+        self.model = MotionModel(self.panSpeed, self.tiltSpeed, self.spinUp, self.panRange, self.tiltRange, \
+                                 self.panRange / 2, self.tiltRange / 2)
+        self.transfers = 0
+        self.shots = []
+
+    @staticmethod
+    def find(count):
+        return [SimulatedTransport.create('sim:' + str(i)) for i in xrange(count)]
+
+    @staticmethod
+    def create(location):
+        """
+        Return the unit plugged at a location, sim:N is the unit N of UNITS
+        """
+        try:
+            index = int(location.rsplit(':', 1)[-1])
+        except ValueError:
+            index = 0
+        panSpeed, tiltSpeed, spinUp = SimulatedTransport.UNITS[index % len(SimulatedTransport.UNITS)]
+        return SimulatedTransport(panSpeed, tiltSpeed, spinUp, location)
+
+    def send(self, packet):
+        now = time.time()
+        cmd = ord(packet[1])
+        self.transfers += 1
+        self.model.command(cmd, now)
+        if cmd == MissileLauncher.CMD_FIRE:
+            self.shots.append((now,) + self.model.getPosition(now))
+
+    def getPosition(self):
+        """
+        Return the true (pan, tilt) of the simulated launcher
+        """
+        return self.model.getPosition(time.time())
+
+    def close(self):
+        pass
+
+class LauncherPose():
+    """
+    Dead-reckoning estimate of the pan/tilt of a launcher, updated from the
+    commands actually sent. The pose is unknown until the first reset, 
+    which drives the launcher to the origin.
+
+    The class speeds are the nominal ones, the speeds of the device come 
+    from its calibration profile (see LauncherCalibration) when it has one.
+    """
+    panSpeed = 50.0         # in degrees per second
+    tiltSpeed = 20.0        # in degrees per second
+    spinUp = 0.0            # in seconds
+    panRange = 300.0        # in degrees
+    tiltRange = 40.0        # in degrees
+    panForward = 150.0      # pan when the launcher faces the +y axis (see aim())
+    tiltLevel = 5.0         # tilt when the launcher is level
+    minAngle = 0.5          # in degrees, smaller corrections are skipped
+
+    def __init__(self):
+        self.known = False
+        self.profile = None
+        self.model = MotionModel(self.panSpeed, self.tiltSpeed, self.spinUp, self.panRange, self.tiltRange)
+
+    def setProfile(self, profile):
+        """
+        This method use the speeds of a calibration profile
+        @param profile: {'panSpeed': ..., 'tiltSpeed': ..., 'spinUp': ...} or None for the nominal speeds
+        """
+        self.model.update(time.time())
+        self.profile = profile
+        if profile is None:
+            profile = {'panSpeed': self.panSpeed, 'tiltSpeed': self.tiltSpeed, 'spinUp': self.spinUp}
+        self.model.speeds = {'pan': profile['panSpeed'], 'tilt': profile['tiltSpeed']}
+        self.model.spinUp = profile['spinUp']
+
+    def getSpinUp(self):
+        return self.model.spinUp
+
+    @staticmethod
+    def getAxis(cmd):
+        if cmd & (MissileLauncher.CMD_LEFT | MissileLauncher.CMD_RIGHT):
+            return 'pan'
+        return 'tilt'
+
+    def getMoveTime(self, cmd, duration):
+        """
+        Return how long this launcher must move to turn as much as a nominal launcher in duration seconds
+        """
+        axis = self.getAxis(cmd)
+        return duration * getattr(self, axis + 'Speed') / self.model.speeds[axis]
+
+    def onCommand(self, cmd, now):
+        if cmd == MissileLauncher.CMD_RESET:
+            self.model.setPosition(0.0, 0.0, now)
+            self.known = True
+        else:
+            self.model.command(cmd, now)
+
+    def getPosition(self):
+        return self.model.getPosition(time.time())
+
+    def getDuration(self, axis, angle):
+        """
+        Return the move duration (in seconds) turning axis by angle degrees
+        """
+        return abs(angle) / self.model.speeds[axis] + self.model.spinUp
+
+    def getGotoPlan(self, pan, tilt):
+        """
+        This method return the steps (offset in seconds, command) reaching (pan, tilt) 
+        from the current pose: both axes move together, then the longest one 
+        finishes alone. At most three transfers.
+        """
+        pan = min(max(pan, 0.0), self.panRange)
+        tilt = min(max(tilt, 0.0), self.tiltRange)
+        curPan, curTilt = self.getPosition()
+        moves = []
+        if abs(pan - curPan) >= self.minAngle:
+            moves.append((self.getDuration('pan', pan - curPan), \
+                          MissileLauncher.CMD_LEFT if pan > curPan else MissileLauncher.CMD_RIGHT))
+        if abs(tilt - curTilt) >= self.minAngle:
+            moves.append((self.getDuration('tilt', tilt - curTilt), \
+                          MissileLauncher.CMD_UP if tilt > curTilt else MissileLauncher.CMD_DOWN))
+        if len(moves) == 0:
+            return []
+        moves.sort()
+        steps = [(0, reduce(lambda a, b: a | b, [cmd for (duration, cmd) in moves]))]
+        if len(moves) == 2 and moves[1][0] > moves[0][0]:
+            steps.append((moves[0][0], moves[1][1]))
+        steps.append((moves[-1][0], MissileLauncher.CMD_STOP))
+        return steps
+
+    def toPanTilt(self, x, y, z):
+        """
+        Return the (pan, tilt) pointing at (x, y, z), launcher at the origin facing +y, z up
+        """
+        pan = self.panForward + math.degrees(math.atan2(-x, y))
+        tilt = self.tiltLevel + math.degrees(math.atan2(z, math.hypot(x, y)))
+        return (pan, tilt)
+
+class MissileLauncher():
+    """
+    This is the missile launcher controller class. Timed commands are run 
+    by the LauncherScheduler of the MissilesController.
+    """
+    CMD_DOWN = launcherMotion.CMD_DOWN
+    CMD_UP = launcherMotion.CMD_UP
+    CMD_LEFT = launcherMotion.CMD_LEFT
+    CMD_RIGHT = launcherMotion.CMD_RIGHT
+    CMD_FIRE = launcherMotion.CMD_FIRE
+    CMD_STOP = launcherMotion.CMD_STOP
+    CMD_RESET = CMD_RIGHT | CMD_DOWN    # Runs to the limit switches
+    COMMAND_NAMES = {CMD_DOWN: 'down', CMD_UP: 'up', CMD_LEFT: 'left', CMD_RIGHT: 'right', \
+                     CMD_FIRE: 'fire', CMD_STOP: 'stop', CMD_RESET: 'reset'}    # other combinations are 'move'
+    FIRE_DURATION = 3       # in seconds
+    RESET_DURATION = 6      # in seconds
+
+    transport = None        # PyUSBTransport, LibUSBAsyncTransport or SimulatedTransport
+    pose = None             # LauncherPose
+    _busyUntil = 0
+    id = None
+    queue = None            # CommandQueue, set by LauncherScheduler.addLauncher()
+
+    def __init__(self, transport, id):
+        self.transport = transport
+        self.id = id
+        self.pose = LauncherPose()
+
+    def send(self, cmd):
+        """
+        Send a command to the device. Fire and reset keep the launcher busy for their cycle.
+        """
+        with latencyStats.timer(self.STAT_NAMES[cmd]):
+            with spanTrace.span(self.STAT_NAMES[cmd] + ' ml=' + str(self.id)):
+                self.transport.send(self.PACKETS[cmd])
+        self.pose.onCommand(cmd, time.time())
+        if cmd == self.CMD_FIRE:
+            self._busyUntil = time.time() + self.FIRE_DURATION
+        elif cmd == self.CMD_RESET:
+            self._busyUntil = time.time() + self.RESET_DURATION
+
+    def getBusyUntil(self):
+        return self._busyUntil
+
+    def isBusy(self):
+        return self._busyUntil > time.time()
+
+    def getFirePlan(self):
+        return [(0, self.CMD_FIRE)]
+
+    def getResetPlan(self):
+        # No stop: the launcher stops by itself on the limit switches
+        return [(0, self.CMD_RESET), (self.RESET_DURATION, None)]
 
     def quit(self):
         pass
     
+    def getGotoPlan(self, pan, tilt):
+        return self.pose.getGotoPlan(pan, tilt)
+
     def aim(self, x, y, z):
         """
-        Nice but will it really ever be coded...?
+        Return the plan pointing the launcher at (x, y, z), see LauncherPose.toPanTilt()
         """
-        pass
+        return self.pose.getGotoPlan(*self.pose.toPanTilt(x, y, z))
+
+# Control transfer payloads of every command combination, encoded once
+MissileLauncher.PACKETS = dict([(cmd, encodeCommand(cmd)) for cmd in xrange(0x40)])
+# Latency histogram of the transfers of each command
+MissileLauncher.STAT_NAMES = dict([(cmd, 'usb.' + MissileLauncher.COMMAND_NAMES.get(cmd, 'move')) for cmd in xrange(0x40)])
+
+class SchedulerJob():
+    """
+    Plans submitted together to the LauncherScheduler
+    """
+    def __init__(self, count):
+        self.remaining = count
+        self.errors = []
+        self.done = Event()
+        if count == 0:
+            self.done.set()
+
+class CommandQueue():
+    """
+    Commands waiting for one launcher.
+
+    Consecutive moves in the same direction are merged into one longer move
+    (a move arriving while the same move runs just pushes its stop back) and
+    the stop sent before a move is dropped when the launcher is known to be
+    stopped. transfersSaved counts the USB transfers avoided compared to the
+    stop/move/stop sequence of every move command.
+    """
+    def __init__(self):
+        self.items = deque()        # ['move', cmd, duration] or ['plan', steps, job]
+        self.active = False         # a move or a plan is running
+        self.motion = None          # command of the running move
+        self.stopAt = 0
+        self.generation = 0         # invalidates the stop timer of an extended move
+        self.stopped = False        # the device is known to be stopped
+        self.wakeAt = 0
+        self.transfersSent = 0
+        self.transfersSaved = 0
+
+    def isIdle(self):
+        return not self.active and len(self.items) == 0
+
+class LauncherScheduler(Thread):
+    """
+    Single thread owning the USB I/O of every launcher.
+
+    Each launcher has a CommandQueue. Moves are queued and return at once;
+    plans of (offset, command) steps (fire, reset, ...) are queued after
+    them and the caller waits for their completion. Every launcher runs its
+    queue concurrently and all the steps are timed from one heap of 
+    deadlines, so a group command lasts as long as one launcher's command.
+    """
+    MOVE_TRANSFERS = 3      # stop, move, stop
+    planTimeout = 60        # in seconds, longest wait for the plans of execute()
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self._timers = []
+        self._seq = 0
+        self._cond = Condition()
+        self._launchers = []
+        self.errors = []
+
+    def addLauncher(self, ml):
+        with self._cond:
+            ml.queue = CommandQueue()
+            self._launchers.append(ml)
+
+    def removeLauncher(self, ml):
+        """
+        This method forget an unplugged launcher. Its queued moves are dropped and 
+        its queued plans fail, the running ones end with the errors of their sends.
+        """
+        with self._cond:
+            if ml in self._launchers:
+                self._launchers.remove(ml)
+            q = ml.queue
+            while len(q.items) > 0:
+                item = q.items.popleft()
+                if item[0] == 'plan':
+                    item[2].errors.append('Launcher #' + str(ml.id) + ': unplugged')
+                    self._endPlan(ml, item[2])
+            self._cond.notifyAll()
+
+    def enqueueMove(self, ml, cmd, duration):
+        """
+        This method queue a move without waiting
+        @param duration: Motion duration in seconds, the spin-up of the launcher is added when the move starts
+        """
+        with self._cond:
+            q = ml.queue
+            if q.motion == cmd and len(q.items) == 0:
+                q.stopAt += duration
+                q.generation += 1
+                self._addTimer(q.stopAt, self._endMove, ml, q.generation)
+                q.transfersSaved += self.MOVE_TRANSFERS
+            elif len(q.items) > 0 and q.items[-1][0] == 'move' and q.items[-1][1] == cmd:
+                q.items[-1][2] += duration
+                q.transfersSaved += self.MOVE_TRANSFERS
+            else:
+                q.items.append(['move', cmd, duration])
+            self._cond.notifyAll()
+
+    def execute(self, plans):
+        """
+        This method queue the plans after the pending moves and wait until every step is done. 
+        Return the errors raised by the devices.
+        @param plans: {launcher: [(offset in seconds, command or None), ...] or a function returning them}
+        """
+        job = SchedulerJob(len(plans))
+        with self._cond:
+            for ml, steps in plans.iteritems():
+                if ml not in self._launchers:
+                    # Unplugged since the caller listed it, nothing would run its plan
+                    job.errors.append('Launcher #' + str(ml.id) + ': unplugged')
+                    job.remaining -= 1
+                    continue
+                if not callable(steps):
+                    steps = sorted(steps)
+                ml.queue.items.append(['plan', steps, job])
+            if job.remaining == 0:
+                job.done.set()
+            self._cond.notifyAll()
+        if not job.done.wait(self.planTimeout):
+            with self._cond:
+                return job.errors + ['Launchers did not complete their commands within ' + str(self.planTimeout) + ' s']
+        return job.errors
+
+    def waitIdle(self):
+        """
+        This method wait until every queue is empty and every launcher is stopped
+        """
+        with self._cond:
+            while not all([ml.queue.isIdle() for ml in self._launchers]):
+                self._cond.wait()
+
+    def popErrors(self):
+        with self._cond:
+            errors = self.errors
+            self.errors = []
+        return errors
+
+    def _addTimer(self, due, callback, *args):
+        self._seq += 1
+        heapq.heappush(self._timers, (due, self._seq, callback, args))
+
+    def _send(self, ml, cmd):
+        try:
+            ml.send(cmd)
+        except Exception, e:
+            return 'Launcher #' + str(ml.id) + ': ' + str(e)
+        ml.queue.transfersSent += 1
+        ml.queue.stopped = (cmd == ml.CMD_STOP)
+        return None
+
+    def _dispatch(self, ml, now):
+        """
+        Start the next queued item of an idle launcher
+        """
+        q = ml.queue
+        if q.active or len(q.items) == 0:
+            return
+        busyUntil = ml.getBusyUntil()
+        if busyUntil > now:
+            if q.wakeAt != busyUntil:
+                q.wakeAt = busyUntil
+                self._addTimer(busyUntil, lambda: None)
+            return
+        item = q.items.popleft()
+        q.active = True
+        if item[0] == 'move':
+            cmd, duration = item[1], item[2]
+            sent = 1
+            if not q.stopped:
+                self._reportError(self._send(ml, ml.CMD_STOP))
+                sent = 2
+            self._reportError(self._send(ml, cmd))
+            q.transfersSaved += self.MOVE_TRANSFERS - (sent + 1)
+            q.motion = cmd
+            q.stopAt = now + ml.pose.getSpinUp() + duration
+            q.generation += 1
+            self._addTimer(q.stopAt, self._endMove, ml, q.generation)
+        else:
+            steps, job = item[1], item[2]
+            if callable(steps):
+                # Planned from the launcher state once the previous items are done
+                steps = sorted(steps())
+            state = {'left': len(steps)}
+            for (offset, cmd) in steps:
+                self._addTimer(now + offset, self._planStep, ml, cmd, job, state)
+            if len(steps) == 0:
+                self._endPlan(ml, job)
+
+    def _endMove(self, ml, generation):
+        q = ml.queue
+        if generation != q.generation or q.motion is None:
+            return
+        self._reportError(self._send(ml, ml.CMD_STOP))
+        q.motion = None
+        q.active = False
+
+    def _planStep(self, ml, cmd, job, state):
+        if cmd is not None:
+            error = self._send(ml, cmd)
+            if error is not None:
+                job.errors.append(error)
+        state['left'] -= 1
+        if state['left'] == 0:
+            self._endPlan(ml, job)
+
+    def _endPlan(self, ml, job):
+        ml.queue.active = False
+        job.remaining -= 1
+        if job.remaining == 0:
+            job.done.set()
+
+    def _reportError(self, error):
+        if error is not None:
+            self.errors.append(error)
+
+    def run(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                for ml in self._launchers:
+                    self._dispatch(ml, now)
+                if self._timers and self._timers[0][0] <= now:
+                    due, seq, callback, args = heapq.heappop(self._timers)
+                    callback(*args)
+                    self._cond.notifyAll()
+                elif self._timers:
+                    self._cond.wait(self._timers[0][0] - now)
+                else:
+                    self._cond.wait()
+
+class LauncherCalibration():
+    """
+    Measure the speeds of a launcher. Moves of increasing durations are run
+    on each axis from the reset position, the angle turned by each move is 
+    read from the transport and a line angle = speed * (duration - spinUp) 
+    is fitted per axis. Only transports reporting their position can be 
+    calibrated (the simulated one for now).
+    """
+    durations = [0.1, 0.2, 0.4, 0.8]    # in seconds
+    repeat = 2
+    settleTime = 0.1                    # in seconds, wait after each stop
+
+    def __init__(self, scheduler, ml):
+        self.scheduler = scheduler
+        self.ml = ml
+        self.errors = []
+        self.samples = {'pan': [], 'tilt': []}
+        self.profile = None
+
+    def _run(self, plan):
+        self.errors += self.scheduler.execute({self.ml: plan})
+        time.sleep(self.settleTime)
+
+    def _measure(self, axis, cmd, back):
+        index = ['pan', 'tilt'].index(axis)
+        for i in xrange(self.repeat):
+            for duration in self.durations:
+                start = self.ml.transport.getPosition()[index]
+                self._run([(0, cmd), (duration, MissileLauncher.CMD_STOP)])
+                self.samples[axis].append((duration, self.ml.transport.getPosition()[index] - start))
+                self._run([(0, back), (duration, MissileLauncher.CMD_STOP)])
+
+    @staticmethod
+    def fit(samples):
+        """
+        Return (speed, spinUp) of the least squares line through the (duration, angle) samples
+        """
+        samples = [(d, a) for (d, a) in samples if a > 0]
+        if len(set([d for (d, a) in samples])) < 2:
+            return None
+        n = float(len(samples))
+        meanD = sum([d for (d, a) in samples]) / n
+        meanA = sum([a for (d, a) in samples]) / n
+        speed = sum([(d - meanD) * (a - meanA) for (d, a) in samples]) / \
+                sum([(d - meanD) ** 2 for (d, a) in samples])
+        if speed <= 0:
+            return None
+        return (speed, max(0.0, meanD - meanA / speed))
+
+    def run(self):
+        """
+        This method set profile to the profile of the launcher or None if it could not be fitted
+        """
+        self._run(self.ml.getResetPlan())
+        self._measure('pan', MissileLauncher.CMD_LEFT, MissileLauncher.CMD_RIGHT)
+        self._measure('tilt', MissileLauncher.CMD_UP, MissileLauncher.CMD_DOWN)
+        pan = self.fit(self.samples['pan'])
+        tilt = self.fit(self.samples['tilt'])
+        if self.errors or pan is None or tilt is None:
+            self.profile = None
+        else:
+            self.profile = {'panSpeed': pan[0], 'tiltSpeed': tilt[0], 'spinUp': (pan[1] + tilt[1]) / 2}
+        return self.profile
+
+class NetlinkHotplugSource():
+    """
+    USB hotplug events of the launchers, read from the kernel uevents 
+    (netlink). The events come before udev sets the permissions of the 
+    device, see DeviceRegistry.attachRetries.
+    """
+    NETLINK_KOBJECT_UEVENT = 15
+    KERNEL_GROUP = 1
+
+    def __init__(self, idVendor, idProduct):
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_KOBJECT_UEVENT)
+        self._sock.bind((0, self.KERNEL_GROUP))
+        self._sock.setblocking(0)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def _parse(self, data):
+        env = dict([field.split('=', 1) for field in data.split('\0')[1:] if '=' in field])
+        if env.get('SUBSYSTEM') != 'usb' or env.get('DEVTYPE') != 'usb_device' or \
+           env.get('ACTION') not in ('add', 'remove'):
+            return None
+        product = env.get('PRODUCT', '').split('/')
+        if len(product) < 2 or int(product[0], 16) != self.idVendor or int(product[1], 16) != self.idProduct:
+            return None
+        # DEVPATH ends with the kernel name of the device: BUS-PORT[.PORT...]
+        bus, ports = env['DEVPATH'].rsplit('/', 1)[-1].split('-', 1)
+        return (env['ACTION'], str(int(bus)) + ':' + ports)
+
+    def readEvents(self):
+        """
+        Return the pending (action, location) events, action is 'add' or 'remove'
+        """
+        events = []
+        while True:
+            try:
+                data = self._sock.recv(8192)
+            except socket.error:
+                break
+            event = self._parse(data)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self):
+        self._sock.close()
+
+class PipeHotplugSource():
+    """
+    Pollable stand-in for NetlinkHotplugSource: events are lines 
+    "add LOCATION" or "remove LOCATION" written with inject() or, if a path
+    is given, to that FIFO (echo add sim:3 > path).
+    """
+    def __init__(self, path=None):
+        if path is None:
+            self._fd, self._wfd = os.pipe()
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        else:
+            if not os.path.exists(path):
+                os.mkfifo(path, 0600)
+            # Opened read/write so the FIFO never reports EOF when a writer leaves
+            self._fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            self._wfd = self._fd
+        self._buffer = ''
+
+    def fileno(self):
+        return self._fd
+
+    def inject(self, action, location):
+        os.write(self._wfd, action + ' ' + location + '\n')
+
+    def readEvents(self):
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            self._buffer += data
+        lines = self._buffer.split('\n')
+        self._buffer = lines.pop()
+        return [tuple(line.split()) for line in lines if len(line.split()) == 2]
+
+    def close(self):
+        os.close(self._fd)
+        if self._wfd != self._fd:
+            os.close(self._wfd)
+
+class DeviceRegistry(Thread):
+    """
+    Launchers currently plugged. The USB bus is enumerated once, then the
+    registry follows the hotplug events of its source, so commands never
+    rescan the bus.
+
+    Ids are kept per USB location: a launcher unplugged and plugged back in
+    the same port gets its id back, with its missiles and enabled state. 
+    The first enumeration is sorted by bus and port numbers so the ids do
+    not depend on the enumeration order (1:2 comes before 1:10).
+    A new location gets the lowest id never used, else the lowest id of an
+    unplugged launcher. Ids stop at the number of rows of remainingMissiles:
+    a launcher without an id left is not attached.
+    """
+    attachRetries = 10      # udev may not have set the permissions of a new device yet
+    attachDelay = 0.2       # in seconds, between two attempts
+
+    def __init__(self, findTransports, onAttach, getIdLimit, scheduler, source=None):
+        """
+        @param findTransports: function(location=None) returning the transports of the launchers (at location)
+        @param onAttach: function(ml) called before a launcher is used
+        @param getIdLimit: function() returning the number of ids available
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.findTransports = findTransports
+        self.onAttach = onAttach
+        self.getIdLimit = getIdLimit
+        self.scheduler = scheduler
+        self.source = source
+        self._lock = Lock()
+        self._ids = {}              # location: id
+        self._launchers = {}        # id: MissileLauncher
+        self._pending = {}          # location: [next attempt, attempts left]
+        self._configLogs()
+
+    def _configLogs(self):
+        """
+        This method configure the logs for this object. 
+        """
+        self.log = asyncLog.getLogger('DeviceRegistry')
+
+    def enumerate(self):
+        """
+        This method register the launchers plugged and return the count attached
+        """
+        transports = sorted(self.findTransports(), key=lambda t: self.getLocationKey(t.location))
+        return len(filter(None, [self.attach(transport) for transport in transports]))
+
+    @staticmethod
+    def getLocationKey(location):
+        """
+        Return the sort key of a location: its numbers compared as numbers (bus:port[.port...], sim:N)
+        """
+        return [int(part) if part.isdigit() else part for part in re.split(r'[:.]', location)]
+
+    def _getFreeId(self):
+        """
+        Return the id of a new location or None if every id is attached
+        """
+        aIds = xrange(self.getIdLimit())
+        usedIds = set(self._ids.values())
+        aFreeIds = [i for i in aIds if i not in usedIds] + [i for i in aIds if i not in self._launchers]
+        if len(aFreeIds) > 0:
+            return aFreeIds[0]
+        return None
+
+    def attach(self, transport):
+        """
+        This method register a launcher plugged and return it, or None if no id is left
+        """
+        ml = None
+        with self._lock:
+            if transport.location not in self._ids:
+                mlId = self._getFreeId()
+                if mlId is not None:
+                    # The id of an unplugged launcher now belongs to this location
+                    for location in [l for (l, i) in self._ids.items() if i == mlId]:
+                        del self._ids[location]
+                    self._ids[transport.location] = mlId
+            if transport.location in self._ids:
+                ml = MissileLauncher(transport, self._ids[transport.location])
+                self.onAttach(ml)
+                self.scheduler.addLauncher(ml)
+                self._launchers[ml.id] = ml
+        if ml is None:
+            transport.close()
+            self.log.warning('Launcher at ' + transport.location + ' ignored: the ' + \
+                             str(self.getIdLimit()) + ' ids are attached')
+            return None
+        self.log.info('Launcher #' + str(ml.id) + ' attached (' + transport.location + ')')
+        return ml
+
+    def detach(self, location):
+        with self._lock:
+            self._pending.pop(location, None)
+            ml = self._launchers.pop(self._ids.get(location), None)
+        if ml is None:
+            return
+        self.scheduler.removeLauncher(ml)
+        ml.transport.close()
+        self.log.info('Launcher #' + str(ml.id) + ' detached (' + location + ')')
+
+    def getLaunchers(self):
+        with self._lock:
+            return [self._launchers[mlId] for mlId in sorted(self._launchers)]
+
+    def getIds(self):
+        """
+        Return {id: location} of every launcher seen, plugged or not
+        """
+        with self._lock:
+            return dict([(mlId, location) for (location, mlId) in self._ids.iteritems()])
+
+    def isAttached(self, mlId):
+        with self._lock:
+            return mlId in self._launchers
+
+    def _tryAttach(self, location, now):
+        try:
+            transports = self.findTransports(location)
+        except Exception, e:
+            self.log.debug('Could not open launcher at ' + location + ': ' + str(e))
+            transports = []
+        if transports:
+            del self._pending[location]
+            self.attach(transports[0])
+            return
+        self._pending[location][1] -= 1
+        if self._pending[location][1] == 0:
+            del self._pending[location]
+            self.log.error('Could not open the launcher plugged at ' + location)
+        else:
+            self._pending[location][0] = now + self.attachDelay
+
+    def _handleEvent(self, action, location, now):
+        if action == 'remove':
+            self.detach(location)
+        elif action == 'add':
+            # A launcher plugged again without a remove event is replaced
+            self.detach(location)
+            self._pending[location] = [now, self.attachRetries]
+
+    def run(self):
+        while True:
+            now = time.time()
+            for location in [l for (l, p) in self._pending.items() if p[0] <= now]:
+                self._tryAttach(location, now)
+            timeout = None
+            if self._pending:
+                timeout = max(0, min([p[0] for p in self._pending.values()]) - time.time())
+            readable = select.select([self.source], [], [], timeout)[0]
+            if readable:
+                for (action, location) in self.source.readEvents():
+                    self._handleEvent(action, location, time.time())
 
 class MissilesController():
     """
@@ -168,123 +1047,268 @@ class MissilesController():
     ID_VENDOR = 0x2123
     ID_PRODUCT = 0x1010
     TIME_WAIT_DELAY = 3    # in seconds
-
-    _mlList = []
-    _nextId = 0
-    enabledML = set()
+    transportBackend = 'pyusb'      # 'pyusb', 'libusb-async' or 'sim'
+    simulatedCount = 3              # number of launchers of the 'sim' backend
+    hotplugFifo = None              # FIFO path of the 'sim' hotplug events (see PipeHotplugSource)
+    metricsFile = 'logs/metrics-%(pid)d.prom'  # latency histograms, one file per process (see latencyStats.py)
+    metricsInterval = 30            # in seconds
+    traceFile = 'logs/missile2k13.trace'    # spans of the fires (see spanTrace.py)
 
     def __init__(self, info_callback, warning_callback, error_callback):
         self.print_info = info_callback
         self.print_warning = warning_callback
         self.print_error = error_callback
+        # Ids of the launchers the commands act on: the set of the shell
+        # running a command in this thread (see MissileShell.processCmd())
+        self._session = local()
+        # One salvo at a time: the sensor can't tell which salvo crashed a building
+        self._fireLock = Lock()
         self._configLogs()
+        self.scheduler = LauncherScheduler()
+        self.scheduler.start()
+        self.registry = DeviceRegistry(self._findTransports, self._onAttach, self._getLauncherLimit, self.scheduler)
+        latencyStats.startDumper(self.metricsFile, self.metricsInterval)
+        spanTrace.configure(self.traceFile, monotonicNs, getBootId())
+        # Do not leave a launcher moving when the shell exits
+        atexit.register(self.scheduler.waitIdle)
 
     def _configLogs(self):
         """
         This method configure the logs for this object. 
         """
-        logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        dateTimeFormat = '%Y-%m-%d %H:%M:%S'
-        logFile = 'missile2k13.log'
-        logDir = 'logs'
-
-        fh = TimedRotatingFileHandler(os.path.join(logDir,logFile), \
-                                      backupCount=0, \
-                                      when='d', \
-                                      interval=1)
-        fh.setFormatter(logging.Formatter(logFormat, dateTimeFormat))
-
-        self.log = logging.getLogger('MissileController')
-        self.log.addHandler(fh)
-        self.log.setLevel(logging.DEBUG)
-
-    def _getDevice(self,no):
-        devs = usb.core.find(find_all=True,idVendor=self.ID_VENDOR, idProduct=self.ID_PRODUCT)
-        dev = None
-        no = int(no)
-        if len(devs) >= no + 1:
-            dev = devs[no]
-        else:
-            self.print_warning('Launcher not found.')
-        return dev
-
-    def registerDevice(self,dev):
-        if dev:
-            oML = MissileLauncher(dev, self._nextId)
-            oML.start()
-            self._mlList.append(oML)
-            self._nextId = self._nextId + 1
-        else:
-            self.print_error('Failed to register device')
+        self.log = asyncLog.getLogger('MissileController')
+
+    def _onAttach(self, ml):
+        ml.pose.setProfile(DBController.getInstance().getProfile(ml.transport.location))
+
+    def _getLauncherLimit(self):
+        return len(DBController.getInstance().getDB()['remainingMissiles'])
+
+    def _findTransports(self, location=None):
+        if self.transportBackend == 'sim':
+            if location is not None:
+                return [SimulatedTransport.create(location)]
+            return SimulatedTransport.find(self.simulatedCount)
+        if self.transportBackend == 'libusb-async':
+            return LibUSBAsyncTransport.find(self.ID_VENDOR, self.ID_PRODUCT, location)
+        return PyUSBTransport.find(self.ID_VENDOR, self.ID_PRODUCT, location)
+
+    def _getHotplugSource(self):
+        if self.transportBackend == 'sim':
+            return PipeHotplugSource(self.hotplugFifo)
+        try:
+            return NetlinkHotplugSource(self.ID_VENDOR, self.ID_PRODUCT)
+        except (socket.error, AttributeError), e:
+            self.log.warning('Hotplug monitoring is not available: ' + str(e))
+            return None
 
     def registerDevices(self):
-        devs = usb.core.find(find_all=True,idVendor=self.ID_VENDOR, idProduct=self.ID_PRODUCT)
-        for dev in devs:
-            self.registerDevice(dev)
-        self.print_info('%s device(s) are detected' % str(len(devs)))
+        """
+        Enumerate the launchers once and follow their hotplug events
+        """
+        count = self.registry.enumerate()
+        self.print_info('%s device(s) are detected' % str(count))
+        if not self.registry.isAlive():
+            self.registry.source = self._getHotplugSource()
+            if self.registry.source is not None:
+                self.registry.start()
+
+    def setEnabledSet(self, enabledML):
+        """
+        This method set the ids the commands of the calling thread act on
+        """
+        self._session.enabledML = enabledML
+
+    def getEnabledSet(self):
+        if not hasattr(self._session, 'enabledML'):
+            self._session.enabledML = set()
+        return self._session.enabledML
 
     def enable(self, mlId):
-        self.enabledML.add(int(mlId))
+        self.getEnabledSet().add(int(mlId))
         self.print_info('Enabled missile #' + str(mlId))
         self.log.info('Enabled missile #' + str(mlId))
     
     def disable(self, mlId):
         iMlId = int(mlId)
-        if iMlId in self.enabledML:
-            self.enabledML.remove(iMlId)
+        if iMlId in self.getEnabledSet():
+            self.getEnabledSet().remove(iMlId)
             self.print_info('Disabled missile #' + str(mlId))
             self.log.info('Disabled missile #' + str(mlId))
 
+    def getEnabledList(self):
+        return [ml for ml in self.registry.getLaunchers() if ml.id in self.getEnabledSet()]
+
+    def _execute(self, plans):
+        """
+        Run the plans on the scheduler and report the device errors
+        """
+        self._reportErrors(self.scheduler.execute(plans))
+
+    def _reportErrors(self, errors):
+        for error in errors + self.scheduler.popErrors():
+            self.print_error(error)
+            self.log.error(error)
+
+    def _move(self, cmd, duration):
+        """
+        Queue a move on the enabled launchers and return without waiting. Every 
+        launcher turns by the same angle, the one a nominal launcher turns in duration.
+        @param duration: Move duration in miliseconds
+        """
+        for ml in self.getEnabledList():
+            self.scheduler.enqueueMove(ml, cmd, ml.pose.getMoveTime(cmd, duration/1000.0))
+        self._reportErrors([])
+
     def up(self, duration):
-        for ml in self._mlList:
-            if ml.id in self.enabledML:
-                ml.up(duration)
+        self._move(MissileLauncher.CMD_UP, duration)
 
     def down(self, duration):
-        for ml in self._mlList:
-            if ml.id in self.enabledML:
-                ml.down(duration)
+        self._move(MissileLauncher.CMD_DOWN, duration)
 
     def left(self, duration):
-        for ml in self._mlList:
-            if ml.id in self.enabledML:
-                ml.left(duration)
+        self._move(MissileLauncher.CMD_LEFT, duration)
 
     def right(self, duration):
-        for ml in self._mlList:
-            if ml.id in self.enabledML:
-                ml.right(duration)
+        self._move(MissileLauncher.CMD_RIGHT, duration)
 
     def fire(self):
-        if self.isReady():
-            hasFired = False
-            for ml in self._mlList:
-                mlShotLeft = DBController.getInstance().getDB()['remainingMissiles'][ml.id]
-                if ml.id in self.enabledML and mlShotLeft > 0:
-                    self.print_info('Firing #' + str(ml.id))
-                    ml.fire()
+        """
+        Fire a salvo: every enabled launcher with missiles left fires at the 
+        same time and the crashes are analyzed once for the whole salvo.
+        The sensor can't tell which missile hit, so the crashes are recorded
+        once, with the launch of the first launcher of the salvo, and the
+        other launches of the salvo record no crash.
+        The salvo is traced, see spanTrace.py.
+        """
+        with self._fireLock:
+            spanTrace.tracer.startTrace('fire session=' + getSourceIP())
+            self.log.info('Fire trace: ' + str(spanTrace.tracer.getTraceId()))
+            try:
+                self._fire()
+            finally:
+                spanTrace.tracer.endTrace()
+
+    def _fire(self):
+        with spanTrace.span('ready'):
+            bReady = self.isReady()
+        if bReady:
+            aML = [ml for ml in self.getEnabledList() if self._getRemainingMissiles(ml.id) > 0]
+            if len(aML) > 0:
+                self.print_info('Firing #' + ', #'.join([str(ml.id) for ml in aML]))
+                oSub = self._subscribeCrashes()
+                with spanTrace.span('launch'):
+                    self._execute(dict([(ml, ml.getFirePlan()) for ml in aML]))
     
-                    self.print_info('Analyzing crashes...')
+                self.print_info('Analyzing crashes...')
+                if oSub is not None:
+                    # Return as soon as the sensor reports a crash
+                    deadline = time.time() + MissileLauncher.FIRE_DURATION + CrashDetector.waitForTimeValue
+                    with spanTrace.span('crash.wait'):
+                        aResult = oSub.waitForCrashes(deadline)
+                    oSub.close()
+                else:
+                    with spanTrace.span('fire.sleep'):
+                        time.sleep(MissileLauncher.FIRE_DURATION)
                     oCD = CrashDetector()
                     aResult = oCD.getCrashedBuildings()
                     del oCD
                     oCD = None
-                    if len(aResult) > 0:
+                if len(aResult) > 0:
+                    with spanTrace.span('flags.print'):
                         self.printFlags(aResult)
-                        self.logCrash(aResult)
-                    else:
-                        self.print_warning('No crash was detected')
+                    self.logCrash(aResult)
+                else:
+                    self.print_warning('No crash was detected')
         
-                    DBController.getInstance().launchMissile(ml.id, aResult)
+                for (i, ml) in enumerate(aML):
+                    DBController.getInstance().launchMissile(ml.id, aResult if i == 0 else set())
             else:
                     self.print_warning('No missile was launched. Ensure that you have enabled missiles launchers and that there are remaining missiles.')
         else:
             self.print_warning('Missile Launchers not ready. Time left before next launch: ' + str(timedelta(seconds=self.getTimeLeftBeforeReady())))
 
+    def _getRemainingMissiles(self, mlId):
+        """
+        Return the missiles left of a launcher, 0 if the DB has none for its id
+        """
+        try:
+            return DBController.getInstance().getDB()['remainingMissiles'][mlId]
+        except IndexError:
+            self.log.warning('No missile count in the DB for launcher #' + str(mlId))
+            return 0
+
+    def _subscribeCrashes(self):
+        """
+        Subscribe to the sensor events. Return None if buildingSensor.py can't be reached.
+        """
+        try:
+            with spanTrace.span('crash.subscribe'):
+                return CrashSubscriber(CrashSubscriber.socketFile)
+        except socket.error, e:
+            self.log.warning('Crash notifications unavailable (' + str(e) + '), falling back to CrashDetector')
+            return None
+
     def reset(self):
-        for ml in self._mlList:
-            if ml.id in self.enabledML:
-                ml.reset()
+        self._execute(dict([(ml, ml.getResetPlan()) for ml in self.getEnabledList()]))
+
+    def calibrate(self):
+        """
+        Calibrate the enabled launchers together and save their profiles. 
+        The measured launchers are reset afterward. The launchers that can't 
+        report their position are left untouched with their current profile.
+        """
+        oDB = DBController.getInstance()
+        aCal = []
+        for ml in self.getEnabledList():
+            if not hasattr(ml.transport, 'getPosition'):
+                self.print_warning('Launcher #' + str(ml.id) + ' can not report its position, calibration skipped')
+                continue
+            self.print_info('Calibrating launcher #' + str(ml.id) + ' (' + ml.transport.location + ')...')
+            aCal.append(LauncherCalibration(self.scheduler, ml))
+        if len(aCal) == 0:
+            self.print_error('No launcher was calibrated')
+            return
+        # Each calibration waits for its own plans, the scheduler runs them concurrently
+        aThreads = [Thread(target=oCal.run) for oCal in aCal]
+        for t in aThreads:
+            t.start()
+        for t in aThreads:
+            t.join()
+        for oCal in aCal:
+            ml, profile = oCal.ml, oCal.profile
+            self._reportErrors(oCal.errors)
+            if profile is None:
+                self.print_error('Calibration of launcher #' + str(ml.id) + ' failed')
+                continue
+            ml.pose.setProfile(profile)
+            oDB.saveProfile(ml.transport.location, profile)
+            self.print_info('Launcher #%d: pan %.1f deg/s, tilt %.1f deg/s, spin-up %.0f ms' % \
+                            (ml.id, profile['panSpeed'], profile['tiltSpeed'], profile['spinUp'] * 1000))
+            self.log.info('Calibrated launcher #%d (%s): %s' % (ml.id, ml.transport.location, str(profile)))
+        # The measures left the launchers anywhere
+        self._execute(dict([(oCal.ml, oCal.ml.getResetPlan()) for oCal in aCal]))
+
+    def _getPositionedList(self):
+        aML = []
+        for ml in self.getEnabledList():
+            if ml.pose.known:
+                aML.append(ml)
+            else:
+                self.print_warning('Position of launcher #' + str(ml.id) + ' is unknown, run "reset" first')
+        return aML
+
+    def goto(self, pan, tilt):
+        """
+        Point the enabled launchers at (pan, tilt) degrees
+        """
+        self._execute(dict([(ml, lambda ml=ml: ml.getGotoPlan(pan, tilt)) for ml in self._getPositionedList()]))
+
+    def aim(self, x, y, z):
+        """
+        Point the enabled launchers at (x, y, z)
+        """
+        self._execute(dict([(ml, lambda ml=ml: ml.aim(x, y, z)) for ml in self._getPositionedList()]))
 
     def getList(self):
         pass
@@ -292,15 +1316,41 @@ class MissilesController():
     def getPrintableList(self):
         result = "\n"
         result += "* Missiles Launchers informations * \n"
-        for ml in self._mlList:
+        aML = dict([(ml.id, ml) for ml in self.registry.getLaunchers()])
+        for (mlId, location) in sorted(self.registry.getIds().items()):
+            if mlId not in aML:
+                result += '    id: ' + str(mlId) + "\n"
+                result += '    location: ' + location + ' (unplugged)' + "\n"
+                result += '    enabled: ' + str(mlId in self.getEnabledSet()) + "\n"
+                result += "\n"
+                continue
+            ml = aML[mlId]
             result += '    id: ' + str(ml.id) + "\n"
-            result += '    thread.isAlive(): ' + str(ml.isAlive()) + "\n"
-            result += '    enabled: ' + str(ml.id in self.enabledML) + "\n"
+            result += '    busy: ' + str(ml.isBusy()) + "\n"
+            result += '    location: ' + ml.transport.location + "\n"
+            if ml.pose.profile is not None:
+                result += '    profile: pan %.1f deg/s, tilt %.1f deg/s, spin-up %.0f ms' % \
+                          (ml.pose.profile['panSpeed'], ml.pose.profile['tiltSpeed'], ml.pose.profile['spinUp'] * 1000) + "\n"
+            else:
+                result += '    profile: nominal (not calibrated)' + "\n"
+            if ml.pose.known:
+                result += '    position (pan, tilt): %.1f, %.1f' % ml.pose.getPosition() + "\n"
+            else:
+                result += '    position (pan, tilt): unknown (run "reset")' + "\n"
+            result += '    USB transfers sent: ' + str(ml.queue.transfersSent) + \
+                      ' (saved by the command queue: ' + str(ml.queue.transfersSaved) + ")\n"
+            result += '    enabled: ' + str(ml.id in self.getEnabledSet()) + "\n"
             result += "\n"
         return result
 
     def getCount(self):
-        return len(self._mlList)
+        """
+        Return the number of launchers attached
+        """
+        return len(self.registry.getLaunchers())
+
+    def isAttached(self, mlId):
+        return self.registry.isAttached(mlId)
 
     def printFlags(self, aResult):
         oDB = DBController.getInstance()
@@ -315,7 +1365,7 @@ class MissilesController():
             oDB.setBuildingAsCrashed(buildId)
 
     def getTimeLeftBeforeReady(self):
-        launches = DBController.getInstance().getDB()['launches']
+        launches = DBController.getInstance().getLaunches(limit=1)
         if len(launches) > 0:
             timeLeft = self.TIME_WAIT_DELAY - (datetime.today() - launches[-1]['datetime']).seconds
             if timeLeft > 0:
@@ -360,12 +1410,13 @@ class MissileShell():
     MSG_HELP_UNDEFINED_COMMAND = 'That command is not defined.'
     MSG_TOP_OF_HELP = ''
     MSG_BOTTOM_OF_HELP = ''
-    DEFAULT_MOVE_DURATION = 0.02
+    DEFAULT_MOVE_DURATION = 100    # miliseconds
+    SHOW_LAUNCHES = 10             # launches printed by show
     MAX_MOVE_DURATION = 3000    # miliseconds
 
     _cmds = {}
     """ 
-    @ivar: This hash table contains the list of commands the console can handle in main mode
+    @ivar: This hash table contains the list of commands the console can handle in main mode, built once with the class
     @type: hashtable
     """
 
@@ -375,45 +1426,39 @@ class MissileShell():
     @type: hashtable
     """
 
-    def __init__(self, info_callback, warning_callback, error_callback):
+    def __init__(self, info_callback, warning_callback, error_callback, oMC=None):
+        """
+        @param oMC: MissilesController shared by the sessions of the control server, by default
+                    the shell creates its own and registers the devices
+        """
         self.print_info = info_callback 
         self.print_warning = warning_callback
         self.print_error = error_callback
         self._configLogs()
+        # Launchers enabled by this session, the controller may be shared by other sessions
+        self.enabledML = set()
 
-        self.oMC = MissilesController(info_callback, warning_callback, error_callback) 
-        self.oMC.registerDevices()
-
-        for name, value in inspect.getmembers(self):
-            if inspect.ismethod(value) and getattr(value, '_console_cmd', False):
-                name = getattr(value, '_console_cmd_name')
-                self._cmds[name] = value
+        if oMC is None:
+            oMC = MissilesController(info_callback, warning_callback, error_callback) 
+            startupProfile.mark('controller started')
+            oMC.registerDevices()
+            startupProfile.mark('devices registered')
+        self.oMC = oMC
 
-        # Setup secure modules array
-        self._secureMods = copy.deepcopy(DBController.getInstance().getDB()['secureMods'])
+        # Setup secure modules array (a copy: the modules are locked again every login)
+        oDB = DBController.getInstance()
+        self._secureMods = dict([(name, dict(mod)) for (name, mod) in oDB.getDB()['secureMods'].iteritems()])
 
         # Print a flag
-        flag = DBController.getInstance().getDB()['loginFlag']
+        flag = oDB.getDB()['loginFlag']
+        startupProfile.mark('DB read')
         self.print_info("Great job, you've reached a powerful interface but it's not over. Flag: " + str(flag))
 
     def _configLogs(self):
         """
         This method configure the logs for this object. 
         """
-        logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        dateTimeFormat = '%Y-%m-%d %H:%M:%S'
-        logFile = 'missile2k13.log'
-        logDir = 'logs'
-
-        fh = TimedRotatingFileHandler(os.path.join(logDir,logFile), \
-                                      backupCount=0, \
-                                      when='d', \
-                                      interval=1)
-        fh.setFormatter(logging.Formatter(logFormat, dateTimeFormat))
-
-        self.log = logging.getLogger('MissileShell')
-        self.log.addHandler(fh)
-        self.log.setLevel(logging.DEBUG)
+        self.log = asyncLog.getLogger('MissileShell')
 
     def __del__(self):
         pass
@@ -429,7 +1474,10 @@ class MissileShell():
             cmd, args = text, ''
 
         if self._cmds.has_key(cmd):
-            return self._cmds[cmd](cmd, args)
+            # The sessions of the control server run their commands at the same time
+            self.oMC.setEnabledSet(self.enabledML)
+            with latencyStats.timer('cmd.' + cmd):
+                return self._cmds[cmd](self, cmd, args)
 
     def getUserInformations(self):
         """
@@ -445,12 +1493,15 @@ class MissileShell():
         """
         Print general informations
         """
+        oDB = DBController.getInstance()
+        counters = oDB.getCounters()
         result = "* General Informations *\n"
-        result += "    Missiles left: " + str(sum(DBController.getInstance().getDB()['remainingMissiles'])) + "\n"
-        result += "    Number of launches: " + str(len(DBController.getInstance().getDB()['launches'])) + "\n"
+        result += "    Missiles left: " + str(counters['missilesLeft']) + "\n"
+        result += "    Number of launches: " + str(counters['launches']) + "\n"
+        result += "    Buildings crashed: " + str(counters['buildingsCrashed']) + "\n"
         result += "    Current datetime: " + str(datetime.today()) + "\n"
         result += "    Time left before ready: " + str(timedelta(seconds=self.oMC.getTimeLeftBeforeReady())) + "\n"
-        result += "    Light is on?: " + str(DBController.getInstance().getDB()['lightStatus']) + "\n"
+        result += "    Light is on?: " + str(oDB.getDB()['lightStatus']) + "\n"
         return result
 
     def getSecureModsInformations(self):
@@ -466,19 +1517,42 @@ class MissileShell():
             result += "\n"
         return result
 
-    def getLaunchLogs(self):
+    def getLaunchLogs(self, since=None, limit=SHOW_LAUNCHES):
         """
-        Print launch logs
+        Print a page of the launch logs: the first limit launches since a datetime or the last limit ones
         """
-        result = "* Launch Logs *\n"
-        launches = DBController.getInstance().getDB()['launches']
+        oDB = DBController.getInstance()
+        launches = oDB.getLaunches(since, limit)
+        total = oDB.getCounters()['launches']
+        aLines = ["* Launch Logs *"]
         for l in launches:
-            result += '    Missile Launcher ID: ' + str(l['mlId']) + "\n"
-            result += '    Source: ' + str(l['source']) + "\n"
-            result += '    Date: ' + str(l['datetime']) + "\n"
-            result += '    Crashed Buildings: ' + str(l['cb']) + "\n"
-            result += "\n"
-        return result
+            aLines.append('    Missile Launcher ID: ' + str(l['mlId']))
+            aLines.append('    Source: ' + str(l['source']))
+            aLines.append('    Date: ' + str(l['datetime']))
+            aLines.append('    Crashed Buildings: ' + str(l['cb']))
+            aLines.append('')
+        if len(launches) < total:
+            aLines.append('    (' + str(len(launches)) + ' of ' + str(total) + ' launches, see help show)')
+            aLines.append('')
+        return "\n".join(aLines) + "\n"
+
+    @staticmethod
+    def parseTime(text):
+        """
+        Return the datetime of YYYY-MM-DD[THH:MM[:SS]] or HH:MM[:SS] (today), None if invalid
+        """
+        for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+            try:
+                return datetime.strptime(text, fmt)
+            except ValueError:
+                pass
+        for fmt in ('%H:%M:%S', '%H:%M'):
+            try:
+                t = datetime.strptime(text, fmt)
+            except ValueError:
+                continue
+            return datetime.combine(datetime.today().date(), t.time())
+        return None
 
     @shellcmd(name='help')
     def _help(self, cmd, args):
@@ -516,7 +1590,7 @@ class MissileShell():
             for mlId in aIds:
                 try:
                     iMlId = int(mlId)
-                    if iMlId >= 0 and iMlId < self.oMC.getCount():
+                    if self.oMC.isAttached(iMlId):
                         self.oMC.enable(iMlId)
                         result += 'Missile Launcher #' + str(iMlId) + ' has been enabled' + "\n"
                 except ValueError:
@@ -537,7 +1611,7 @@ class MissileShell():
             for mlId in aIds:
                 try:
                     iMlId = int(mlId)
-                    if iMlId >= 0 and iMlId < self.oMC.getCount():
+                    if self.oMC.isAttached(iMlId) or iMlId in self.enabledML:
                         self.oMC.disable(iMlId)
                         result += 'Missile Launcher #' + str(iMlId) + ' has been disabled' + "\n"
                 except ValueError:
@@ -599,15 +1673,53 @@ class MissileShell():
     @shellcmd(name='show')
     def _show(self, cmd, args):
         '''
-        Display informations
-        Usage: show
+        Display informations (with the last launches only)
+        Usage: show [summary | launches [--since YYYY-MM-DD[THH:MM[:SS]] | HH:MM[:SS]] [--limit N]]
+        '''
+        aArgs = args.split()
+        if len(aArgs) == 0:
+            return "\n" + \
+                   self.getUserInformations() + \
+                   self.getGeneralInformations() + \
+                   self.oMC.getPrintableList() + \
+                   self.getSecureModsInformations() + \
+                   self.getLaunchLogs()
+        if aArgs == ['summary']:
+            return "\n" + \
+                   self.getUserInformations() + \
+                   self.getGeneralInformations()
+        if aArgs[0] == 'launches' and len(aArgs) % 2 == 1:
+            since = None
+            limit = self.SHOW_LAUNCHES
+            for (opt, value) in zip(aArgs[1::2], aArgs[2::2]):
+                if opt == '--since':
+                    since = self.parseTime(value)
+                    if since is None:
+                        return 'Invalid datetime'
+                elif opt == '--limit':
+                    try:
+                        limit = int(value)
+                    except ValueError:
+                        return 'Invalid value'
+                    if limit <= 0:
+                        return 'Invalid value'
+                else:
+                    return 'Invalid argument: ' + opt
+            return "\n" + self.getLaunchLogs(since, limit)
+        return 'Invalid arguments'
+
+    @shellcmd(name='stats')
+    def _stats(self, cmd, args):
         '''
-        return "\n" + \
-               self.getUserInformations() + \
-               self.getGeneralInformations() + \
-               self.oMC.getPrintableList() + \
-               self.getSecureModsInformations() + \
-               self.getLaunchLogs()
+        Display the latency of the commands (cmd.*), USB transfers (usb.*) and DB operations (db.*) in miliseconds
+        Usage: stats [PREFIX | reset]
+        '''
+        if args.strip() == 'reset':
+            latencyStats.registry.reset()
+            return 'Statistics cleared'
+        since = datetime.fromtimestamp(latencyStats.registry.since).strftime('%Y-%m-%d %H:%M:%S')
+        return "\nLatency since " + since + " (bucket upper bounds for the percentiles):\n" + \
+               "\n".join(latencyStats.registry.report(args.strip()))
 
 #    @shellcmd(name='register_all')
 #    def _registerAll(self, cmd, args):
@@ -621,7 +1733,7 @@ class MissileShell():
     def _moveLeft(self, cmd, args):
         '''
         Move left selected ML
-        Usage: ml [duration (miliseconds)]
+        Usage: ml [duration (miliseconds at the nominal speed, see calibrate)]
         '''
         if args != '' and float(args) > 0 and float(args) < self.MAX_MOVE_DURATION:
             duration = float(args)
@@ -635,7 +1747,7 @@ class MissileShell():
     def _moveRight(self, cmd, args):
         '''
         Move right selected ML
-        Usage: mr [duration (miliseconds)]
+        Usage: mr [duration (miliseconds at the nominal speed, see calibrate)]
         '''
         if args != '' and float(args) > 0 and float(args) < self.MAX_MOVE_DURATION:
             duration = float(args)
@@ -649,7 +1761,7 @@ class MissileShell():
     def _moveUp(self, cmd, args):
         '''
         Move up selected ML
-        Usage: mu [duration (miliseconds)]
+        Usage: mu [duration (miliseconds at the nominal speed, see calibrate)]
         '''
         if args != '' and float(args) > 0 and float(args) < self.MAX_MOVE_DURATION:
             duration = float(args)
@@ -663,7 +1775,7 @@ class MissileShell():
     def _moveDown(self, cmd, args):
         '''
         Move down selected ML
-        Usage: md [duration (miliseconds)]
+        Usage: md [duration (miliseconds at the nominal speed, see calibrate)]
         '''
         if args != '' and float(args) > 0 and float(args) < self.MAX_MOVE_DURATION:
             duration = float(args)
@@ -673,6 +1785,40 @@ class MissileShell():
         result = ''
         return result
 
+    @shellcmd(name='reset')
+    def _reset(self, cmd, args):
+        '''
+        Drive selected ML to the reset position (right/down limits), their position is known afterward
+        Usage: reset
+        '''
+        self.oMC.reset()
+        return ''
+
+    @shellcmd(name='calibrate')
+    def _calibrate(self, cmd, args):
+        '''
+        Measure the speeds of selected ML and save them for their USB port. The measured ML are reset afterward.
+        Usage: calibrate
+        '''
+        self.oMC.calibrate()
+        return ''
+
+    @shellcmd(name='goto')
+    def _goto(self, cmd, args):
+        '''
+        Point selected ML at an absolute position (run "reset" once first)
+        Usage: goto PAN TILT (degrees, pan grows to the left and tilt grows up from the reset position)
+        '''
+        aArgs = args.split()
+        if len(aArgs) != 2:
+            return 'Invalid number of arguments'
+        try:
+            pan, tilt = float(aArgs[0]), float(aArgs[1])
+        except ValueError:
+            return 'Invalid value'
+        self.oMC.goto(pan, tilt)
+        return ''
+
     @shellcmd(name='fire')
     def _fire(self, cmd, args):
         '''
@@ -687,17 +1833,194 @@ class MissileShell():
             result = ''
         return result
 
+# Command table of the shell, built once instead of inspecting every shell
+MissileShell._cmds = dict([(func._console_cmd_name, func) for func in MissileShell.__dict__.values() \
+                          if getattr(func, '_console_cmd', False)])
+
+class CrashSubscriber():
+    """
+    Subscription to the crash events published by buildingSensor.py
+    (see CrashPublisher in crashJournal.py). Subscribe before firing so no
+    event is missed.
+    """
+    socketFile = ROOT_DIR + '/logs/buildingSensor.sock'
+    RECORD = crashJournal.RECORD
+    settleTime = 0.3     # in seconds, collect the other buildings falling at the same time
+
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except socket.error:
+            self._sock.close()
+            raise
+        self._buffer = ''
+
+    def waitForCrashes(self, deadline):
+        """
+        This method wait for crash events until deadline (time.time() value).
+        Return the crashed building indexes as soon as one is seen (empty set if none).
+        """
+        aResult = set()
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            if not select.select([self._sock], [], [], timeout)[0]:
+                break
+            data = self._sock.recv(4096)
+            if not data:
+                break
+            self._buffer += data
+            while len(self._buffer) >= self.RECORD.size:
+                ts, chan, buildId, kind, arg = self.RECORD.unpack_from(self._buffer)
+                self._buffer = self._buffer[self.RECORD.size:]
+                if kind != crashJournal.EVENT_CRASH:
+                    # Traced when the pin went low
+                    spanTrace.event('sensor.end building=%d chan=%d' % (buildId, chan), ts - arg * 1000000)
+                    continue
+                spanTrace.event('sensor.crash building=%d chan=%d' % (buildId, chan), ts)
+                aResult.add(buildId - 1)
+            if aResult:
+                deadline = min(deadline, time.time() + self.settleTime)
+        return aResult
+
+    def close(self):
+        self._sock.close()
+
+class LogCursor():
+    """
+    Incremental reader of the recent entries of a log written by a
+    TimedRotatingFileHandler.
+
+    The file is read backwards from EOF and the scan stops as soon as an
+    entry is older than the requested window or when it reaches the offset
+    where the previous call stopped. The entries still inside the window are
+    cached, so a call costs O(recent entries) instead of O(file size).
+    The inode is remembered to detect the daily rotation: the rest of the
+    rotated file is read before starting over on the new one.
+    """
+    blockSize = 4096
+
+    def __init__(self, path, dateTimeFormat):
+        self.path = path
+        self.dateTimeFormat = dateTimeFormat
+        self._inode = None
+        self._offset = 0
+        self._entries = []
+
+    def getEntriesSince(self, since):
+        """
+        This method return the entries logged at or after since, in chronological order.
+        Entries are dicts: {'datetime': str, 'source': str, 'type': str, 'text': str}
+        @param since: Oldest datetime to return
+        @type since: datetime
+        """
+        entries = [e for e in self._entries if e[0] >= since]
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._entries = entries
+            return [e[1] for e in entries]
+
+        if self._inode is not None and st.st_ino != self._inode:
+            rotated = self._findRotatedFile()
+            if rotated is not None:
+                entries += self._scanFile(rotated, self._offset, since)[0]
+            self._offset = 0
+        elif st.st_size < self._offset:
+            # Truncated (ex: initDB.py)
+            entries = []
+            self._offset = 0
+        self._inode = st.st_ino
+
+        newEntries, self._offset = self._scanFile(self.path, self._offset, since)
+        self._entries = entries + newEntries
+        return [e[1] for e in self._entries]
+
+    def _findRotatedFile(self):
+        """
+        This method return the path of the rotated log that still has the last known inode
+        """
+        d = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path) + '.'
+        for name in os.listdir(d):
+            if name.startswith(prefix):
+                path = os.path.join(d, name)
+                if os.stat(path).st_ino == self._inode:
+                    return path
+        return None
+
+    def _scanFile(self, path, start, since):
+        """
+        This method return (entries, offset): the entries found after the start offset 
+        that are newer than since and the offset following the last complete line.
+        """
+        f = open(path, 'rb')
+        try:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            entries = []
+            offset = None
+            for line in self._readLinesBackward(f, start, end):
+                if offset is None:
+                    # Whatever follows the last newline is still being written
+                    offset = end - len(line)
+                    continue
+                entry = self._parse(line)
+                if entry is None:
+                    continue
+                if entry[0] < since:
+                    break
+                entries.append(entry)
+        finally:
+            f.close()
+        entries.reverse()
+        if offset is None:
+            offset = start
+        return entries, offset
+
+    def _readLinesBackward(self, f, start, end):
+        """
+        Yield the lines between the start and end offsets, last one first
+        """
+        pos = end
+        tail = ''
+        while pos > start:
+            size = min(self.blockSize, pos - start)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + tail).split('\n')
+            tail = lines.pop(0)
+            for l in reversed(lines):
+                yield l
+        yield tail
+
+    def _parse(self, line):
+        entry = line.split(' - ', 3)
+        if len(entry) < 4:
+            return None
+        try:
+            dt = datetime.strptime(entry[0], self.dateTimeFormat)
+        except ValueError:
+            return None
+        return (dt, {'datetime': entry[0], 'source': entry[1], 'type': entry[2], 'text': entry[3]})
+
 class CrashDetector():
-    bsLogFile = '/root/logs/buildingSensor.log'
+    bsLogFile = ROOT_DIR + '/logs/buildingSensor.log'
+    bsJournalFile = ROOT_DIR + '/logs/buildingSensor.journal'
     bsLogDateTimeFormat = '%Y-%m-%d %H:%M:%S'
     events = []
     curDateTime = None
+    curTimestamp = None
     waitForTimeValue = 2
     recentTimeValue = 10
     #recentTimeValue = 60
+    _logCursor = None       # Shared by every detector so the log is never read twice
 
     def __init__(self):
         self.curDateTime = datetime.now()
+        self.curTimestamp = monotonicNs()
         self._configLogs()
         self.events = []
 
@@ -705,40 +2028,45 @@ class CrashDetector():
         """
         This method configure the logs for this object. 
         """
-        logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        dateTimeFormat = '%Y-%m-%d %H:%M:%S'
-        logFile = 'missile2k13.log'
-        logDir = 'logs'
-
-        fh = TimedRotatingFileHandler(os.path.join(logDir,logFile), \
-                                      backupCount=0, \
-                                      when='d', \
-                                      interval=1)
-        fh.setFormatter(logging.Formatter(logFormat, dateTimeFormat))
-
-        self.log = logging.getLogger('CrashDetector')
-        self.log.addHandler(fh)
-        self.log.setLevel(logging.DEBUG)
+        self.log = asyncLog.getLogger('CrashDetector')
 
     def _importRecentCrashEvents(self):
-        f = open(self.bsLogFile, 'r')
-        for l in f:
-            entry = l.split(' - ', 4)
-            if len(entry) > 3 and\
-               self._eventIsRecent(entry[0]) and\
-               entry[3].startswith('Building'):
-                self.events.append({'datetime': entry[0], 'source': entry[1], 'type': entry[2], 'text': entry[3]})
-        f.close()
-
-    def _eventIsRecent(self, sTime):
-       #self.log.debug('eventIsRecent: ' + str(self.recentTimeValue - (datetime.strptime(sTime, self.bsLogDateTimeFormat) - self.curDateTime).seconds))
-       return self.recentTimeValue - (datetime.strptime(sTime, self.bsLogDateTimeFormat) - self.curDateTime).seconds >= 0 
+        """
+        Import the recent events from the sensor journal. The text log is only
+        parsed if the journal is missing (ex: older buildingSensor.py).
+        """
+        try:
+            oJournal = CrashJournalReader(self.bsJournalFile)
+        except IOError:
+            self.log.warning('No crash journal, parsing ' + self.bsLogFile)
+            self._importRecentLogEvents()
+            return
+        try:
+            since = self.curTimestamp - self.recentTimeValue * 1000000000
+            for (ts, chan, buildId, kind, arg) in oJournal.getEventsSince(since):
+                if kind != crashJournal.EVENT_CRASH:
+                    continue
+                spanTrace.event('sensor.crash building=%d chan=%d' % (buildId, chan), ts)
+                self.events.append({'timestamp': ts, 'source': 'BuildingSensor', 'type': 'INFO', \
+                                    'text': 'Building #' + str(buildId) + ' crashed'})
+        finally:
+            oJournal.close()
+
+    def _importRecentLogEvents(self):
+        if CrashDetector._logCursor is None:
+            CrashDetector._logCursor = LogCursor(self.bsLogFile, self.bsLogDateTimeFormat)
+        since = self.curDateTime - timedelta(seconds=self.recentTimeValue)
+        for entry in CrashDetector._logCursor.getEntriesSince(since):
+            if entry['text'].startswith('Building'):
+                self.events.append(entry)
 
     def getCrashedBuildings(self):
-        time.sleep(self.waitForTimeValue)
+        with spanTrace.span('crash.sleep'):
+            time.sleep(self.waitForTimeValue)
         aResult = set()
         self.log.info('Importing recent crash events')
-        self._importRecentCrashEvents()
+        with spanTrace.span('crash.parse'):
+            self._importRecentCrashEvents()
         self.log.info('Import done')
         for e in self.events:
             self.log.debug(str(e))
@@ -752,36 +2080,34 @@ class CrashDetector():
         self.events = None
         return aResult
 
-@Singleton
-class DBController():
-    #dbFile = '/root/missile2k13.shelve'
-    dbFile = 'missile2k13.shelve'
-    d = None
-
-    def __init__(self):
-        self._configLogs()
-        self.log.info('Opening shelve (' + str(self.dbFile) + ')')
-        self.d = shelve.open(self.dbFile, writeback=True)
-        self.log.debug(self.d)
+class ShelveStorage():
+    """
+    Storage engine keeping the whole game state in a shelve (dbm) file.
+    Kept for compatibility, a sync() pickles back every cached entry and
+    the file can't be shared safely between processes.
+    """
+    def __init__(self, path):
+        import shelve
+        self.d = shelve.open(path, writeback=True)
+        self.counters = None
 
-    def _configLogs(self):
+    def getCounters(self):
         """
-        This method configure the logs for this object. 
+        The counters are counted once per process and kept up to date by the storage methods
         """
-        logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        dateTimeFormat = '%Y-%m-%d %H:%M:%S'
-        logFile = 'missile2k13.log'
-        logDir = 'logs'
-
-        fh = TimedRotatingFileHandler(os.path.join(logDir,logFile), \
-                                      backupCount=0, \
-                                      when='d', \
-                                      interval=1)
-        fh.setFormatter(logging.Formatter(logFormat, dateTimeFormat))
-
-        self.log = logging.getLogger('DBController')
-        self.log.addHandler(fh)
-        self.log.setLevel(logging.DEBUG)
+        if self.counters is None:
+            self.counters = {'missilesLeft': sum(self.d['remainingMissiles']),
+                             'launches': len(self.d['launches']),
+                             'buildingsCrashed': len([b for b in self.d['buildings'] if b['crashed']])}
+        return self.counters
+
+    def getLaunches(self, since=None, limit=None):
+        launches = self.d['launches']
+        if since is not None:
+            return [l for l in launches if l['datetime'] >= since][:limit]
+        if limit is None:
+            return list(launches)
+        return launches[-limit:]
 
     def getDB(self):
         return self.d
@@ -792,15 +2118,33 @@ class DBController():
     def close(self):
         self.d.close()
 
-    def launchMissile(self, mlId, crashedBuildings):
+    def launchMissile(self, mlId, source, crashedBuildings):
+        counters = self.getCounters()
+
         # Decrement remaining missiles number
         self.d['remainingMissiles'][mlId] -= 1
+        counters['missilesLeft'] -= 1
 
         # Log attempt
-        self.d['launches'].append({'mlId': str(mlId), 'source': getSourceIP(), 'datetime': datetime.now(), 'cb': str(crashedBuildings)})
+        self.d['launches'].append({'mlId': str(mlId), 'source': source, 'datetime': datetime.now(), 'cb': str(crashedBuildings)})
+        counters['launches'] += 1
+
+    def getProfile(self, location):
+        return self.d.get('launcherProfiles', {}).get(location)
+
+    def saveProfile(self, location, profile):
+        if not self.d.has_key('launcherProfiles'):
+            self.d['launcherProfiles'] = {}
+        self.d['launcherProfiles'][location] = dict(profile, datetime=datetime.now())
+        self.d.sync()
 
     def setBuildingAsCrashed(self, buildId):
+        """
+        Return False if the flag could not be logged as given
+        """
         # Set building as crashed
+        if not self.d['buildings'][buildId]['crashed']:
+            self.getCounters()['buildingsCrashed'] += 1
         self.d['buildings'][buildId]['crashed'] = True
 
         # Set flag as given
@@ -808,341 +2152,390 @@ class DBController():
         if self.d.has_key('flagsGiven'):
             self.d['flagsGiven'].append(flag)
             self.d.sync()
-        else:
-            self.log.debug('Could not append flag to flagsGiven')
-        #self.d.close()
+            return True
+        return False
 
-class ExtendedListBox(urwid.ListBox):
+class SQLiteRow(dict):
     """
-        Listbow widget with embeded autoscroll
+    A table row. Item assignments are written through to the DB.
     """
-
-    __metaclass__ = urwid.MetaSignals
-    signals = ["set_auto_scroll"]
-
-
-    def set_auto_scroll(self, switch):
-        if type(switch) != bool:
-            return
-        self._auto_scroll = switch
-        urwid.emit_signal(self, "set_auto_scroll", switch)
-
-
-    auto_scroll = property(lambda s: s._auto_scroll, set_auto_scroll)
-
-
-    def __init__(self, body):
-        urwid.ListBox.__init__(self, body)
-        self.auto_scroll = True
-
-
-    def switch_body(self, body):
-        if self.body:
-            urwid.disconnect_signal(body, "modified", self._invalidate)
-
-        self.body = body
-        self._invalidate()
-
-        urwid.connect_signal(body, "modified", self._invalidate)
-
-
-    def keypress(self, size, key):
-        urwid.ListBox.keypress(self, size, key)
-
-        if key in ("page up", "page down"):
-            logging.debug("focus = %d, len = %d" % (self.get_focus()[1], len(self.body)))
-            if self.get_focus()[1] == len(self.body)-1:
-                self.auto_scroll = True
-            else:
-                self.auto_scroll = False
-            logging.debug("auto_scroll = %s" % (self.auto_scroll))
-
-
-    def scroll_to_bottom(self):
-        logging.debug("current_focus = %s, len(self.body) = %d" % (self.get_focus()[1], len(self.body)))
-
-        if self.auto_scroll:
-            # at bottom -> scroll down
-            self.set_focus(len(self.body))
-
-
-
-"""
- -------context-------
-| --inner context---- |
-|| HEADER            ||
-||                   ||
-|| BODY              ||
-||                   ||
-|| DIVIDER           ||
-| ------------------- |
-| FOOTER              |
- ---------------------
-
-inner context = context.body
-context.body.body = BODY
-context.body.header = HEADER
-context.body.footer = DIVIDER
-context.footer = FOOTER
-
-HEADER = Notice line (urwid.Text)
-BODY = Extended ListBox
-DIVIDER = Divider with information (urwid.Text)
-FOOTER = Input line (Ext. Edit)
-"""
-
-
-class MainWindow(object):
-
-    __metaclass__ = MetaSignals
-    signals = ["quit","keypress"]
-
-    _palette = [
-            ('divider','black','dark cyan', 'standout'),
-            ('text','light gray', 'default'),
-            ('bold_text', 'light gray', 'default', 'bold'),
-            ('client_text','light gray', 'default'),
-            ('server_text', 'light blue', 'default'),
-            ('info_text', 'light green', 'default'),
-            ('warning_text', 'yellow', 'default'),
-            ('error_text', 'light red', 'default'),
-            ("body", "text"),
-            ("footer", "text"),
-            ("header", "text"),
-        ]
-
-    for type, bg in (
-            ("div_fg_", "dark cyan"),
-            ("", "default")):
-        for name, color in (
-                ("red","dark red"),
-                ("blue", "dark blue"),
-                ("green", "dark green"),
-                ("yellow", "yellow"),
-                ("magenta", "dark magenta"),
-                ("gray", "light gray"),
-                ("white", "white"),
-                ("black", "black")):
-            _palette.append( (type + name, color, bg) )
-
-
-    def __init__(self, sender="1234567890"):
-        self.shall_quit = False
-        self.sender = sender
-        self.shell = None
-
-
-    def main(self):
-        """ 
-            Entry point to start UI 
+    def __init__(self, storage, table, keyValue, values):
+        dict.__init__(self, values)
+        self._storage = storage
+        self._table = table
+        self._keyValue = keyValue
+
+    def __setitem__(self, column, value):
+        table = self._storage.TABLES[self._table]
+        if column not in table['columns']:
+            raise KeyError(column)
+        self._storage.execute('UPDATE %s SET %s = ? WHERE %s = ?' % (self._table, column, table['key']), \
+                              (value, self._keyValue))
+        self._storage.recount([self._table])
+        dict.__setitem__(self, column, value)
+
+class SQLiteList():
+    """
+    List-like view of a table ordered by its primary key. Items are rows
+    (SQLiteRow) or, if column is given, the value of that column.
+    """
+    def __init__(self, storage, table, column=None):
+        self._storage = storage
+        self._table = table
+        self._column = column
+        self._def = storage.TABLES[table]
+
+    def _select(self, suffix='', args=()):
+        return self._storage.execute('SELECT %s, %s FROM %s %s' % \
+                                     (self._def['key'], ', '.join(self._def['columns']), self._table, suffix), args)
+
+    def _toItem(self, row):
+        values = dict(zip(self._def['columns'], row[1:]))
+        if self._column is not None:
+            return values[self._column]
+        return SQLiteRow(self._storage, self._table, row[0], values)
+
+    def __len__(self):
+        return self._storage.execute('SELECT COUNT(*) FROM %s' % self._table).fetchone()[0]
+
+    def __iter__(self):
+        for row in self._select('ORDER BY %s' % self._def['key']).fetchall():
+            yield self._toItem(row)
+
+    def __getitem__(self, index):
+        if index < 0:
+            row = self._select('ORDER BY %s DESC LIMIT 1 OFFSET ?' % self._def['key'], (-index - 1,)).fetchone()
+        else:
+            row = self._select('ORDER BY %s LIMIT 1 OFFSET ?' % self._def['key'], (index,)).fetchone()
+        if row is None:
+            raise IndexError(index)
+        return self._toItem(row)
+
+    def __setitem__(self, index, value):
+        if self._column is None:
+            raise TypeError('Rows must be updated column by column')
+        key = self._select('ORDER BY %s LIMIT 1 OFFSET ?' % self._def['key'], (index,)).fetchone()[0]
+        self._storage.execute('UPDATE %s SET %s = ? WHERE %s = ?' % (self._table, self._column, self._def['key']), \
+                              (value, key))
+        self._storage.recount([self._table])
+
+    def append(self, value):
+        if self._column is not None:
+            value = {self._column: value}
+        columns = [c for c in self._def['columns'] if c in value]
+        self._storage.execute('INSERT INTO %s (%s) VALUES (%s)' % (self._table, ', '.join(columns), ', '.join('?' * len(columns))), \
+                              [value[c] for c in columns])
+        self._storage.recount([self._table])
+
+class SQLiteDict():
+    """
+    Compatibility layer giving the shelve dict API (getDB()) on top of SQLiteStorage.
+    Table backed keys return live views (see SQLiteList), secureMods returns a
+    copy and every other key is a pickled value of the settings table.
+    """
+    def __init__(self, storage):
+        self._storage = storage
+
+    def __getitem__(self, key):
+        if key == 'secureMods':
+            return self._storage.getSecureMods()
+        if key == 'remainingMissiles':
+            return SQLiteList(self._storage, key, 'count')
+        if key == 'flagsGiven':
+            return SQLiteList(self._storage, key, 'flag')
+        if key in self._storage.TABLES:
+            return SQLiteList(self._storage, key)
+        row = self._storage.execute('SELECT value FROM settings WHERE name = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return cPickle.loads(str(row[0]))
+
+    def __setitem__(self, key, value):
         """
-
-        self.ui = urwid.raw_display.Screen()
-        self.ui.register_palette(self._palette)
-        self.build_interface()
-        self.shell = MissileShell(self.print_info, self.print_warning, self.print_error)
-        self.ui.run_wrapper(self.run)
-
-
-    def run(self):
-        """ 
-            Setup input handler, invalidate handler to
-            automatically redraw the interface if needed.
-
-            Start mainloop.
+        Replace a whole entry (used by initDB.py)
         """
+        if key in self._storage.TABLES:
+            self._storage.replaceTable(key, value)
+        else:
+            self._storage.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', \
+                                  (key, self._storage.sqlite3.Binary(cPickle.dumps(value, 2))))
 
-        # I don't know what the callbacks are for yet,
-        # it's a code taken from the nigiri project
-        def input_cb(key):
-            if self.shall_quit:
-                raise urwid.ExitMainLoop
-            self.keypress(self.size, key)
-
-        self.size = self.ui.get_cols_rows()
-
-        self.main_loop = urwid.MainLoop(
-                self.context,
-                screen=self.ui,
-                handle_mouse=False,
-                unhandled_input=input_cb,
-            )
-
-        def call_redraw(*x):
-            self.draw_interface()
-            invalidate.locked = False
-            return True
+    def has_key(self, key):
+        return key in self._storage.TABLES or \
+               self._storage.execute('SELECT 1 FROM settings WHERE name = ?', (key,)).fetchone() is not None
 
-        inv = urwid.canvas.CanvasCache.invalidate
+    __contains__ = has_key
 
-        def invalidate (cls, *a, **k):
-            inv(*a, **k)
+    def keys(self):
+        return self._storage.TABLES.keys() + \
+               [row[0] for row in self._storage.execute('SELECT name FROM settings').fetchall()]
 
-            if not invalidate.locked:
-                invalidate.locked = True
-                self.main_loop.set_alarm_in(0, call_redraw)
+    def sync(self):
+        pass
 
-        invalidate.locked = False
-        urwid.canvas.CanvasCache.invalidate = classmethod(invalidate)
+    def close(self):
+        self._storage.close()
 
-        try:
-            self.main_loop.run()
-        except KeyboardInterrupt:
-            self.quit()
+class SQLiteStorage():
+    """
+    Storage engine keeping the game state in SQLite tables.
 
+    The DB is in WAL mode so the shell of every team and lightController.py
+    read while another process writes. Every statement is committed on its
+    own except the multi-statement operations that use a transaction.
+    A sqlite3 connection can't be shared between threads, so every thread
+    (UI, scheduler, hotplug, control server executor) opens its own.
 
-    def quit(self, exit=True):
-        """ 
-            Stops the ui, exits the application (if exit=True)
+    The counters table keeps the totals shown by the shell. launchMissile()
+    and setBuildingAsCrashed() update them in their transaction, other 
+    writes recount the counters of the tables they change.
+    """
+    TABLES = {
+        'launches': {'key': 'id', 'columns': ['mlId', 'source', 'datetime', 'cb']},
+        'buildings': {'key': 'id', 'columns': ['name', 'value', 'crashed', 'flag']},
+        'remainingMissiles': {'key': 'mlId', 'columns': ['count']},
+        'flagsGiven': {'key': 'id', 'columns': ['flag', 'datetime']},
+        'secureMods': {'key': 'name', 'columns': ['description', 'key', 'locked']},
+        'launcherProfiles': {'key': 'location', 'columns': ['panSpeed', 'tiltSpeed', 'spinUp', 'datetime']},
+    }
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS launches (id INTEGER PRIMARY KEY AUTOINCREMENT, mlId TEXT, source TEXT, datetime TIMESTAMP, cb TEXT);
+        CREATE INDEX IF NOT EXISTS launches_datetime ON launches (datetime);
+        CREATE INDEX IF NOT EXISTS launches_mlId ON launches (mlId);
+        CREATE TABLE IF NOT EXISTS buildings (id INTEGER PRIMARY KEY, name TEXT, value INTEGER, crashed BOOLEAN, flag TEXT);
+        CREATE TABLE IF NOT EXISTS remainingMissiles (mlId INTEGER PRIMARY KEY, count INTEGER);
+        CREATE TABLE IF NOT EXISTS flagsGiven (id INTEGER PRIMARY KEY AUTOINCREMENT, flag TEXT, datetime TIMESTAMP);
+        CREATE INDEX IF NOT EXISTS flagsGiven_flag ON flagsGiven (flag);
+        CREATE TABLE IF NOT EXISTS secureMods (name TEXT PRIMARY KEY, description TEXT, key TEXT, locked BOOLEAN);
+        CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value BLOB);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS launcherProfiles (location TEXT PRIMARY KEY, panSpeed REAL, tiltSpeed REAL, spinUp REAL, datetime TIMESTAMP);
+    """
+    COUNTERS = {
+        'missilesLeft': ('remainingMissiles', 'SELECT COALESCE(SUM(count), 0) FROM remainingMissiles'),
+        'launches': ('launches', 'SELECT COUNT(*) FROM launches'),
+        'buildingsCrashed': ('buildings', 'SELECT COUNT(*) FROM buildings WHERE crashed'),
+    }
+    busyTimeout = 5     # in seconds
+
+    def __init__(self, path):
+        import sqlite3
+        self.sqlite3 = sqlite3
+        sqlite3.register_converter('BOOLEAN', lambda v: v not in ('0', ''))
+        self.path = path
+        self._local = local()
+        self._connections = []
+        self._lock = Lock()
+        conn = self.getConnection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+        self.d = SQLiteDict(self)
+        if self.execute('SELECT COUNT(*) FROM counters').fetchone()[0] < len(self.COUNTERS):
+            self.recount()
+
+    def getConnection(self):
         """
-        urwid.emit_signal(self, "quit")
-
-        self.shall_quit = True
-
-        if exit:
-            sys.exit(0)
-
-
-    def build_interface(self):
-        """ 
-            Call the widget methods to build the UI 
+        Return the connection of the calling thread, opened by its first call
         """
-
-        self.header = urwid.Text("HF City Missile Launcher control center")
-        self.footer = urwid.Edit("> ")
-        self.divider = urwid.Text("Initializing.")
-
-        self.generic_output_walker = urwid.SimpleListWalker([])
-        self.body = ExtendedListBox(self.generic_output_walker)
-        self.header = urwid.AttrWrap(self.header, "divider")
-        self.footer = urwid.AttrWrap(self.footer, "footer")
-        self.divider = urwid.AttrWrap(self.divider, "divider")
-        self.body = urwid.AttrWrap(self.body, "body")
-
-        self.footer.set_wrap_mode("space")
-
-        main_frame = urwid.Frame(self.body, 
-                                header=self.header,
-                                footer=self.divider)
-        
-        self.context = urwid.Frame(main_frame, footer=self.footer)
-
-        self.divider.set_text(("divider",
-                               ("Enter a command (help for list):")))
-
-        self.context.set_focus("footer")
-
-
-
-    def draw_interface(self):
-        self.main_loop.draw_screen()
-
-
-    def keypress(self, size, key):
-        """ 
-            Handle user inputs
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Only close() uses it from another thread
+            conn = self.sqlite3.connect(self.path, timeout=self.busyTimeout, isolation_level=None, \
+                                        detect_types=self.sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+            conn.text_factory = str
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def execute(self, sql, args=()):
+        return self.getConnection().execute(sql, args)
+
+    @contextlib.contextmanager
+    def transaction(self):
         """
+        Context manager running its statements in one write transaction
+        """
+        conn = self.getConnection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
 
-        urwid.emit_signal(self, "keypress", size, key)
-
-        # scroll the top panel
-        if key in ("page up","page down"):
-            self.body.keypress (size, key)
-
-        # resize the main windows
-        elif key == "window resize":
-            self.size = self.ui.get_cols_rows()
-
-        elif key in ("ctrl d", 'ctrl c'):
-            self.quit()
-
-        elif key == "enter":
-            # Parse data or (if parse failed)
-            # send it to the current world
-            text = self.footer.get_edit_text()
-
-            self.footer.set_edit_text(" "*len(text))
-            self.footer.set_edit_text("")
-
-            if text in ('quit', 'q'):
-                self.quit()
-
-            if text.strip():
-                self.print_sent_message(text)
-                reply = self.shell.processCmd(text)
-                if reply != None:
-                    self.print_received_message(reply)
+    def getDB(self):
+        return self.d
 
-        else:
-            self.context.keypress (size, key)
+    def sync(self):
+        pass
 
- 
-    def print_sent_message(self, text):
+    def close(self):
         """
-            Print a received message
+        This method close the connection of every thread
         """
-
-        self.print_text(('client_text', ('[%s] You: %s' % (self.get_time(), text))))
- 
- 
-    def print_received_message(self, text):
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for conn in connections:
+            conn.close()
+        self._local = local()
+
+    def recount(self, tables=None):
         """
-            Print a sent message
+        This method recount the counters of tables (all by default)
         """
-        self.print_text(('server_text', ('[%s] System: %s' % (self.get_time(), text))))
+        for (name, (table, sql)) in self.COUNTERS.iteritems():
+            if tables is None or table in tables:
+                self.execute('INSERT OR REPLACE INTO counters (name, value) VALUES (?, (%s))' % sql, (name,))
+
+    def _addToCounter(self, name, value):
+        self.getConnection().execute('UPDATE counters SET value = value + ? WHERE name = ?', (value, name))
+
+    def getCounters(self):
+        return dict(self.execute('SELECT name, value FROM counters').fetchall())
+
+    def getLaunches(self, since=None, limit=None):
+        if limit is None:
+            limit = -1
+        columns = ['mlId', 'source', 'datetime', 'cb']
+        if since is not None:
+            rows = self.execute('SELECT mlId, source, datetime, cb FROM launches WHERE datetime >= ? ORDER BY datetime, id LIMIT ?', \
+                                (since, limit)).fetchall()
+        else:
+            rows = self.execute('SELECT mlId, source, datetime, cb FROM launches ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+            rows.reverse()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def getSecureMods(self):
+        result = {}
+        for (name, description, key, locked) in \
+                self.execute('SELECT name, description, key, locked FROM secureMods').fetchall():
+            result[name] = {'description': description, 'key': key, 'locked': locked}
+        return result
 
-    def print_info(self, text):
+    def replaceTable(self, table, value):
         """
-            Print an info message
+        This method replace the content of a table with value: a list of rows 
+        (or of values for single column tables) or a dict for secureMods.
         """
-        self.print_text(('info_text', ('[%s] Info: %s' % (self.get_time(), text))))
+        tDef = self.TABLES[table]
+        if isinstance(value, dict):
+            rows = [dict(v, **{tDef['key']: k}) for (k, v) in value.iteritems()]
+        elif len(tDef['columns']) == 1 and table != 'flagsGiven':
+            rows = [{tDef['key']: i, tDef['columns'][0]: v} for (i, v) in enumerate(value)]
+        elif table == 'flagsGiven':
+            rows = [{'flag': v} for v in value]
+        else:
+            rows = [dict(v, **{tDef['key']: i}) for (i, v) in enumerate(value)]
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM %s' % table)
+            for row in rows:
+                columns = [c for c in [tDef['key']] + tDef['columns'] if c in row]
+                conn.execute('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns), ', '.join('?' * len(columns))), \
+                             [row[c] for c in columns])
+            self.recount([table])
+
+    def launchMissile(self, mlId, source, crashedBuildings):
+        with self.transaction() as conn:
+            if conn.execute('UPDATE remainingMissiles SET count = count - 1 WHERE mlId = ?', (mlId,)).rowcount:
+                self._addToCounter('missilesLeft', -1)
+            conn.execute('INSERT INTO launches (mlId, source, datetime, cb) VALUES (?, ?, ?, ?)', \
+                         (str(mlId), source, datetime.now(), str(crashedBuildings)))
+            self._addToCounter('launches', 1)
+
+    def getProfile(self, location):
+        row = self.execute('SELECT panSpeed, tiltSpeed, spinUp FROM launcherProfiles WHERE location = ?', (location,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['panSpeed', 'tiltSpeed', 'spinUp'], row))
+
+    def saveProfile(self, location, profile):
+        self.execute('INSERT OR REPLACE INTO launcherProfiles (location, panSpeed, tiltSpeed, spinUp, datetime) VALUES (?, ?, ?, ?, ?)', \
+                     (location, profile['panSpeed'], profile['tiltSpeed'], profile['spinUp'], datetime.now()))
 
-    def print_warning(self, text):
-        """
-            Print a warning message
-        """
-        self.print_text(('warning_text', ('[%s] Warning: %s' % (self.get_time(), text))))
+    def setBuildingAsCrashed(self, buildId):
+        with self.transaction() as conn:
+            if conn.execute('UPDATE buildings SET crashed = 1 WHERE id = ? AND NOT COALESCE(crashed, 0)', (buildId,)).rowcount:
+                self._addToCounter('buildingsCrashed', 1)
+            row = conn.execute('SELECT flag FROM buildings WHERE id = ?', (buildId,)).fetchone()
+            if row is None:
+                return False
+            conn.execute('INSERT INTO flagsGiven (flag, datetime) VALUES (?, ?)', (row[0], datetime.now()))
+        return True
 
+@Singleton
+class DBController():
+    #dbFile = '/root/missile2k13.shelve'
+    dbFile = 'missile2k13.shelve'
+    sqliteFile = 'missile2k13.sqlite'
+    storageBackend = 'sqlite'       # 'sqlite' or 'shelve'
+    storage = None
 
-    def print_error(self, text):
-        """
-            Print an error message
-        """
-        self.print_text(('error_text', ('[%s] Error: %s' % (self.get_time(), text))))
+    def __init__(self):
+        self._configLogs()
+        if self.storageBackend == 'sqlite':
+            self.log.info('Opening SQLite DB (' + str(self.sqliteFile) + ')')
+            self.storage = SQLiteStorage(self.sqliteFile)
+        else:
+            self.log.info('Opening shelve (' + str(self.dbFile) + ')')
+            self.storage = ShelveStorage(self.dbFile)
 
-        
-    def print_text(self, text):
+    def _configLogs(self):
         """
-            Print the given text in the _current_ window
-            and scroll to the bottom. 
-            You can pass a Text object or a string
+        This method configure the logs for this object. 
         """
+        self.log = asyncLog.getLogger('DBController')
+
+    def getDB(self):
+        return self.storage.getDB()
 
-        walker = self.generic_output_walker
+    @latencyStats.timed('db.sync')
+    def sync(self):
+        self.storage.sync()
 
-        if not isinstance(text, urwid.Text):
-            text = urwid.Text(text)
+    def close(self):
+        self.storage.close()
 
-        walker.append(text)
+    @latencyStats.timed('db.launchMissile')
+    def launchMissile(self, mlId, crashedBuildings):
+        with spanTrace.span('db.launchMissile ml=' + str(mlId)):
+            self.storage.launchMissile(mlId, getSourceIP(), crashedBuildings)
 
-        self.body.scroll_to_bottom()
+    @latencyStats.timed('db.getCounters')
+    def getCounters(self):
+        """
+        Return the game totals {'missilesLeft': ..., 'launches': ..., 'buildingsCrashed': ...}
+        """
+        return self.storage.getCounters()
 
+    @latencyStats.timed('db.getLaunches')
+    def getLaunches(self, since=None, limit=None):
+        """
+        Return launches in chronological order: the first limit ones logged at or after since 
+        or, without since, the last limit ones
+        """
+        return self.storage.getLaunches(since, limit)
 
-    def get_time(self):
+    @latencyStats.timed('db.getProfile')
+    def getProfile(self, location):
         """
-            Return formated current datetime
+        Return the calibration profile saved for a USB location or None
         """
-        return datetime.now().strftime('%H:%M:%S')
-        
-def getSourceIP():
-    cmd = "w | grep ^ml | awk '{ print $3 }'"
-    p1 = subprocess.Popen(['w'], stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(['grep', '^ml'], stdin=p1.stdout, stdout=subprocess.PIPE)
-    p3 = subprocess.Popen(['awk', '{ print $3 }'], stdin=p2.stdout, stdout=subprocess.PIPE)
-    output = p3.communicate()[0]
-    if output[-1] == "\n":
-        output = output[:-1]
-    return str(output)
+        return self.storage.getProfile(location)
+
+    @latencyStats.timed('db.saveProfile')
+    def saveProfile(self, location, profile):
+        self.storage.saveProfile(location, profile)
+
+    @latencyStats.timed('db.setBuildingAsCrashed')
+    def setBuildingAsCrashed(self, buildId):
+        with spanTrace.span('db.setBuildingAsCrashed building=' + str(buildId)):
+            bLogged = self.storage.setBuildingAsCrashed(buildId)
+        if not bLogged:
+            self.log.debug('Could not append flag to flagsGiven')
 
 def except_hook(extype, exobj, extb, manual=False):
     if not manual:
@@ -1185,8 +2578,7 @@ def setup_logging():
         if not os.path.exists(logdir):
             os.makedirs(logdir)
 
-        logging.basicConfig(filename=logfile, level=logging.DEBUG,
-            filemode="w")
+        asyncLog.setup(logfile)
 
         logging.getLogger("Missile2k13").addHandler(ExceptionHandler())
 
@@ -1194,8 +2586,162 @@ def setup_logging():
         print >> sys.stderr, "Logging init error: %s" % (e)
 
 
+class RemoteShell():
+    """
+    MissileShell of a control server (missileServer.py). The session runs in
+    the server process, which owns the devices and the DB. Every command 
+    is sent as a line and the server answers with lines "I text" (info), 
+    "W text" (warning), "E text" (error), "R text" (reply) and "D" when the
+    command is done. The first line sent gives the address of the session
+    (only trusted by the server on its Unix socket, see missileServer.py).
+    """
+    def __init__(self, info_callback, warning_callback, error_callback, address):
+        self.print_info = info_callback 
+        self.print_warning = warning_callback
+        self.print_error = error_callback
+        self._sock = connectControlServer(address)
+        self._file = self._sock.makefile('rb')
+        self._sock.sendall('H ' + getSourceIP() + '\n')
+        self._readReply()
+
+    def _readReply(self):
+        aReply = []
+        while True:
+            line = self._file.readline()
+            if line == '':
+                raise IOError('Connection closed by the control server')
+            kind, text = line[0], line[2:].rstrip('\n')
+            if kind == 'D':
+                return '\n'.join(aReply)
+            elif kind == 'R':
+                aReply.append(text)
+            elif kind == 'I':
+                self.print_info(text)
+            elif kind == 'W':
+                self.print_warning(text)
+            elif kind == 'E':
+                self.print_error(text)
+
+    def processCmd(self, text):
+        self._sock.sendall(text.replace('\n', ' ') + '\n')
+        return self._readReply()
+
+def parseAddress(address):
+    """
+    Return (family, address) of a control server address: a Unix socket path or HOST:PORT
+    """
+    if '/' in address:
+        return (socket.AF_UNIX, address)
+    host, port = address.rsplit(':', 1)
+    return (socket.AF_INET, (host, int(port)))
+
+def connectControlServer(address):
+    family, addr = parseAddress(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(addr)
+    return sock
+
+class BatchConsole():
+    """
+    Run shell commands without the UI and stream the results to stdout. 
+    Commands are separated by ';' or new lines, lines starting with '#' are
+    ignored and 'quit' stops the batch.
+    """
+    def __init__(self, shellClass=None, out=sys.stdout):
+        """
+        @param shellClass: function(info_callback, warning_callback, error_callback) returning the shell
+        """
+        self.shellClass = shellClass or MissileShell
+        self.out = out
+        self.failed = False
+        self.shell = None
+
+    def _write(self, level, text):
+        self.out.write('[%s] %s: %s\n' % (datetime.now().strftime('%H:%M:%S'), level, text))
+        self.out.flush()
+
+    def print_info(self, text):
+        self._write('Info', text)
+
+    def print_warning(self, text):
+        self._write('Warning', text)
+
+    def print_error(self, text):
+        self.failed = True
+        self._write('Error', text)
+
+    @staticmethod
+    def split(script):
+        """
+        Return the commands of a script
+        """
+        aCmds = []
+        for line in script.splitlines():
+            if line.strip().startswith('#'):
+                continue
+            aCmds += [cmd.strip() for cmd in line.split(';') if cmd.strip()]
+        return aCmds
+
+    def run(self, script):
+        """
+        This method run the commands of script and return the exit status (1 if an error was printed)
+        """
+        self.shell = self.shellClass(self.print_info, self.print_warning, self.print_error)
+        startupProfile.mark('shell ready')
+        for text in self.split(script):
+            if text in ('quit', 'q'):
+                break
+            self._write('You', text)
+            reply = self.shell.processCmd(text)
+            if reply is None:
+                self.print_error('Unknown command: ' + text.split(' ', 1)[0])
+            elif reply != '':
+                self._write('System', reply)
+        return int(self.failed)
+
+def usage():
+    print >> sys.stderr, 'Usage: ' + sys.argv[0] + ' [--startup-profile] [--connect ADDRESS] [--batch FILE | -c "CMD; CMD..."]'
+    print >> sys.stderr, '    --startup-profile   print the time of each start-up phase'
+    print >> sys.stderr, '    --connect ADDRESS   use the control server at ADDRESS (socket path or HOST:PORT)'
+    print >> sys.stderr, '    --batch FILE        run the commands of FILE (- for stdin) without the UI'
+    print >> sys.stderr, '    -c CMDS             run the commands separated by ";" without the UI'
+    sys.exit(2)
+
 if __name__ == "__main__":
+    script = None
+    shellClass = MissileShell
+    try:
+        aOpts, aArgs = getopt.getopt(sys.argv[1:], 'c:', ['batch=', 'connect=', 'startup-profile'])
+    except getopt.GetoptError:
+        usage()
+    if aArgs:
+        usage()
+    for opt, value in aOpts:
+        if opt == '--batch':
+            if value == '-':
+                script = sys.stdin.read()
+            else:
+                script = open(value).read()
+        elif opt == '-c':
+            script = value
+        elif opt == '--connect':
+            shellClass = lambda info, warning, error, address=value: RemoteShell(info, warning, error, address)
+        elif opt == '--startup-profile':
+            startupProfile.enabled = True
+    startupProfile.mark('imports done')
+
     setup_logging()
-    main_window = MainWindow()
+    getSourceIP()    # Resolve the session identity once, before the UI starts
+    startupProfile.mark('logging and session identity')
     sys.excepthook = except_hook
+    if script is not None:
+        oConsole = BatchConsole(shellClass)
+        status = oConsole.run(script)
+        if startupProfile.enabled:
+            print >> sys.stderr, '\n'.join(startupProfile.report())
+        sys.exit(status)
+
+    from missileUI import MainWindow
+    startupProfile.mark('urwid imported')
+    main_window = MainWindow(shellClass, profile=startupProfile)
     main_window.main()
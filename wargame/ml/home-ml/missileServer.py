@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Control server of the missile launchers
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Long running server owning the launchers and the DB. Every team session
+    (missile2k13.py --connect) gets its own MissileShell on one shared
+    MissilesController, so a login no longer loads pyusb, opens the DB and
+    registers the devices.
+
+    The sockets are handled by asyncore in the main thread. Every session
+    runs its commands in order in its own CommandExecutor thread, so a
+    team calibrating does not hold the others. The launchers serialize
+    their own moves (LauncherScheduler) and the controller runs one salvo
+    at a time. The output is sent back to the session by the main thread
+    as it is printed. See RemoteShell in missile2k13.py for the line
+    protocol.
+
+    The address of a session is the TCP peer address. The "H address" line
+    of a client is only trusted on the Unix socket from a process of the
+    same user (the ml SSH sessions), it is ignored otherwise.
+
+    Usage: missileServer.py [ADDRESS ...]
+    ADDRESS is a Unix socket path (default /home/ml/missile2k13.sock) or
+    HOST:PORT. A TCP port has no authentication: bind it to 127.0.0.1.
+"""
+import os
+import sys
+import struct
+import socket
+import asyncore
+import asynchat
+import Queue
+from threading import Thread, Lock, local
+
+import asyncLog
+import sessionIdentity
+from missile2k13 import MissileShell, MissilesController, parseAddress
+
+DEFAULT_ADDRESS = os.environ.get('HF_ML_DIR', '/home/ml') + '/missile2k13.sock'
+LOG_FILE = 'logs/missileServer.log'
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+PEERCRED = struct.Struct('3i')     # struct ucred: pid, uid, gid
+
+class OutputRouter():
+    """
+    Print callbacks of the shared controller and of the shells: the
+    messages go to the session of the executor thread printing them.
+    """
+    def __init__(self, waker):
+        self.waker = waker
+        self._local = local()
+        self._configLogs()
+
+    def _configLogs(self):
+        """
+        This method configure the logs for this object.
+        """
+        self.log = asyncLog.getLogger('OutputRouter')
+
+    def setSession(self, session):
+        """
+        This method send the messages printed by the calling thread to session
+        """
+        self._local.session = session
+
+    def _print(self, kind, text):
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            session.output(kind, text)
+            # Sent now, a fire or a calibration prints for seconds
+            self.waker.wake()
+        else:
+            self.log.info(text)
+
+    def print_info(self, text):
+        self._print('I', text)
+
+    def print_warning(self, text):
+        self._print('W', text)
+
+    def print_error(self, text):
+        self._print('E', text)
+
+class CommandExecutor(Thread):
+    """
+    Run the commands of one session in order. The first one opens the
+    session (creates its shell), None stops the thread.
+    """
+    def __init__(self, session, oMC, router):
+        Thread.__init__(self)
+        self.daemon = True
+        self.session = session
+        self.oMC = oMC
+        self.router = router
+        self.shell = None
+        self._queue = Queue.Queue()
+        self._configLogs()
+
+    def _configLogs(self):
+        """
+        This method configure the logs for this object.
+        """
+        self.log = asyncLog.getLogger('CommandExecutor')
+
+    def submit(self, text):
+        """
+        This method queue a command of the session
+        """
+        self._queue.put(text)
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _open(self):
+        self.shell = MissileShell(self.router.print_info, self.router.print_warning, \
+                                  self.router.print_error, self.oMC)
+
+    def _run(self, text):
+        reply = self.shell.processCmd(text)
+        if reply is None:
+            self.router.print_error('Unknown command: ' + text.split(' ', 1)[0])
+        elif reply != '':
+            self.session.output('R', reply)
+
+    def _execute(self, func, *args):
+        """
+        This method run func and tell the session it is done
+        """
+        try:
+            func(*args)
+        except Exception, e:
+            self.log.exception('Command failed: ' + ' '.join(args))
+            self.router.print_error('Internal error: ' + str(e))
+        self.session.output('D', '')
+        self.router.waker.wake()
+
+    def run(self):
+        self.router.setSession(self.session)
+        sessionIdentity.setSourceIP(self.session.sourceIP)
+        self._execute(self._open)
+        while True:
+            text = self._queue.get()
+            if text is None:
+                return
+            self._execute(self._run, text)
+
+class Waker(asyncore.file_dispatcher):
+    """
+    Wake the asyncore loop up when an executor has output to send
+    """
+    def __init__(self, sessions):
+        self._r, self._w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._r)
+        self.sessions = sessions
+
+    def wake(self):
+        os.write(self._w, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        for session in list(self.sessions):
+            session.flush()
+
+class ControlSession(asynchat.async_chat):
+    """
+    One client. The first line may give the address of the session
+    ("H address", see trusted), every other line is a shell command.
+    The executor of the session is started once its address is known.
+    """
+    maxLine = 4096
+
+    def __init__(self, sock, sessions, oMC, router, sourceIP, trusted=False):
+        """
+        @param trusted: The client may give the address of its session
+        """
+        asynchat.async_chat.__init__(self, sock)
+        self.set_terminator('\n')
+        self.sessions = sessions
+        self.executor = CommandExecutor(self, oMC, router)
+        self.sourceIP = sourceIP
+        self.trusted = trusted
+        self.closed = False
+        self.opened = False
+        self._buffer = []
+        self._lock = Lock()
+        self._output = []
+        self.sessions.add(self)
+
+    def collect_incoming_data(self, data):
+        self._buffer.append(data)
+        if sum([len(d) for d in self._buffer]) > self.maxLine:
+            self.handle_close()
+
+    def found_terminator(self):
+        line = ''.join(self._buffer).rstrip('\r')
+        self._buffer = []
+        if not self.opened:
+            self.opened = True
+            if line.startswith('H '):
+                if self.trusted:
+                    self.sourceIP = line[2:].strip()
+                else:
+                    self.executor.log.warning('Session address ' + line[2:].strip() + ' of ' + \
+                                              self.sourceIP + ' ignored')
+                line = ''
+            self.executor.start()
+        if line.strip():
+            self.executor.submit(line.strip())
+
+    def output(self, kind, text):
+        """
+        This method queue output lines, called by the executor thread
+        """
+        with self._lock:
+            if kind == 'D':
+                self._output.append('D\n')
+                return
+            for line in text.split('\n'):
+                self._output.append(kind + ' ' + line + '\n')
+
+    def flush(self):
+        with self._lock:
+            data = ''.join(self._output)
+            self._output = []
+        if data and not self.closed:
+            self.push(data)
+
+    def handle_close(self):
+        self.closed = True
+        self.sessions.discard(self)
+        self.executor.stop()
+        self.close()
+
+class ControlServer(asyncore.dispatcher):
+    """
+    Accept the sessions on a Unix socket or a TCP port
+    """
+    def __init__(self, address, sessions, oMC, router):
+        asyncore.dispatcher.__init__(self)
+        family, addr = parseAddress(address)
+        self.create_socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.unlink(addr)
+        else:
+            self.set_reuse_addr()
+        self.bind(addr)
+        if family == socket.AF_UNIX:
+            os.chmod(addr, 0600)
+        self.listen(16)
+        self.family = family
+        self.sessions = sessions
+        self.oMC = oMC
+        self.router = router
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        sourceIP = sessionIdentity.UNKNOWN_SOURCE
+        trusted = False
+        if self.family != socket.AF_UNIX:
+            sourceIP = addr[0]
+        else:
+            pid, uid, gid = PEERCRED.unpack(sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, PEERCRED.size))
+            trusted = uid in (os.getuid(), 0)
+        ControlSession(sock, self.sessions, self.oMC, self.router, sourceIP, trusted)
+
+def main(aAddresses):
+    if not os.path.exists(os.path.dirname(LOG_FILE)):
+        os.makedirs(os.path.dirname(LOG_FILE))
+    asyncLog.setup(LOG_FILE)
+    sessions = set()
+    waker = Waker(sessions)
+    router = OutputRouter(waker)
+    oMC = MissilesController(router.print_info, router.print_warning, router.print_error)
+    oMC.registerDevices()
+    for address in aAddresses:
+        ControlServer(address, sessions, oMC, router)
+    asyncore.loop(timeout=30, use_poll=True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or [DEFAULT_ADDRESS])
@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Full screen console of the missile launcher controller
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>. 
+# code extracted from nigiri
+# This code needs urwid version: 1.0.1-2 (debian stable repo)
+#
+# Kept out of missile2k13.py so the batch mode (--batch, -c) never loads urwid.
+#
+
+import os
+import sys
+import logging
+import threading
+import struct
+import tempfile
+import cPickle
+import Queue
+import array
+import urwid
+from collections import deque
+from datetime import datetime
+from urwid import MetaSignals
+
+class ScrollbackWalker(urwid.ListWalker):
+    """
+        Output history of the console. Only the last cap entries stay in
+        memory, older ones are spilled to a temporary file and read back
+        when scrolled to. Widgets are built for the rows the ListBox asks
+        for (the visible ones), not for every entry.
+    """
+
+    widgetCacheSize = 256
+    RECORD_SIZE = struct.Struct('<I')
+
+    def __init__(self, cap=1000):
+        self.cap = cap
+        self._entries = deque()             # markup of the entries in memory
+        self._first = 0                     # position of _entries[0]
+        self._spill = None                  # temporary file of the evicted entries
+        self._offsets = array.array('L')    # offset in _spill of each evicted position
+        self._widgets = {}                  # position: urwid.Text
+        self._focus = 0
+
+    def __len__(self):
+        return self._first + len(self._entries)
+
+    def append(self, markup):
+        self._entries.append(markup)
+        if len(self._entries) > self.cap:
+            self._evict(self._entries.popleft())
+        self._modified()
+
+    def _evict(self, markup):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(0, 2)
+        self._offsets.append(self._spill.tell())
+        data = cPickle.dumps(markup, 2)
+        self._spill.write(self.RECORD_SIZE.pack(len(data)) + data)
+        self._first += 1
+
+    def _getMarkup(self, position):
+        if position >= self._first:
+            return self._entries[position - self._first]
+        self._spill.seek(self._offsets[position])
+        size = self.RECORD_SIZE.unpack(self._spill.read(self.RECORD_SIZE.size))[0]
+        return cPickle.loads(self._spill.read(size))
+
+    def _getWidget(self, position):
+        if position < 0 or position >= len(self):
+            return None, None
+        widget = self._widgets.get(position)
+        if widget is None:
+            if len(self._widgets) >= self.widgetCacheSize:
+                self._widgets.clear()
+            widget = urwid.Text(self._getMarkup(position))
+            self._widgets[position] = widget
+        return widget, position
+
+    def get_focus(self):
+        return self._getWidget(min(self._focus, len(self) - 1))
+
+    def set_focus(self, position):
+        self._focus = max(0, min(position, len(self) - 1))
+        self._modified()
+
+    def get_next(self, position):
+        return self._getWidget(position + 1)
+
+    def get_prev(self, position):
+        return self._getWidget(position - 1)
+
+class ExtendedListBox(urwid.ListBox):
+    """
+        Listbow widget with embeded autoscroll
+    """
+
+    __metaclass__ = urwid.MetaSignals
+    signals = ["set_auto_scroll"]
+
+
+    def set_auto_scroll(self, switch):
+        if type(switch) != bool:
+            return
+        self._auto_scroll = switch
+        urwid.emit_signal(self, "set_auto_scroll", switch)
+
+
+    auto_scroll = property(lambda s: s._auto_scroll, set_auto_scroll)
+
+
+    def __init__(self, body):
+        urwid.ListBox.__init__(self, body)
+        self.auto_scroll = True
+
+
+    def switch_body(self, body):
+        if self.body:
+            urwid.disconnect_signal(body, "modified", self._invalidate)
+
+        self.body = body
+        self._invalidate()
+
+        urwid.connect_signal(body, "modified", self._invalidate)
+
+
+    def keypress(self, size, key):
+        urwid.ListBox.keypress(self, size, key)
+
+        if key in ("page up", "page down"):
+            logging.debug("focus = %d, len = %d" % (self.get_focus()[1], len(self.body)))
+            if self.get_focus()[1] == len(self.body)-1:
+                self.auto_scroll = True
+            else:
+                self.auto_scroll = False
+            logging.debug("auto_scroll = %s" % (self.auto_scroll))
+
+
+    def scroll_to_bottom(self):
+        logging.debug("current_focus = %s, len(self.body) = %d" % (self.get_focus()[1], len(self.body)))
+
+        if self.auto_scroll:
+            # at bottom -> scroll down
+            self.set_focus(len(self.body))
+
+
+
+"""
+ -------context-------
+| --inner context---- |
+|| HEADER            ||
+||                   ||
+|| BODY              ||
+||                   ||
+|| DIVIDER           ||
+| ------------------- |
+| FOOTER              |
+ ---------------------
+
+inner context = context.body
+context.body.body = BODY
+context.body.header = HEADER
+context.body.footer = DIVIDER
+context.footer = FOOTER
+
+HEADER = Notice line (urwid.Text)
+BODY = Extended ListBox
+DIVIDER = Divider with information (urwid.Text)
+FOOTER = Input line (Ext. Edit)
+"""
+
+
+class MainWindow(object):
+
+    __metaclass__ = MetaSignals
+    signals = ["quit","keypress"]
+
+    _palette = [
+            ('divider','black','dark cyan', 'standout'),
+            ('text','light gray', 'default'),
+            ('bold_text', 'light gray', 'default', 'bold'),
+            ('client_text','light gray', 'default'),
+            ('server_text', 'light blue', 'default'),
+            ('info_text', 'light green', 'default'),
+            ('warning_text', 'yellow', 'default'),
+            ('error_text', 'light red', 'default'),
+            ("body", "text"),
+            ("footer", "text"),
+            ("header", "text"),
+        ]
+
+    for type, bg in (
+            ("div_fg_", "dark cyan"),
+            ("", "default")):
+        for name, color in (
+                ("red","dark red"),
+                ("blue", "dark blue"),
+                ("green", "dark green"),
+                ("yellow", "yellow"),
+                ("magenta", "dark magenta"),
+                ("gray", "light gray"),
+                ("white", "white"),
+                ("black", "black")):
+            _palette.append( (type + name, color, bg) )
+
+
+    def __init__(self, shellClass, sender="1234567890", scrollback=1000, profile=None):
+        """
+            scrollback is the number of output entries kept in memory,
+            older ones are kept on disk (see ScrollbackWalker)
+            profile gets the start-up marks (see StartupProfile)
+        """
+        self.shall_quit = False
+        self.sender = sender
+        self.scrollback = scrollback
+        self.profile = profile
+        self.shellClass = shellClass
+        self.shell = None
+        self._uiThread = threading.current_thread()
+        self._calls = deque()           # (function, args) to run in the UI thread
+        self._wakeFd = None
+        self._cmds = Queue.Queue()      # typed commands, run by the shell thread
+
+
+    def main(self):
+        """ 
+            Entry point to start UI 
+        """
+
+        self.ui = urwid.raw_display.Screen()
+        self.ui.register_palette(self._palette)
+        self.build_interface()
+        self.ui.run_wrapper(self.run)
+
+
+    def _mark(self, name):
+        if self.profile is not None:
+            self.profile.mark(name)
+
+
+    def _call(self, func, *args):
+        """ 
+            Run func in the UI thread
+        """
+        if threading.current_thread() is self._uiThread:
+            func(*args)
+        else:
+            self._calls.append((func, args))
+            os.write(self._wakeFd, 'x')
+
+
+    def _on_wake(self, data):
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
+        return True
+
+
+    def _start_shell(self):
+        """ 
+            Create the shell (DB, USB devices...) in the background
+            while the prompt is already usable, then run the commands
+            typed. The UI thread draws what they print as it comes
+            (a fire or a calibration prints for seconds).
+        """
+        try:
+            shell = self.shellClass(self._print_info_async, self._print_warning_async, self._print_error_async)
+        except Exception, e:
+            logging.exception('Shell initialization failed')
+            self._call(self.print_error, 'Initialization failed: ' + str(e))
+            return
+        self._mark('shell ready')
+        self._call(self._on_shell_ready, shell)
+        while True:
+            text = self._cmds.get()
+            try:
+                reply = shell.processCmd(text)
+            except Exception, e:
+                logging.exception('Command failed: ' + text)
+                self._call(self.print_error, 'Internal error: ' + str(e))
+                continue
+            if reply != None:
+                self._call(self.print_received_message, reply)
+
+
+    def _print_info_async(self, text):
+        self._call(self.print_info, text)
+
+    def _print_warning_async(self, text):
+        self._call(self.print_warning, text)
+
+    def _print_error_async(self, text):
+        self._call(self.print_error, text)
+
+
+    def _on_shell_ready(self, shell):
+        self.shell = shell
+        self.divider.set_text(("divider",
+                               ("Enter a command (help for list):")))
+        if self.profile is not None and self.profile.enabled:
+            for line in self.profile.report():
+                self.print_info(line)
+
+
+    def run(self):
+        """ 
+            Setup input handler, invalidate handler to
+            automatically redraw the interface if needed.
+
+            Start mainloop.
+        """
+
+        # I don't know what the callbacks are for yet,
+        # it's a code taken from the nigiri project
+        def input_cb(key):
+            if self.shall_quit:
+                raise urwid.ExitMainLoop
+            self.keypress(self.size, key)
+
+        self.size = self.ui.get_cols_rows()
+
+        self.main_loop = urwid.MainLoop(
+                self.context,
+                screen=self.ui,
+                handle_mouse=False,
+                unhandled_input=input_cb,
+            )
+
+        self._wakeFd = self.main_loop.watch_pipe(self._on_wake)
+        self.main_loop.set_alarm_in(0, lambda *x: self._mark('prompt shown'))
+        starter = threading.Thread(target=self._start_shell)
+        starter.daemon = True
+        starter.start()
+
+        def call_redraw(*x):
+            self.draw_interface()
+            invalidate.locked = False
+            return True
+
+        inv = urwid.canvas.CanvasCache.invalidate
+
+        def invalidate (cls, *a, **k):
+            inv(*a, **k)
+
+            if not invalidate.locked:
+                invalidate.locked = True
+                self.main_loop.set_alarm_in(0, call_redraw)
+
+        invalidate.locked = False
+        urwid.canvas.CanvasCache.invalidate = classmethod(invalidate)
+
+        try:
+            self.main_loop.run()
+        except KeyboardInterrupt:
+            self.quit()
+
+
+    def quit(self, exit=True):
+        """ 
+            Stops the ui, exits the application (if exit=True)
+        """
+        urwid.emit_signal(self, "quit")
+
+        self.shall_quit = True
+
+        if exit:
+            sys.exit(0)
+
+
+    def build_interface(self):
+        """ 
+            Call the widget methods to build the UI 
+        """
+
+        self.header = urwid.Text("HF City Missile Launcher control center")
+        self.footer = urwid.Edit("> ")
+        self.divider = urwid.Text("Initializing.")
+
+        self.generic_output_walker = ScrollbackWalker(self.scrollback)
+        self.body = ExtendedListBox(self.generic_output_walker)
+        self.header = urwid.AttrWrap(self.header, "divider")
+        self.footer = urwid.AttrWrap(self.footer, "footer")
+        self.divider = urwid.AttrWrap(self.divider, "divider")
+        self.body = urwid.AttrWrap(self.body, "body")
+
+        self.footer.set_wrap_mode("space")
+
+        main_frame = urwid.Frame(self.body, 
+                                header=self.header,
+                                footer=self.divider)
+        
+        self.context = urwid.Frame(main_frame, footer=self.footer)
+
+        self.divider.set_text(("divider",
+                               ("Initializing... (commands typed now run once ready)")))
+
+        self.context.set_focus("footer")
+
+
+
+    def draw_interface(self):
+        self.main_loop.draw_screen()
+
+
+    def keypress(self, size, key):
+        """ 
+            Handle user inputs
+        """
+
+        urwid.emit_signal(self, "keypress", size, key)
+
+        # scroll the top panel
+        if key in ("page up","page down"):
+            self.body.keypress (size, key)
+
+        # resize the main windows
+        elif key == "window resize":
+            self.size = self.ui.get_cols_rows()
+
+        elif key in ("ctrl d", 'ctrl c'):
+            self.quit()
+
+        elif key == "enter":
+            # Parse data or (if parse failed)
+            # send it to the current world
+            text = self.footer.get_edit_text()
+
+            self.footer.set_edit_text(" "*len(text))
+            self.footer.set_edit_text("")
+
+            if text in ('quit', 'q'):
+                self.quit()
+
+            if text.strip():
+                self.run_command(text)
+
+        else:
+            self.context.keypress (size, key)
+
+ 
+    def run_command(self, text):
+        """ 
+            Queue a command for the shell thread (see _start_shell)
+        """
+        self.print_sent_message(text)
+        self._cmds.put(text)
+
+
+    def print_sent_message(self, text):
+        """
+            Print a received message
+        """
+
+        self.print_text(('client_text', ('[%s] You: %s' % (self.get_time(), text))))
+ 
+ 
+    def print_received_message(self, text):
+        """
+            Print a sent message
+        """
+        self.print_text(('server_text', ('[%s] System: %s' % (self.get_time(), text))))
+
+    def print_info(self, text):
+        """
+            Print an info message
+        """
+        self.print_text(('info_text', ('[%s] Info: %s' % (self.get_time(), text))))
+
+    def print_warning(self, text):
+        """
+            Print a warning message
+        """
+        self.print_text(('warning_text', ('[%s] Warning: %s' % (self.get_time(), text))))
+
+
+    def print_error(self, text):
+        """
+            Print an error message
+        """
+        self.print_text(('error_text', ('[%s] Error: %s' % (self.get_time(), text))))
+
+        
+    def print_text(self, text):
+        """
+            Print the given text in the _current_ window
+            and scroll to the bottom. 
+            You can pass a Text object or a text markup
+        """
+
+        walker = self.generic_output_walker
+
+        if isinstance(text, urwid.Text):
+            text = text.get_text()[0]
+
+        walker.append(text)
+
+        self.body.scroll_to_bottom()
+
+
+    def get_time(self):
+        """
+            Return formated current datetime
+        """
+        return datetime.now().strftime('%H:%M:%S')
+        
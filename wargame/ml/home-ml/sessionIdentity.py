@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Session identity of the missile launcher controller interface
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Resolve the address of the peer of the current SSH session.
+
+    The address is taken from SSH_CONNECTION/SSH_CLIENT (set by sshd) or,
+    if missing, from the utmp record of the session terminal. It is
+    resolved once and cached for the life of the process. Only the
+    caller's own session is considered, not every logged in ml session.
+    The control server (missileServer.py), which serves many sessions,
+    sets the address of the session in the thread running its commands.
+"""
+import os
+import struct
+import socket
+import threading
+
+import latencyStats
+
+UTMP_FILE = '/var/run/utmp'
+UNKNOWN_SOURCE = 'Unknown'
+
+# struct utmp from <utmp.h> (Linux, 384 bytes)
+UTMP_RECORD = struct.Struct('<hxxi32s4s32s256shhi2i16s20x')
+USER_PROCESS = 7
+
+_sourceIP = None
+_session = threading.local()    # sourceIP set by setSourceIP() in this thread
+
+def getSourceIP():
+    """
+    Return the peer address of the current session (cached)
+    """
+    global _sourceIP
+    if getattr(_session, 'sourceIP', None) is not None:
+        return _session.sourceIP
+    if _sourceIP is None:
+        with latencyStats.timer('session.resolveSourceIP'):
+            _sourceIP = resolveSourceIP()
+    return _sourceIP
+
+def setSourceIP(sourceIP):
+    """
+    Replace the address of the current session in the calling thread
+    """
+    _session.sourceIP = sourceIP
+
+def resolveSourceIP():
+    """
+    Resolve the peer address of the current session without using the cache
+    """
+    return _fromEnvironment() or _fromUtmp() or UNKNOWN_SOURCE
+
+def _fromEnvironment():
+    for var in ('SSH_CONNECTION', 'SSH_CLIENT'):
+        value = os.environ.get(var, '').split()
+        if value:
+            return value[0]
+    return None
+
+def _getTerminal():
+    """
+    Return the terminal of the session as written in utmp (ex: pts/3)
+    """
+    for fd in (0, 1, 2):
+        try:
+            tty = os.ttyname(fd)
+        except OSError:
+            continue
+        if tty.startswith('/dev/'):
+            return tty[5:]
+    return None
+
+def _fromUtmp():
+    line = _getTerminal()
+    if line is None:
+        return None
+    try:
+        f = open(UTMP_FILE, 'rb')
+    except IOError:
+        return None
+    try:
+        while True:
+            data = f.read(UTMP_RECORD.size)
+            if len(data) < UTMP_RECORD.size:
+                return None
+            (utType, pid, utLine, utId, utUser, utHost, \
+             exitTerm, exitExit, session, tvSec, tvUsec, addr) = UTMP_RECORD.unpack(data)
+            if utType == USER_PROCESS and utLine.rstrip('\0') == line:
+                return _formatAddress(addr) or utHost.rstrip('\0') or None
+    finally:
+        f.close()
+
+def _formatAddress(addr):
+    """
+    Format ut_addr_v6: an IPv4 address only uses the first word
+    """
+    if addr == '\0' * 16:
+        return None
+    if addr[4:] == '\0' * 12:
+        return socket.inet_ntop(socket.AF_INET, addr[:4])
+    return socket.inet_ntop(socket.AF_INET6, addr)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Span tracing of the fires
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Span tracing of the fires. Each fire gets a trace id and every span
+    started while the trace is active (USB transfers of the scheduler
+    thread, crash detection, DB writes) is written to the trace file. The
+    times are CLOCK_MONOTONIC nanoseconds, the clock of the timestamps of
+    the events of buildingSensor.py, so the crashes reported by the sensor
+    are added to the trace as events at the time the sensor saw them.
+
+    The file is a 32 bytes header followed by variable size records:
+        header: magic (4s), version (H), padding (2x), boot id (16s), padding (8x)
+        record: trace id (Q), span id (I), parent span id (I), start in ns (Q),
+                duration in ns (Q), name length (H), name (UTF-8)
+    A name is "NAME [key=value ...]". Records are appended with one write()
+    on an O_APPEND descriptor, the file is moved to FILE.1 when it grows
+    over maxSize and restarted when the boot id changes.
+
+    Usage: spanTrace.py [--last N | --trace ID] [--width N] [FILE]
+    Print the waterfall of the last N fires (default 1) of FILE
+    (default logs/missile2k13.trace).
+"""
+import os
+import sys
+import struct
+import getopt
+import random
+import contextlib
+import threading
+
+HEADER = struct.Struct('<4sH2x16s8x')
+RECORD = struct.Struct('<QIIQQH')
+MAGIC = 'HFTR'
+VERSION = 1
+DEFAULT_FILE = 'logs/missile2k13.trace'
+
+class Span():
+    def __init__(self, tracer, traceId, spanId, parentId, name, start):
+        self.tracer = tracer
+        self.traceId = traceId
+        self.spanId = spanId
+        self.parentId = parentId
+        self.name = name
+        self.start = start
+
+    def end(self):
+        self.tracer.write(self.traceId, self.spanId, self.parentId, self.start, \
+                          self.tracer.clock() - self.start, self.name)
+
+class SpanTracer():
+    """
+    Writer of the trace file. One trace is active at a time in the process
+    (the fire being run), the spans of the other threads are children of
+    its root span.
+    """
+    maxSize = 8 * 1024 * 1024   # in bytes
+
+    def __init__(self, path, clock, bootId):
+        self.path = path
+        self.clock = clock
+        self.bootId = bootId
+        self.root = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._nextId = 1
+        self._random = random.SystemRandom()
+        d = os.path.dirname(path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self._open()
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        if os.fstat(self.fd).st_size >= HEADER.size:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            magic, version, bootId = HEADER.unpack(os.read(self.fd, HEADER.size))
+            if magic == MAGIC and version == VERSION and bootId == self.bootId:
+                return
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, HEADER.pack(MAGIC, VERSION, self.bootId))
+
+    def _newSpanId(self):
+        with self._lock:
+            spanId = self._nextId
+            self._nextId += 1
+        return spanId
+
+    def write(self, traceId, spanId, parentId, start, duration, name):
+        name = name.encode('utf-8') if isinstance(name, unicode) else name
+        with self._lock:
+            if os.fstat(self.fd).st_size > self.maxSize:
+                os.close(self.fd)
+                os.rename(self.path, self.path + '.1')
+                self._open()
+            os.write(self.fd, RECORD.pack(traceId, spanId, parentId, start, max(0, duration), len(name)) + name)
+
+    def startTrace(self, name):
+        """
+        This method start a trace and return its root span, see endTrace()
+        """
+        self.root = Span(self, self._random.getrandbits(64), self._newSpanId(), 0, name, self.clock())
+        self._local.stack = [self.root]
+        return self.root
+
+    def endTrace(self):
+        if self.root is not None:
+            self.root.end()
+        self.root = None
+        self._local.stack = []
+
+    def getTraceId(self):
+        """
+        Return the id of the active trace as hex or None
+        """
+        if self.root is None:
+            return None
+        return '%016x' % self.root.traceId
+
+    def _getStack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Context manager tracing its block as a span of the active trace (nothing without trace)
+        """
+        root = self.root
+        if root is None:
+            yield None
+            return
+        stack = self._getStack()
+        parent = stack[-1] if stack and stack[-1].traceId == root.traceId else root
+        s = Span(self, root.traceId, self._newSpanId(), parent.spanId, name, self.clock())
+        stack.append(s)
+        try:
+            yield s
+        finally:
+            stack.pop()
+            s.end()
+
+    def event(self, name, timestamp=None):
+        """
+        This method add an instant event (ex: a crash seen by the sensor at timestamp ns) to the active trace
+        """
+        root = self.root
+        if root is None:
+            return
+        stack = self._getStack()
+        parent = stack[-1] if stack and stack[-1].traceId == root.traceId else root
+        self.write(root.traceId, self._newSpanId(), parent.spanId, \
+                   timestamp if timestamp is not None else self.clock(), 0, name)
+
+    def close(self):
+        os.close(self.fd)
+
+class _NullTracer():
+    """
+    Tracer used until configure() is called
+    """
+    root = None
+
+    def getTraceId(self):
+        return None
+
+    @contextlib.contextmanager
+    def span(self, name):
+        yield None
+
+    def event(self, name, timestamp=None):
+        pass
+
+    def startTrace(self, name):
+        return None
+
+    def endTrace(self):
+        pass
+
+tracer = _NullTracer()
+
+def configure(path, clock, bootId):
+    """
+    This method open the trace file of the process (once)
+    @param clock: function returning CLOCK_MONOTONIC in ns
+    """
+    global tracer
+    if isinstance(tracer, _NullTracer):
+        tracer = SpanTracer(path, clock, bootId)
+    return tracer
+
+def span(name):
+    return tracer.span(name)
+
+def event(name, timestamp=None):
+    tracer.event(name, timestamp)
+
+def readTraces(path):
+    """
+    Return the traces of a file as {traceId: [(spanId, parentId, start, duration, name), ...]}
+    and the trace ids in the order of their first record
+    """
+    data = open(path, 'rb').read()
+    traces = {}
+    order = []
+    if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+        return traces, order
+    pos = HEADER.size
+    while pos + RECORD.size <= len(data):
+        traceId, spanId, parentId, start, duration, length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        name = data[pos:pos + length]
+        pos += length
+        if traceId not in traces:
+            traces[traceId] = []
+            order.append(traceId)
+        traces[traceId].append((spanId, parentId, start, duration, name))
+    return traces, order
+
+def renderWaterfall(traceId, spans, width=50):
+    """
+    Return the lines of the waterfall of a trace, children under their parent in start order
+    """
+    origin = min([s[2] for s in spans])
+    end = max([s[2] + s[3] for s in spans])
+    total = max(end - origin, 1)
+    children = {}
+    ids = set([s[0] for s in spans])
+    for s in spans:
+        parent = s[1] if s[1] in ids else 0
+        children.setdefault(parent, []).append(s)
+    aLines = ['Trace %016x: %d spans, %.1f ms' % (traceId, len(spans), (end - origin) / 1e6)]
+
+    def walk(parentId, depth):
+        for (spanId, pId, start, duration, name) in sorted(children.get(parentId, []), key=lambda s: (s[2], s[0])):
+            first = int((start - origin) * width / total)
+            size = int(round(duration * width / float(total)))
+            bar = ' ' * first + ('#' * size if size else '|')
+            aLines.append('  %-40s %-*s %9.1f %+9.1f ms' % \
+                          (('  ' * depth + name)[:40], width + 1, bar[:width + 1], (start - origin) / 1e6, duration / 1e6))
+            walk(spanId, depth + 1)
+    walk(0, 0)
+    return aLines
+
+def main(argv):
+    try:
+        aOpts, aArgs = getopt.getopt(argv, '', ['last=', 'trace=', 'width='])
+    except getopt.GetoptError:
+        print >> sys.stderr, __doc__.strip()
+        sys.exit(1)
+    last, wanted, width = 1, None, 50
+    for (opt, value) in aOpts:
+        if opt == '--last':
+            last = int(value)
+        elif opt == '--trace':
+            wanted = int(value, 16)
+        elif opt == '--width':
+            width = int(value)
+    traces, order = readTraces(aArgs[0] if aArgs else DEFAULT_FILE)
+    aIds = [wanted] if wanted is not None else order[-last:]
+    for traceId in aIds:
+        if traceId not in traces:
+            print >> sys.stderr, 'Unknown trace: %016x' % traceId
+            sys.exit(1)
+        print '\n'.join(renderWaterfall(traceId, traces[traceId], width))
+        print
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -20,52 +20,185 @@ import time
 import RPi.GPIO as GPIO
 import os, sys
 import logging
-from threading import Thread
-from logging.handlers import TimedRotatingFileHandler
+from threading import Thread, Lock
+import asyncLog
+import crashJournal
+from crashJournal import CrashJournal, CrashPublisher
+
+# Overridden to run elsewhere than on the game box (see ../sim)
+ROOT_DIR = os.environ.get('HF_ROOT_DIR', '/root')
+RUN_DIR = os.environ.get('HF_RUN_DIR', '/var/run')
 
 
 # CLASSES
+class CrashDebouncer():
+    """
+    Debounce/hysteresis state machine of a single sensor channel.
+
+    The channel is 'idle' until its pin goes high. The first high sample
+    reports a crash and moves the channel to 'crashed'. A low sample moves
+    it to 'releasing' and the channel only goes back to 'idle' once the pin
+    stayed low for releaseTime seconds. A building bouncing on its sensor
+    is therefore reported once per impact.
+
+    The high samples of a crash are only counted: going back to 'idle'
+    ends the run, summarized by getRun() instead of a line per sample.
+    """
+    CRASH = 'crash'
+    END = 'end'
+
+    def __init__(self, buildingId, releaseTime):
+        self.buildingId = buildingId
+        self.releaseTime = releaseTime
+        self.state = 'idle'
+        self._lowSince = None
+        self._runStart = None
+        self._samples = 0
+        self._run = None
+        self._lock = Lock()
+
+    def update(self, level, now=None):
+        """
+        This method feed a pin level to the state machine. Return CRASH if a new crash must be
+        reported, END when the crash is over (see getRun()) or None.
+        @param level: Pin level
+        @type level: Boolean
+        @param now: Sample time (default: time.time())
+        @type now: Float
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if level:
+                self._samples += 1
+                if self.state == 'crashed':
+                    return None
+                if self.state == 'releasing' and \
+                   now - self._lowSince < self.releaseTime:
+                    self.state = 'crashed'
+                    return None
+                self.state = 'crashed'
+                self._runStart = now
+                self._samples = 1
+                return self.CRASH
+            else:
+                if self.state == 'crashed':
+                    self.state = 'releasing'
+                    self._lowSince = now
+                elif self.state == 'releasing' and \
+                     now - self._lowSince >= self.releaseTime:
+                    self.state = 'idle'
+                    self._run = (self._runStart, self._lowSince, self._samples)
+                    return self.END
+                return None
+
+    def getRun(self):
+        """
+        Return (start, end, high samples) of the last ended crash, times are time.time() values
+        """
+        return self._run
+
 class BuildingSensor(Thread):
     _bState = 'notstarted'
     chan1 = 12
     chan2 = 16
-    pidFile = '/var/run/buildingSensor/bs.pid'
-    logDir = '/root/logs'
+    backend = 'edge'        # 'edge' (GPIO edge detection) or 'poll'
+    pollInterval = 0.02     # in seconds, sampling period of the poll backend
+    idleInterval = 0.5      # in seconds, state loop period of the edge backend
+    bounceTime = 20         # in miliseconds, given to GPIO edge detection
+    releaseTime = 0.5       # in seconds, low time before a new impact can be reported
+    pidFile = RUN_DIR + '/buildingSensor/bs.pid'
+    logDir = ROOT_DIR + '/logs'
     logFile = 'buildingSensor.log'
+    journalFile = 'buildingSensor.journal'
+    socketFile = 'buildingSensor.sock'
 
     def __init__(self):
         Thread.__init__(self)
         self.configLogs()
+        self.journal = CrashJournal(os.path.join(self.logDir, self.journalFile))
+        self.publisher = CrashPublisher(os.path.join(self.logDir, self.socketFile))
+        self.publisher.start()
         GPIO.setmode(GPIO.BOARD)
         GPIO.setup(self.chan1, GPIO.IN)
         GPIO.setup(self.chan2, GPIO.IN)
+        self.debouncers = {self.chan1: CrashDebouncer(1, self.releaseTime), \
+                           self.chan2: CrashDebouncer(2, self.releaseTime)}
+        if self.backend == 'edge':
+            self.setupEdgeDetection()
+
+    def setupEdgeDetection(self):
+        """
+        This method register the GPIO edge callbacks. Fall back to polling if the GPIO library can't do it.
+        """
+        try:
+            for chan in self.debouncers:
+                GPIO.add_event_detect(chan, GPIO.BOTH, \
+                                      callback=self.onEdge, \
+                                      bouncetime=self.bounceTime)
+            self.log.info('Using edge detection backend')
+        except (AttributeError, RuntimeError), e:
+            self.log.warning('Edge detection unavailable (' + str(e) + '), falling back to polling')
+            self.backend = 'poll'
 
     def run(self):
         while self.isRunning():
-            if self.getState() == 'dying':
+            state = self.getState()
+            if state == 'dying':
                 break
-            if self.getState() == 'started':
+            if state == 'started':
                 self.checkInput()
-            if self.getState() == 'stopped':
+            if state == 'stopped':
                 pass
-            if self.getState() == 'starting':
+            if state == 'starting':
                 self.log.info('Starting')
                 self.setState('started')
-            if self.getState() == 'stopping':
+            if state == 'stopping':
                 self.log.info('Stopping')
                 self.setState('stopped')
-            if self.getState() == 'notstarted':
+            if state == 'notstarted':
                 pass
-            #time.sleep(0.2)
-            time.sleep(0.02)
+            if self.backend == 'poll':
+                time.sleep(self.pollInterval)
+            else:
+                time.sleep(self.idleInterval)
         GPIO.cleanup()
         return 0
 
     def checkInput(self):
-        if (GPIO.input(self.chan1)):
-            self.log.info('Building #1 crashed')
-        if (GPIO.input(self.chan2)):
-            self.log.info('Building #2 crashed')
+        """
+        This method sample every channel. With the edge backend, it only resync 
+        the state machines in case an edge was swallowed by the bounce time.
+        """
+        now = time.time()
+        for chan in self.debouncers:
+            self.processLevel(chan, GPIO.input(chan), now)
+
+    def onEdge(self, chan):
+        """
+        GPIO edge callback (called from the GPIO library thread)
+        """
+        if self.getState() == 'started':
+            self.processLevel(chan, GPIO.input(chan))
+
+    def processLevel(self, chan, level, now=None):
+        oDebouncer = self.debouncers[chan]
+        event = oDebouncer.update(level, now)
+        if event == CrashDebouncer.CRASH:
+            self.publisher.publish(self.journal.append(chan, oDebouncer.buildingId))
+            self.log.info('Building #' + str(oDebouncer.buildingId) + ' crashed')
+        elif event == CrashDebouncer.END:
+            start, end, samples = oDebouncer.getRun()
+            # Stamped now like every record (the journal is in time order), the argument tells when the pin went low
+            age = int(max(0.0, time.time() - end) * 1000)
+            self.publisher.publish(self.journal.append(chan, oDebouncer.buildingId, crashJournal.EVENT_END, age))
+            # Not "Building #N crashed": CrashDetector (missile2k13.py) would count the end as a new crash
+            self.log.info('Building #%d crash ended: %s to %s (%d samples)' % \
+                          (oDebouncer.buildingId, self.formatTime(start), self.formatTime(end), samples))
+
+    @staticmethod
+    def formatTime(t):
+        return time.strftime('%H:%M:%S', time.localtime(t)) + '.%03d' % int(t % 1 * 1000)
 
     def getState(self):
         """
@@ -126,24 +259,14 @@ class BuildingSensor(Thread):
         """
         This method configure the logs for this object. 
         """
-        logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        dateTimeFormat = '%Y-%m-%d %H:%M:%S'
-
-        # Write also to file
-        fh = TimedRotatingFileHandler(os.path.join(self.logDir,self.logFile), \
-                                      backupCount=0, \
-                                      when='d', \
-                                      interval=1)
-        fh.setFormatter(logging.Formatter(logFormat, dateTimeFormat))
-        self.log = logging.getLogger('BuildingSensor')
-        self.log.addHandler(fh)
-       
-        # Set log level
-        self.log.setLevel(logging.DEBUG)
-        #self.log.setLevel(logging.INFO)
+        asyncLog.setup(os.path.join(self.logDir,self.logFile))
+        self.log = asyncLog.getLogger('BuildingSensor')
+        #self.log = asyncLog.getLogger('BuildingSensor', logging.INFO)
 
 
 # MENU
+if '--poll' in sys.argv[1:]:
+    BuildingSensor.backend = 'poll'
 bs = BuildingSensor()
 bs.daemon=True
 bs.start()
@@ -21,16 +21,106 @@ import RPi.GPIO as GPIO
 import os, sys
 import logging
 import shelve
+import sqlite3
+import cPickle
+import struct
+import select
+import ctypes, ctypes.util
 from threading import Thread
-from logging.handlers import TimedRotatingFileHandler
+import asyncLog
+
+# Overridden to run elsewhere than on the game box (see ../sim)
+ROOT_DIR = os.environ.get('HF_ROOT_DIR', '/root')
+ML_DIR = os.environ.get('HF_ML_DIR', '/home/ml')
+RUN_DIR = os.environ.get('HF_RUN_DIR', '/var/run')
 
 
 # CLASSES
+class InotifyWatcher():
+    """
+    Wait for modifications of a file (and of its -wal/-journal companions)
+    with inotify. The parent directory is watched since SQLite and dbm
+    create and replace those files.
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    EVENT = struct.Struct('iIII')
+    settleTime = 0.02       # in seconds, wait for the writer to finish before reporting a change
+
+    def __init__(self, path):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init()
+        if self.fd < 0:
+            self._raise()
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if self._libc.inotify_add_watch(self.fd, os.path.dirname(path) or '.', mask) < 0:
+            os.close(self.fd)
+            self._raise()
+        self.prefix = os.path.basename(path)
+
+    def _raise(self):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    def _readChanged(self, timeout):
+        """
+        Return True if the watched file changed before timeout
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        data = os.read(self.fd, 4096)
+        changed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if name.startswith(self.prefix):
+                changed = True
+        return changed
+
+    def wait(self, timeout):
+        """
+        This method wait up to timeout seconds for a change. Return True once the file changed
+        and stayed untouched for settleTime seconds, False on timeout.
+        """
+        deadline = time.time() + timeout
+        while not self._readChanged(max(0, deadline - time.time())):
+            if time.time() >= deadline:
+                return False
+        while self._readChanged(self.settleTime):
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class SleepWatcher():
+    """
+    Stand-in for InotifyWatcher when inotify is unavailable: sleeps and always reports a change.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return True
+
+    def close(self):
+        pass
+
 class LightController(Thread):
     _bState = 'notstarted'
+    _lightStatus = None
     chan1 = 18
-    pidFile = '/var/run/lightController/lc.pid'
-    logDir = '/root/logs'
+    recheckInterval = 30    # in seconds, read the DB even if no change was notified
+    pollInterval = 2        # in seconds, used if inotify is unavailable
+    idleInterval = 0.5      # in seconds, state loop period when not started
+    pidFile = RUN_DIR + '/lightController/lc.pid'
+    logDir = ROOT_DIR + '/logs'
     logFile = 'lightController.log'
 
     def __init__(self):
@@ -39,37 +129,53 @@ class LightController(Thread):
         GPIO.cleanup()
         GPIO.setmode(GPIO.BOARD)
         GPIO.setup(self.chan1, GPIO.OUT)
+        self.oDB = DBController()
+        try:
+            self.watcher = InotifyWatcher(self.oDB.getPath())
+        except OSError, e:
+            self.log.warning('inotify unavailable (' + str(e) + '), polling the DB')
+            self.watcher = SleepWatcher(self.pollInterval)
 
     def run(self):
         while self.isRunning():
-            if self.getState() == 'dying':
+            state = self.getState()
+            if state == 'dying':
                 break
-            if self.getState() == 'started':
+            if state == 'started':
                 self.checkInput()
-            if self.getState() == 'stopped':
+            if state == 'stopped':
                 pass
-            if self.getState() == 'starting':
+            if state == 'starting':
                 self.log.info('Starting')
                 self.setState('started')
-            if self.getState() == 'stopping':
+            if state == 'stopping':
                 self.log.info('Stopping')
                 self.setState('stopped')
-            if self.getState() == 'notstarted':
+            if state == 'notstarted':
                 pass
-            time.sleep(2)
+            if self.getState() == 'started':
+                self.watcher.wait(self.recheckInterval)
+            else:
+                time.sleep(self.idleInterval)
+        self.watcher.close()
+        self.oDB.close()
         GPIO.cleanup()
         return 0
 
     def checkInput(self):
-        oDB = DBController().getDB()
-        if (oDB['lightStatus']):
+        """
+        This method read the light status and write the GPIO pin if it changed.
+        """
+        lightStatus = bool(self.oDB.getLightStatus())
+        if lightStatus == self._lightStatus:
+            return
+        self._lightStatus = lightStatus
+        if lightStatus:
             self.turnOn()
-            #self.log.info('Light is turned on')
+            self.log.info('Light is turned on')
         else:
             self.turnOff()
-            #self.log.info('Light is turned off')
-        del oDB
-        oDB = None
+            self.log.info('Light is turned off')
 
     def getState(self):
         """
@@ -130,21 +236,9 @@ class LightController(Thread):
         """
         This method configure the logs for this object. 
         """
-        logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        dateTimeFormat = '%Y-%m-%d %H:%M:%S'
-
-        # Write also to file
-        fh = TimedRotatingFileHandler(os.path.join(self.logDir,self.logFile), \
-                                      backupCount=0, \
-                                      when='d', \
-                                      interval=1)
-        fh.setFormatter(logging.Formatter(logFormat, dateTimeFormat))
-        self.log = logging.getLogger('LightController')
-        self.log.addHandler(fh)
-       
-        # Set log level
-        self.log.setLevel(logging.DEBUG)
-        #self.log.setLevel(logging.INFO)
+        asyncLog.setup(os.path.join(self.logDir,self.logFile))
+        self.log = asyncLog.getLogger('LightController')
+        #self.log = asyncLog.getLogger('LightController', logging.INFO)
 
     def turnOn(self):
         GPIO.output(self.chan1,True)
@@ -152,39 +246,62 @@ class LightController(Thread):
     def turnOff(self):
         GPIO.output(self.chan1,False)
 
+class SQLiteSettings():
+    """
+    Read-only access to the settings table of the SQLite game DB (see SQLiteStorage in missile2k13.py)
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getitem__(self, key):
+        row = self.conn.execute('SELECT value FROM settings WHERE name = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return cPickle.loads(str(row[0]))
+
+    def close(self):
+        self.conn.close()
+
 class DBController():
-    dbFile = '/home/ml/missile2k13.shelve'
+    dbFile = ML_DIR + '/missile2k13.shelve'
     #dbFile = 'missile2k13.shelve'
+    sqliteFile = ML_DIR + '/missile2k13.sqlite'
+    storageBackend = 'sqlite'       # Must match DBController.storageBackend in missile2k13.py
     d = None
 
     def __init__(self):
         self._configLogs()
         #self.log.info('Opening shelve (' + str(self.dbFile) + ')')
-        self.d = shelve.open(self.dbFile)
+        if self.storageBackend == 'sqlite':
+            self.d = SQLiteSettings(sqlite3.connect(self.sqliteFile, timeout=5, check_same_thread=False))    # used by the LightController thread
+        else:
+            self.d = shelve.open(self.dbFile)
         #self.log.debug(self.d)
 
     def _configLogs(self):
         """
         This method configure the logs for this object. 
         """
-        logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        dateTimeFormat = '%Y-%m-%d %H:%M:%S'
-        logFile = 'lightController.log'
-        logDir = '/root/logs'
-
-        fh = TimedRotatingFileHandler(os.path.join(logDir,logFile), \
-                                      backupCount=0, \
-                                      when='d', \
-                                      interval=1)
-        fh.setFormatter(logging.Formatter(logFormat, dateTimeFormat))
-
-        self.log = logging.getLogger('DBController')
-        self.log.addHandler(fh)
-        self.log.setLevel(logging.INFO)
+        self.log = asyncLog.getLogger('DBController', logging.INFO)
 
     def getDB(self):
         return self.d
 
+    def getPath(self):
+        if self.storageBackend == 'sqlite':
+            return self.sqliteFile
+        return self.dbFile
+
+    def getLightStatus(self):
+        """
+        This method return the current light status. The shelve is reopened 
+        on every call since it doesn't see the writes of other processes.
+        """
+        if self.storageBackend != 'sqlite':
+            self.d.close()
+            self.d = shelve.open(self.dbFile)
+        return self.d['lightStatus']
+
     def sync(self):
         self.d.sync()
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Asynchronous logging pipeline shared by the missile2k13 daemons
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Logging pipeline: every logger propagates to a single QueueHandler on
+    the root logger and a LogWriter thread does the file I/O. The file
+    handler is configured once per process (setup()), so creating objects
+    never adds handlers and a slow SD card never blocks the caller.
+
+    Installed once in /usr/local/lib/python2.7/dist-packages (root-owned)
+    for missile2k13.py and the daemons of /root, like crashJournal.py.
+"""
+import os
+import atexit
+import logging
+import Queue
+from threading import Thread
+from logging.handlers import TimedRotatingFileHandler
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+DATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+QUEUE_SIZE = 10000
+
+_queue = None
+_writer = None
+
+class QueueHandler(logging.Handler):
+    """
+    Handler putting the records in a queue. Records are dropped (and 
+    counted) rather than blocking the caller when the queue is full.
+    """
+    dropped = 0
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self._formatter = logging.Formatter()
+
+    def emit(self, record):
+        try:
+            # Render the message now: args may change before the writer handles the record
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = self._formatter.formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class LogWriter(Thread):
+    """
+    Thread writing the queued records to the real handlers
+    """
+    def __init__(self, queue, handlers):
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.close()
+
+def setup(logFile, level=logging.DEBUG):
+    """
+    Configure the pipeline writing to logFile (daily rotation). Only the first call has an effect.
+    """
+    global _queue, _writer
+    if _writer is not None:
+        return
+    d = os.path.dirname(logFile)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+
+    fh = TimedRotatingFileHandler(logFile, \
+                                  backupCount=0, \
+                                  when='d', \
+                                  interval=1)
+    fh.setFormatter(logging.Formatter(LOG_FORMAT, DATE_TIME_FORMAT))
+
+    _queue = Queue.Queue(QUEUE_SIZE)
+    _writer = LogWriter(_queue, [fh])
+    _writer.start()
+
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(_queue))
+    root.setLevel(level)
+    atexit.register(shutdown)
+
+def getLogger(name, level=logging.DEBUG):
+    """
+    Return the named logger. No handler is added: records go through the root logger.
+    """
+    log = logging.getLogger(name)
+    log.setLevel(level)
+    return log
+
+def shutdown():
+    """
+    Flush the queued records and stop the writer thread
+    """
+    global _writer
+    if _writer is None:
+        return
+    _queue.put(None)
+    _writer.join(5)
+    _writer = None
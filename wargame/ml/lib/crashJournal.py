@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Crash events shared by buildingSensor.py and missile2k13.py
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Crash events written by buildingSensor.py and read by the fire path of
+    missile2k13.py: the journal file, the socket stream of the same records
+    and the clock of their timestamps.
+
+    The journal is a 32 bytes header followed by 16 bytes records:
+        header: magic (4s), version (H), record size (H), boot id (16s), padding (8x)
+        record: monotonic timestamp in ns (Q), GPIO channel (B), building id (B),
+                event kind (B), padding (x), event argument (I)
+    A crash is one EVENT_CRASH record when the pin goes high and one
+    EVENT_END record once it stayed low for the release time (argument:
+    miliseconds between the pin going low and the record). Every record is
+    stamped when it is appended, so the records are in time order.
+
+    Installed once in /usr/local/lib/python2.7/dist-packages, like
+    asyncLog.py: the daemons run as root so they must never import a module
+    of /home/ml, which the players can write.
+"""
+import os
+import mmap
+import socket
+import select
+import struct
+from threading import Thread, Lock
+
+HEADER = struct.Struct('<4sHH16s8x')
+RECORD = struct.Struct('<QBBBxI')
+MAGIC = 'HFCJ'
+VERSION = 1
+EVENT_CRASH = 1
+EVENT_END = 2
+
+CLOCK_MONOTONIC = 1
+_clock = None       # (ctypes, librt, timespec), loaded by the first monotonicNs() call
+
+def monotonicNs():
+    """
+    Return CLOCK_MONOTONIC in nanoseconds (same clock in every process until reboot)
+    """
+    global _clock
+    if _clock is None:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        _clock = (ctypes, librt, timespec)
+    ctypes, librt, timespec = _clock
+    t = timespec()
+    if librt.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return t.tv_sec * 1000000000 + t.tv_nsec
+
+def getBootId():
+    """
+    Return the kernel boot id as 16 raw bytes. Monotonic timestamps are only comparable within a boot.
+    """
+    return open('/proc/sys/kernel/random/boot_id').read().strip().replace('-', '').decode('hex')
+
+class CrashJournal():
+    """
+    Append-only writer of the journal (buildingSensor.py).
+
+    Records are appended with a single write() on an O_APPEND descriptor so
+    readers never see a partial record. The file is restarted when the
+    boot id changes since the timestamps of an older boot are meaningless.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.bootId = getBootId()
+        self.fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        self._lock = Lock()
+        self._checkHeader()
+
+    def _checkHeader(self):
+        """
+        This method (re)write the header if the file is empty (ex: cleared by initDB.py) or from another boot.
+        """
+        if os.fstat(self.fd).st_size >= HEADER.size:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            magic, version, recSize, bootId = HEADER.unpack(os.read(self.fd, HEADER.size))
+            if magic == MAGIC and version == VERSION and \
+               recSize == RECORD.size and bootId == self.bootId:
+                return
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, HEADER.pack(MAGIC, VERSION, RECORD.size, self.bootId))
+
+    def append(self, channel, buildingId, kind=EVENT_CRASH, arg=0):
+        """
+        This method append an event stamped now and return its record
+        """
+        with self._lock:
+            if os.fstat(self.fd).st_size == 0:
+                self._checkHeader()
+            record = RECORD.pack(monotonicNs(), channel, buildingId, kind, arg)
+            os.write(self.fd, record)
+        return record
+
+    def close(self):
+        os.close(self.fd)
+
+class CrashJournalReader():
+    """
+    Reader of the journal (missile2k13.py).
+
+    The file is memory-mapped read-only and records are decoded in place
+    with struct.unpack_from. Records are appended in time order so the
+    first recent record is found with a binary search.
+    """
+    _map = None
+
+    def __init__(self, path):
+        self.path = path
+        self.bootId = getBootId()
+        self._open()
+
+    def _open(self):
+        f = open(self.path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                return
+            self._map = mmap.mmap(f.fileno(), size, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            f.close()
+
+    def isValid(self):
+        """
+        This method return True if the journal belongs to the current boot and has the expected format
+        """
+        if self._map is None:
+            return False
+        magic, version, recSize, bootId = HEADER.unpack_from(self._map, 0)
+        return magic == MAGIC and version == VERSION and \
+               recSize == RECORD.size and bootId == self.bootId
+
+    def getCount(self):
+        if self._map is None:
+            return 0
+        return (len(self._map) - HEADER.size) // RECORD.size
+
+    def getTimestamp(self, index):
+        return RECORD.unpack_from(self._map, HEADER.size + index * RECORD.size)[0]
+
+    def getEventsSince(self, timestamp):
+        """
+        This method return the events (timestamp, channel, buildingId, kind, arg) logged at or after timestamp (ns)
+        """
+        if not self.isValid():
+            return []
+        lo, hi = 0, self.getCount()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.getTimestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return [RECORD.unpack_from(self._map, HEADER.size + i * RECORD.size) \
+                for i in xrange(lo, self.getCount())]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+class CrashPublisher(Thread):
+    """
+    Publish the journal records to local subscribers (missile2k13.py) over
+    a Unix stream socket. Subscribers only read; a subscriber that is gone
+    or too slow to drain its socket is dropped. A record is never sent in 
+    part: the rest of the stream would be read out of its record framing.
+    """
+    def __init__(self, path):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self._subscribers = []
+        self._lock = Lock()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0666)
+        self._sock.listen(16)
+
+    def run(self):
+        while True:
+            with self._lock:
+                socks = [self._sock] + self._subscribers
+            readable = select.select(socks, [], [])[0]
+            for s in readable:
+                if s is self._sock:
+                    conn = self._sock.accept()[0]
+                    conn.setblocking(0)
+                    with self._lock:
+                        self._subscribers.append(conn)
+                else:
+                    # Subscribers never write: readable means closed
+                    self._drop(s)
+
+    def _drop(self, s):
+        with self._lock:
+            if s in self._subscribers:
+                self._subscribers.remove(s)
+        try:
+            # The subscriber sees the end of the stream at once (the run() thread may still hold the socket)
+            s.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        s.close()
+
+    def publish(self, data):
+        """
+        This method send data to every subscriber without blocking.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for s in subscribers:
+            try:
+                sent = s.send(data)
+            except socket.error:
+                sent = 0
+            if sent < len(data):
+                self._drop(s)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    RPi.GPIO replacement of the hardware simulator
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    The part of the RPi.GPIO API used by the daemons, on the pins of the
+    simulator (see simState.PinBank). Edge detection samples the pins
+    every millisecond in one thread per process.
+"""
+import time
+from threading import Thread, Lock
+
+from simState import getPinBank
+
+BOARD = 10
+BCM = 11
+IN = 1
+OUT = 0
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+VERSION = '0.5.3a-sim'
+
+_mode = None
+_directions = {}
+_events = {}            # channel: [edge, callbacks, bouncetime (s), last level, last callback time, detected]
+_lock = Lock()
+_thread = None
+sampleInterval = 0.001  # in seconds
+
+def setwarnings(flag):
+    pass
+
+def setmode(mode):
+    global _mode
+    _mode = mode
+
+def getmode():
+    return _mode
+
+def _check(channel):
+    if _mode is None:
+        raise RuntimeError('Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)')
+    if channel < 0 or channel >= getPinBank().PIN_COUNT:
+        raise ValueError('The channel sent is invalid on a Raspberry Pi')
+
+def setup(channel, direction, pull_up_down=PUD_OFF, initial=None):
+    _check(channel)
+    _directions[channel] = direction
+    if direction == OUT and initial is not None:
+        getPinBank().set(channel, initial)
+
+def input(channel):
+    _check(channel)
+    return getPinBank().get(channel)
+
+def output(channel, value):
+    _check(channel)
+    if _directions.get(channel) != OUT:
+        raise RuntimeError('The GPIO channel has not been set up as an OUTPUT')
+    getPinBank().set(channel, value)
+
+def cleanup(channel=None):
+    with _lock:
+        for c in ([channel] if channel is not None else _directions.keys()):
+            _directions.pop(c, None)
+            _events.pop(c, None)
+
+def _matches(edge, previous, level):
+    if previous == level:
+        return False
+    return edge == BOTH or (edge == RISING and level) or (edge == FALLING and not level)
+
+def _sampler():
+    bank = getPinBank()
+    while True:
+        time.sleep(sampleInterval)
+        now = time.time()
+        aCalls = []
+        with _lock:
+            for (channel, event) in _events.items():
+                level = bank.get(channel)
+                edge, callbacks, bouncetime, previous, lastCall = event[:5]
+                event[3] = level
+                if not _matches(edge, previous, level) or now - lastCall < bouncetime:
+                    continue
+                event[4] = now
+                event[5] = True
+                aCalls += [(callback, channel) for callback in callbacks]
+        for (callback, channel) in aCalls:
+            callback(channel)
+
+def add_event_detect(channel, edge, callback=None, bouncetime=0):
+    global _thread
+    _check(channel)
+    with _lock:
+        if channel in _events:
+            raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+        _events[channel] = [edge, [], bouncetime / 1000.0, getPinBank().get(channel), 0, False]
+        if callback is not None:
+            _events[channel][1].append(callback)
+        if _thread is None:
+            _thread = Thread(target=_sampler)
+            _thread.daemon = True
+            _thread.start()
+
+def add_event_callback(channel, callback, bouncetime=0):
+    with _lock:
+        if channel not in _events:
+            raise RuntimeError('Add event detection using add_event_detect first before adding a callback')
+        _events[channel][1].append(callback)
+
+def remove_event_detect(channel):
+    with _lock:
+        _events.pop(channel, None)
+
+def event_detected(channel):
+    with _lock:
+        if channel not in _events:
+            return False
+        detected = _events[channel][5]
+        _events[channel][5] = False
+        return detected
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Pins of the hardware simulator
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Read and drive the simulated GPIO pins.
+
+    Usage: simPins.py show
+           simPins.py set CHANNEL LEVEL
+           simPins.py wave CHANNEL "LEVEL:SECONDS LEVEL:SECONDS ... [LEVEL]"
+           simPins.py crash BUILDING
+
+    "wave 12 '1:0.002 0:0.001 1:1.0 0'" is a bouncy one second hit on
+    building #1. "crash" plays the hit of a building of the world.
+"""
+import sys
+
+from simState import getPinBank
+
+PIN_NAMES = {12: 'building #1 sensor', 16: 'building #2 sensor', 18: 'light'}
+
+def usage():
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def main(args):
+    if not args:
+        usage()
+    bank = getPinBank()
+    if args[0] == 'show':
+        for channel in sorted(PIN_NAMES):
+            print '%2d %d  %s' % (channel, bank.get(channel), PIN_NAMES[channel])
+    elif args[0] == 'set' and len(args) == 3:
+        bank.set(int(args[1]), int(args[2]))
+    elif args[0] == 'wave' and len(args) == 3:
+        bank.play(int(args[1]), bank.parseWaveform(args[2])).join()
+    elif args[0] == 'crash' and len(args) == 2:
+        from simWorld import World
+        aBuildings = [b for b in World.load().buildings if b.name == args[1]]
+        if not aBuildings:
+            print >> sys.stderr, 'Unknown building: ' + args[1]
+            sys.exit(1)
+        aBuildings[0].crash().join()
+    else:
+        usage()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Runner of the hardware simulator
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    Run the whole game on a plain Linux box. This directory replaces
+    RPi.GPIO and pyusb and ../lib is the installed shared modules
+    (PYTHONPATH), HF_ROOT_DIR, HF_ML_DIR and HF_RUN_DIR
+    move /root, /home/ml and /var/run under HF_SIM_DIR. The DB is reset
+    (initDB.py), buildingSensor.py and lightController.py are started in
+    the background and missile2k13.py runs in the foreground with the
+    given arguments (or missileServer.py with --server).
+
+    Usage: simStack.py [--server] [MISSILE2K13 ARGUMENTS ...]
+    e.g.   simStack.py -c "unlock fire DPQJDUEja43H8Dfhmjaq; enable 0; fire"
+    (the key of the fire module set by initDB.py, launcher #0 faces building 1)
+
+    The daemons can also be run by hand with the same environment:
+    PYTHONPATH=sim:lib HF_ROOT_DIR=... python home-root/buildingSensor.py
+"""
+import os
+import sys
+import time
+import subprocess
+
+from simState import SIM_DIR, getPinBank
+
+SIM_PATH = os.path.dirname(os.path.abspath(__file__))
+GAME_PATH = os.path.dirname(SIM_PATH)
+
+def getEnvironment():
+    """
+    Return the environment of the simulated processes
+    """
+    env = dict(os.environ)
+    env['HF_SIM_DIR'] = SIM_DIR
+    env['HF_ROOT_DIR'] = os.path.join(SIM_DIR, 'root')
+    env['HF_ML_DIR'] = os.path.join(SIM_DIR, 'ml')
+    env['HF_RUN_DIR'] = os.path.join(SIM_DIR, 'run')
+    env['PYTHONPATH'] = os.pathsep.join([SIM_PATH, os.path.join(GAME_PATH, 'lib')] + \
+                                        [p for p in [os.environ.get('PYTHONPATH')] if p])
+    for key in ('HF_ROOT_DIR', 'HF_ML_DIR'):
+        if not os.path.exists(os.path.join(env[key], 'logs')):
+            os.makedirs(os.path.join(env[key], 'logs'))
+    return env
+
+def main(args):
+    env = getEnvironment()
+    bank = getPinBank()
+    for channel in xrange(bank.PIN_COUNT):
+        bank.set(channel, 0)
+    mlDir = env['HF_ML_DIR']
+    subprocess.check_call([sys.executable, os.path.join(GAME_PATH, 'home-ml', 'initDB.py')], env=env, cwd=mlDir)
+    aDaemons = [subprocess.Popen([sys.executable, os.path.join(GAME_PATH, 'home-root', script)], env=env, \
+                                 cwd=env['HF_ROOT_DIR']) for script in ('buildingSensor.py', 'lightController.py')]
+    try:
+        time.sleep(1)
+        if args[:1] == ['--server']:
+            aCmd = [sys.executable, os.path.join(GAME_PATH, 'home-ml', 'missileServer.py')] + args[1:]
+        else:
+            aCmd = [sys.executable, os.path.join(GAME_PATH, 'home-ml', 'missile2k13.py')] + args
+        return subprocess.call(aCmd, env=env, cwd=mlDir)
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        for p in aDaemons:
+            p.terminate()
+            p.wait()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
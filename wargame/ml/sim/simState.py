@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Shared state of the hardware simulator
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    State shared by the processes of a simulated stack. The GPIO pins are
+    one byte each in a file mapped by every process (HF_SIM_DIR/pins), so
+    a pin raised by the launchers of missile2k13.py is read by
+    buildingSensor.py and the light written by lightController.py can be
+    read by anyone (simPins.py).
+"""
+import os
+import time
+import mmap
+from threading import Thread
+
+SIM_DIR = os.environ.get('HF_SIM_DIR', '/tmp/hf2k13-sim')
+
+class PinBank():
+    """
+    Levels of the simulated GPIO pins (board numbering)
+    """
+    PIN_COUNT = 64
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(SIM_DIR, 'pins')
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            if os.fstat(fd).st_size < self.PIN_COUNT:
+                os.ftruncate(fd, self.PIN_COUNT)
+            self._map = mmap.mmap(fd, self.PIN_COUNT, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+    def get(self, channel):
+        return ord(self._map[channel])
+
+    def set(self, channel, level):
+        self._map[channel] = chr(1 if level else 0)
+
+    def play(self, channel, steps):
+        """
+        This method play a waveform on a pin in a thread
+        @param steps: [(level, duration in seconds), ...]
+        """
+        def run():
+            for (level, duration) in steps:
+                self.set(channel, level)
+                time.sleep(duration)
+        t = Thread(target=run)
+        t.daemon = True
+        t.start()
+        return t
+
+    @staticmethod
+    def parseWaveform(text):
+        """
+        Return the steps of "LEVEL:SECONDS LEVEL:SECONDS ... [LEVEL]"
+        """
+        steps = []
+        for item in text.split():
+            level, sep, duration = item.partition(':')
+            steps.append((int(level), float(duration or 0)))
+        return steps
+
+_bank = None
+
+def getPinBank():
+    """
+    Return the pin bank of the process
+    """
+    global _bank
+    if _bank is None:
+        _bank = PinBank()
+    return _bank
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    Launchers and buildings of the hardware simulator
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    The table of the game: launchers, their motors and missiles, and the
+    buildings wired to the sensor pins. Coordinates are in meters, the
+    launchers face the +y axis and z is up. A missile follows a ballistic
+    trajectory from the pose of its launcher; when it enters a building,
+    the pin of the building goes high (with contact bounces) for a while.
+
+    HF_SIM_WORLD may name a JSON file replacing the defaults:
+    {"launchers": [{"x": 0, "y": 0, "z": 0.1, "panSpeed": 55, ...}, ...],
+     "buildings": [{"name": "1", "channel": 12, "x": -0.6, "y": 2.0,
+                    "width": 0.3, "depth": 0.3, "height": 0.5}, ...],
+     "usbErrorRate": 0.0}
+"""
+import os
+import sys
+import math
+import json
+import time
+import random
+import logging
+from threading import Lock, Timer
+
+from simState import getPinBank
+
+# The launchers move with the motion model of the controller
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'home-ml'))
+from launcherMotion import MotionModel, CMD_FIRE
+
+class Building():
+    """
+    A box standing on the table, wired to a sensor pin
+    """
+    crashBounces = [(1, 0.002), (0, 0.001), (1, 0.003), (0, 0.002)]   # contact bounces of the sensor
+    crashDuration = 1.0     # in seconds, time the pin stays high
+
+    def __init__(self, name, channel, x, y, width=0.3, depth=0.3, height=0.5):
+        self.name = name
+        self.channel = channel
+        self.x = x
+        self.y = y
+        self.width = width
+        self.depth = depth
+        self.height = height
+
+    def contains(self, x, y, z):
+        return abs(x - self.x) <= self.width / 2 and abs(y - self.y) <= self.depth / 2 and 0 <= z <= self.height
+
+    def crash(self):
+        """
+        This method play the waveform of a hit on the pin of the building
+        """
+        return getPinBank().play(self.channel, self.crashBounces + [(1, self.crashDuration), (0, 0)])
+
+class LauncherPhysics():
+    """
+    Motors and missiles of one launcher. The motors follow a MotionModel
+    (see launcherMotion.py) with the speeds of this unit. The launcher 
+    faces +y at panForward and is level at tiltLevel.
+    """
+    panSpeed = 55.0         # in degrees per second
+    tiltSpeed = 22.0        # in degrees per second
+    spinUp = 0.03           # in seconds, motor latency before a move starts
+    panRange = 300.0        # in degrees
+    tiltRange = 40.0        # in degrees
+    panForward = 150.0      # in degrees
+    tiltLevel = 5.0         # in degrees
+    fireDelay = 1.5         # in seconds, the pump runs before the missile leaves
+    missileSpeed = 6.0      # in meters per second
+    missiles = 4            # missiles loaded
+    gravity = 9.81          # in meters per second^2
+    timeStep = 0.002        # in seconds, trajectory integration step
+    maxFlight = 3.0         # in seconds
+
+    def __init__(self, world, x=0.0, y=0.0, z=0.1, **kwargs):
+        self.world = world
+        self.x = x
+        self.y = y
+        self.z = z
+        for (key, value) in kwargs.items():
+            setattr(self, key, value)
+        self.model = MotionModel(self.panSpeed, self.tiltSpeed, self.spinUp, self.panRange, self.tiltRange, \
+                                 self.panRange / 2, self.tiltRange / 2)
+        self._lock = Lock()
+        self._firing = False
+        self.log = logging.getLogger('LauncherPhysics')
+
+    def command(self, cmd):
+        """
+        This method apply a command received by the device
+        """
+        with self._lock:
+            self.model.command(cmd, time.time())
+            if cmd == CMD_FIRE and not self._firing and self.missiles > 0:
+                self._firing = True
+                t = Timer(self.fireDelay, self._launch)
+                t.daemon = True
+                t.start()
+
+    def getPosition(self):
+        with self._lock:
+            return self.model.getPosition(time.time())
+
+    def _launch(self):
+        pan, tilt = self.getPosition()
+        with self._lock:
+            self._firing = False
+            self.missiles -= 1
+        building, flight, point = self.world.trace(self.trajectory(pan, tilt))
+        self.log.info('Missile launched at pan %.1f tilt %.1f, %s after %.2fs at (%.2f, %.2f, %.2f)' % \
+                      ((pan, tilt, 'building ' + building.name if building else 'ground', flight) + point))
+        if building is not None:
+            t = Timer(flight, building.crash)
+            t.daemon = True
+            t.start()
+
+    def trajectory(self, pan, tilt):
+        """
+        Yield the (t, x, y, z) of a missile launched at pan/tilt
+        """
+        azimuth = math.radians(pan - self.panForward)
+        elevation = math.radians(tilt - self.tiltLevel)
+        horizontal = self.missileSpeed * math.cos(elevation)
+        vx, vy = -horizontal * math.sin(azimuth), horizontal * math.cos(azimuth)
+        vz = self.missileSpeed * math.sin(elevation)
+        t = 0.0
+        while t <= self.maxFlight:
+            z = self.z + vz * t - self.gravity * t * t / 2
+            yield (t, self.x + vx * t, self.y + vy * t, z)
+            if z < 0:
+                return
+            t += self.timeStep
+
+class World():
+    """
+    Launchers and buildings of the simulated table
+    """
+    DEFAULT = {'launchers': [{'x': -0.5, 'y': 0.0, 'z': 0.1},
+                             {'x': 0.0, 'y': 0.0, 'z': 0.1, 'panSpeed': 52.0, 'tiltSpeed': 21.0},
+                             {'x': 0.5, 'y': 0.0, 'z': 0.1, 'panSpeed': 58.0, 'tiltSpeed': 23.5, 'spinUp': 0.04}],
+               'buildings': [{'name': '1', 'channel': 12, 'x': -0.6, 'y': 2.0},
+                             {'name': '2', 'channel': 16, 'x': 0.7, 'y': 2.5, 'height': 0.8}],
+               'usbErrorRate': 0.0}
+
+    def __init__(self, config=None):
+        config = config or self.DEFAULT
+        self.buildings = [Building(**b) for b in config.get('buildings', [])]
+        self.launchers = [LauncherPhysics(self, **l) for l in config.get('launchers', [])]
+        self.usbErrorRate = config.get('usbErrorRate', 0.0)
+        self._random = random.Random(0)
+
+    @staticmethod
+    def load():
+        """
+        Return the world of HF_SIM_WORLD or the default one
+        """
+        path = os.environ.get('HF_SIM_WORLD')
+        if path:
+            with open(path) as f:
+                return World(json.load(f))
+        return World()
+
+    def trace(self, points):
+        """
+        Return the (building hit or None, flight time, (x, y, z)) of a trajectory
+        """
+        for (t, x, y, z) in points:
+            for building in self.buildings:
+                if building.contains(x, y, z):
+                    return (building, t, (x, y, z))
+        return (None, t, (x, y, z))
+
+    def transferFails(self):
+        return self.usbErrorRate > 0 and self._random.random() < self.usbErrorRate
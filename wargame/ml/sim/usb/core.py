@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#    pyusb replacement of the hardware simulator
+#    Copyright (C) 2013  Martin Dubé
+#    Version: 2013-10-20:2020
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+    The part of usb.core used by missile2k13.py: one device per launcher
+    of the simulated world (see simWorld.py), plugged on bus 1, port 1..N.
+    The control transfers drive the motors and the missiles of the
+    launcher.
+"""
+from simWorld import World
+
+ID_VENDOR = 0x2123
+ID_PRODUCT = 0x1010
+
+class USBError(IOError):
+    def __init__(self, strerror, error_code=None, errno=None):
+        IOError.__init__(self, errno, strerror)
+        self.backend_error_code = error_code
+
+class Device():
+    """
+    A simulated launcher
+    """
+    def __init__(self, world, launcher, port):
+        self.world = world
+        self.launcher = launcher
+        self.idVendor = ID_VENDOR
+        self.idProduct = ID_PRODUCT
+        self.bus = 1
+        self.port_number = port
+        self.port_numbers = (port,)
+        self.address = port + 1
+        self._driverActive = True
+
+    def is_kernel_driver_active(self, interface):
+        return self._driverActive
+
+    def detach_kernel_driver(self, interface):
+        self._driverActive = False
+
+    def set_configuration(self, configuration=None):
+        pass
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        if self.world.transferFails():
+            raise USBError('Operation timed out', -7, 110)
+        data = data_or_wLength
+        if bmRequestType == 0x21 and bRequest == 0x09 and data is not None and len(data) == 8:
+            packet = [ord(c) for c in data] if isinstance(data, str) else list(data)
+            if packet[0] == 0x02:
+                self.launcher.command(packet[1])
+            return len(data)
+        return 0
+
+_devices = None
+
+def getDevices():
+    """
+    Return the devices of the simulated world, created once per process
+    """
+    global _devices
+    if _devices is None:
+        world = World.load()
+        _devices = [Device(world, launcher, port + 1) for (port, launcher) in enumerate(world.launchers)]
+    return _devices
+
+def find(find_all=False, backend=None, custom_match=None, **args):
+    aDevices = [dev for dev in getDevices() \
+                if all([getattr(dev, key) == value for (key, value) in args.items()]) and \
+                (custom_match is None or custom_match(dev))]
+    if find_all:
+        return iter(aDevices)
+    return aDevices[0] if aDevices else None